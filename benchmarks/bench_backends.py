@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Inference backend accuracy vs latency benchmark
+===============================================
+
+Loads the embedding model and flan-t5 on every backend in research/inference_backends.py
+(fp32 torch, dynamic int8, onnxruntime) and runs the same fixed question set through each:
+
+  embedding   ms per batch of passages, mean cosine similarity to the fp32 vectors and
+              retrieval accuracy (is the question's own passage the nearest one)
+  generation  ms per answer (p50 / p95), answer accuracy (the expected answer appears in the
+              output) and agreement with the fp32 answer
+
+Pick the fastest backend whose accuracy stays at the torch level, then set RAG_INFERENCE_BACKEND
+(or RAG_EMBEDDING_BACKEND / RAG_GENERATION_BACKEND).
+A backend whose dependencies are missing (onnx without optimum[onnxruntime]) is reported and skipped.
+
+Usage:
+    python benchmarks/bench_backends.py
+    python benchmarks/bench_backends.py --backends torch int8 --repeats 3
+    python benchmarks/bench_backends.py --skip-generation
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+# make the django project importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "market_research.settings")
+# benchmark on CPU only so numbers are comparable between machines
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import django
+
+django.setup()
+
+import numpy as np
+
+from research.inference_backends import BACKENDS, load_embedding_model, load_generator
+from research.model_registry import embedding_model_name, generation_model_name
+from research.rag_pipeline import GENERATION_KWARGS, augment_context
+
+# fixed question set: a passage like the ones we index, a question about it and the expected answer
+QUESTIONS = [
+    ("Apple reported total net sales of $383.3 billion for fiscal 2023, down 3 percent from the prior year.",
+     "What were Apple's total net sales in fiscal 2023?", "$383.3 billion"),
+    ("Microsoft's Intelligent Cloud segment revenue was $87.9 billion, driven by Azure growth of 29 percent.",
+     "How much did Azure grow?", "29 percent"),
+    ("NVIDIA's data center revenue reached a record $47.5 billion, up 217 percent year over year.",
+     "What was NVIDIA's data center revenue?", "$47.5 billion"),
+    ("Amazon recorded operating income of $36.9 billion in 2023 compared with $12.2 billion in 2022.",
+     "What was Amazon's operating income in 2023?", "$36.9 billion"),
+    ("Tesla delivered 1.81 million vehicles in 2023, and automotive gross margin fell to 18.2 percent.",
+     "How many vehicles did Tesla deliver in 2023?", "1.81 million"),
+    ("JPMorgan's board declared a quarterly dividend of $1.05 per share payable on January 31.",
+     "What quarterly dividend did JPMorgan declare?", "$1.05"),
+    ("Alphabet repurchased $61.5 billion of its Class A and Class C shares during the year.",
+     "How much stock did Alphabet repurchase?", "$61.5 billion"),
+    ("Meta's headcount was 67,317 as of December 31, 2023, a decrease of 22 percent year over year.",
+     "What was Meta's headcount at the end of 2023?", "67,317"),
+    ("Exxon Mobil's capital and exploration expenditures were $26.3 billion in 2023.",
+     "What were Exxon's capital and exploration expenditures?", "$26.3 billion"),
+    ("UnitedHealth Group's medical care ratio increased to 83.2 percent from 82.0 percent.",
+     "What was UnitedHealth's medical care ratio?", "83.2 percent"),
+    ("The company recognized a goodwill impairment charge of $1.2 billion in its consumer segment.",
+     "How large was the goodwill impairment charge?", "$1.2 billion"),
+    ("Long-term debt totaled $95.3 billion, with maturities ranging from 2025 to 2062.",
+     "How much long-term debt was outstanding?", "$95.3 billion"),
+]
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().replace(",", "").split())
+
+
+def timed_load(loader, *args):
+    start = time.perf_counter()
+    model = loader(*args)
+    return model, time.perf_counter() - start
+
+
+def bench_embedding(backends, repeats):
+    passages = [passage for passage, _, _ in QUESTIONS]
+    questions = [question for _, question, _ in QUESTIONS]
+    reference = None
+    print(f"embedding model {embedding_model_name()}")
+    print(f"{'backend':<10}{'load s':>8}{'ms/batch':>10}{'cosine vs fp32':>16}{'retrieval acc':>15}")
+    for backend in backends:
+        try:
+            model, load_seconds = timed_load(load_embedding_model, embedding_model_name(), backend)
+        except Exception as e:
+            print(f"{backend:<10}  skipped: {e}")
+            continue
+        encode = lambda texts: np.asarray(model.encode(texts, convert_to_numpy=True, normalize_embeddings=True,
+                                                       show_progress_bar=False), dtype=np.float32)
+        # warm up, the first call initialises kernels and the onnx session
+        encode(passages[:2])
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            passage_vectors = encode(passages)
+            times.append(time.perf_counter() - start)
+        question_vectors = encode(questions)
+
+        nearest = np.argmax(question_vectors @ passage_vectors.T, axis=1)
+        accuracy = float(np.mean(nearest == np.arange(len(questions))))
+        if reference is None:
+            reference = passage_vectors
+        cosine = float(np.mean(np.sum(passage_vectors * reference, axis=1)))
+        print(f"{backend:<10}{load_seconds:>8.1f}{min(times) * 1000:>10.1f}{cosine:>16.4f}{accuracy:>15.2f}")
+    print()
+
+
+def bench_generation(backends, repeats):
+    prompts = [
+        augment_context(question, [{"id": str(i), "content": passage,
+                                    "metadata": {"company": "benchmark", "doc_type": "10-K"}}])
+        for i, (passage, question, _) in enumerate(QUESTIONS)
+    ]
+    expected = [normalize(answer) for _, _, answer in QUESTIONS]
+    reference = None
+    print(f"generation model {generation_model_name()}")
+    print(f"{'backend':<10}{'load s':>8}{'p50 ms':>10}{'p95 ms':>10}{'accuracy':>10}{'agrees w/ fp32':>16}")
+    for backend in backends:
+        try:
+            generator, load_seconds = timed_load(load_generator, generation_model_name(), backend)
+        except Exception as e:
+            print(f"{backend:<10}  skipped: {e}")
+            continue
+        generate = lambda prompt: generator(prompt, truncation=True, **GENERATION_KWARGS)[0]["generated_text"]
+        generate(prompts[0])
+        times, answers = [], []
+        for prompt in prompts:
+            for _ in range(repeats):
+                start = time.perf_counter()
+                answer = generate(prompt)
+                times.append(time.perf_counter() - start)
+            answers.append(answer)
+
+        accuracy = statistics.mean(want in normalize(answer) for want, answer in zip(expected, answers))
+        if reference is None:
+            reference = answers
+        agreement = statistics.mean(normalize(a) == normalize(b) for a, b in zip(answers, reference))
+        print(f"{backend:<10}{load_seconds:>8.1f}{percentile(times, 0.5) * 1000:>10.0f}"
+              f"{percentile(times, 0.95) * 1000:>10.0f}{accuracy:>10.2f}{agreement:>16.2f}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # torch first, the other backends are compared against its vectors and answers
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--repeats", type=int, default=1, help="timed runs per question")
+    parser.add_argument("--skip-embedding", action="store_true")
+    parser.add_argument("--skip-generation", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{len(QUESTIONS)} questions, {os.cpu_count()} cpus\n")
+    if not args.skip_embedding:
+        bench_embedding(args.backends, args.repeats)
+    if not args.skip_generation:
+        bench_generation(args.backends, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Embedding throughput benchmark
+==============================
+
+Compares chunks/sec of the old per-chunk loop
+    [model.encode(chunk["content"]).tolist() for chunk in chunks]
+against the batched, length sorted path in research/embeddings.py on CPU.
+
+Usage:
+    python benchmarks/bench_embedding.py                       # synthetic chunks
+    python benchmarks/bench_embedding.py --file filing.txt     # chunks from a real document
+    python benchmarks/bench_embedding.py --batch-sizes 16 32 64 128
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+# make the django project importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "market_research.settings")
+# benchmark on CPU only so numbers are comparable between machines
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import django
+
+django.setup()
+
+from research.embedding_cache import get_embedding_cache
+from research.embeddings import embed_texts
+from research.model_registry import get_embedding_model
+from research.rag_pipeline import chunk_documents
+
+WORDS = (
+    "revenue net income operating margin fiscal year quarter guidance cash flow "
+    "capital expenditures segment subscription services hardware impairment goodwill "
+    "dividend share repurchase liquidity debt covenant inflation headwinds 10-K 2024"
+).split()
+
+
+def synthetic_chunks(count: int):
+    # chunks of uneven length, like real filings produce
+    rng = random.Random(0)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 60))) for _ in range(count)]
+
+
+def chunks_from_file(path: str):
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        content = f.read()
+    document = {"title": path, "company": "Unknown", "doc_type": "benchmark", "content": content, "date_filed": None}
+    return [chunk["content"] for chunk in chunk_documents([document])]
+
+
+def per_chunk_loop(model, texts):
+    # the original vector_db() implementation
+    return [model.encode(text).tolist() for text in texts]
+
+
+def timed(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="text file to chunk instead of synthetic chunks")
+    parser.add_argument("--chunks", type=int, default=512, help="number of synthetic chunks")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--repeats", type=int, default=3, help="best of N runs is reported")
+    args = parser.parse_args()
+
+    texts = chunks_from_file(args.file) if args.file else synthetic_chunks(args.chunks)
+    model = get_embedding_model()
+    # one throwaway call so lazy initialisation does not count against the first run
+    model.encode(texts[:4])
+
+    print(f"{len(texts)} chunks, average {sum(map(len, texts)) // len(texts)} characters\n")
+    print(f"{'method':<28}{'seconds':>10}{'chunks/sec':>14}{'speedup':>10}")
+
+    baseline = timed(lambda: per_chunk_loop(model, texts), args.repeats)
+    print(f"{'per-chunk loop':<28}{baseline:>10.3f}{len(texts) / baseline:>14.1f}{1.0:>10.2f}")
+
+    cache = get_embedding_cache()
+    for batch_size in args.batch_sizes:
+        # empty the embedding cache before every run, otherwise we would time cache hits
+        seconds = timed(lambda: (cache.clear(), embed_texts(texts, batch_size=batch_size)), args.repeats)
+        label = f"batched (batch_size={batch_size})"
+        print(f"{label:<28}{seconds:>10.3f}{len(texts) / seconds:>14.1f}{baseline / seconds:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
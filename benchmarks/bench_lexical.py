@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Lexical (BM25) leg latency benchmark
+====================================
+
+Builds a synthetic corpus of filing-like chunks, indexes it in the in-process BM25 index
+(research/lexical_index.py) and in an in-memory chroma collection with random 384-d vectors,
+then reports per-query latency of the dense search, the lexical search and the rank fusion,
+so the extra cost hybrid retrieval adds on top of the dense search is visible.
+
+No models are loaded, the dense leg uses random query vectors of the MiniLM size.
+
+Usage:
+    python benchmarks/bench_lexical.py
+    python benchmarks/bench_lexical.py --chunks 20000 50000 --queries 500
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+# make the django project importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "market_research.settings")
+
+import django
+
+django.setup()
+
+import chromadb
+import numpy as np
+
+from research.lexical_index import LexicalIndex
+from research.rag_pipeline import reciprocal_rank_fusion
+
+WORDS = (
+    "revenue net income operating margin fiscal year quarter guidance cash flow capital expenditures "
+    "segment subscription services hardware impairment goodwill dividend share repurchase liquidity "
+    "debt covenant inflation headwinds backlog inventory warranty deferred tax lease"
+).split()
+TICKERS = ["AAPL", "MSFT", "NVDA", "AMZN", "GOOGL", "META", "TSLA", "JPM", "XOM", "UNH"]
+DIMENSION = 384
+
+
+def synthetic_chunk(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(30, 55))]
+    words.insert(rng.randrange(len(words)), rng.choice(TICKERS))
+    words.insert(rng.randrange(len(words)), f"FY{rng.randint(2015, 2025)}")
+    words.insert(rng.randrange(len(words)), f"${rng.randint(1, 999)}.{rng.randint(0, 9)}M")
+    return " ".join(words)
+
+
+def synthetic_query(rng: random.Random) -> str:
+    return f"{rng.choice(TICKERS)} {rng.choice(WORDS)} {rng.choice(WORDS)} FY{rng.randint(2015, 2025)}"
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return statistics.mean(samples) * 1000, pick(0.5), pick(0.95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[5000, 20000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=9, help="candidates per leg (3 x top_k in the pipeline)")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    client = chromadb.Client()
+    print(f"{'chunks':>8}  {'leg':<10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+
+    for size in args.chunks:
+        texts = [synthetic_chunk(rng) for _ in range(size)]
+        ids = [f"chunk-{i}" for i in range(size)]
+
+        index = LexicalIndex()
+        start = time.perf_counter()
+        index.add((chunk_id, text, {}) for chunk_id, text in zip(ids, texts))
+        build = time.perf_counter() - start
+
+        name = f"bench_lexical_{size}"
+        collection = client.get_or_create_collection(name, metadata={"hnsw:space": "cosine"})
+        vectors = np.random.default_rng(0).standard_normal((size, DIMENSION)).astype(np.float32)
+        for offset in range(0, size, 5000):
+            collection.add(ids=ids[offset:offset + 5000], embeddings=vectors[offset:offset + 5000],
+                           documents=texts[offset:offset + 5000])
+
+        queries = [synthetic_query(rng) for _ in range(args.queries)]
+        query_vectors = np.random.default_rng(1).standard_normal((args.queries, DIMENSION)).astype(np.float32)
+        dense_times, lexical_times, fusion_times = [], [], []
+        for query, vector in zip(queries, query_vectors):
+            start = time.perf_counter()
+            dense = collection.query(query_embeddings=[vector], n_results=args.top_k)["ids"][0]
+            dense_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            lexical = [chunk_id for chunk_id, _ in index.search(query, args.top_k)]
+            lexical_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            reciprocal_rank_fusion([dense, lexical])
+            fusion_times.append(time.perf_counter() - start)
+
+        for label, samples in (("dense", dense_times), ("lexical", lexical_times), ("fusion", fusion_times)):
+            mean, p50, p95 = percentiles(samples)
+            print(f"{size:>8}  {label:<10}{mean:>10.3f}{p50:>10.3f}{p95:>10.3f}")
+        stats = index.stats()
+        print(f"{'':>8}  built in {build:.2f}s, {stats['terms']} terms, "
+              f"{stats['postings_bytes'] / 1e6:.1f} MB of postings, "
+              f"lexical adds {statistics.mean(lexical_times) / statistics.mean(dense_times) * 100:.0f}% "
+              f"to the dense search\n")
+        client.delete_collection(name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+PDF extraction throughput benchmark
+===================================
+
+Compares pages/sec of the old serial extractor (every page in one process, `text +=`,
+table search on every page) against the page sharded extractor in research/extraction.py
+at several process counts.
+
+Usage:
+    python benchmarks/bench_pdf_extraction.py --pdf filing.pdf
+    python benchmarks/bench_pdf_extraction.py --pdf filing.pdf --repeat 10      # 10 copies of the pages
+    python benchmarks/bench_pdf_extraction.py --pdf filing.pdf --processes 1 2 4 8
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# make the django project importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "market_research.settings")
+
+import django
+
+django.setup()
+
+import pdfplumber
+from django.test import override_settings
+
+from research.extraction import extract_pdf_pages
+
+
+def serial_extract(path: str) -> str:
+    # the original extract_text() implementation
+    text = ""
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages:
+            text += page.extract_text() or ""
+            text += "\n"
+            for table in page.extract_tables():
+                for row in table:
+                    text += " | ".join([str(cell) for cell in row if cell]) + "\n"
+    return text
+
+
+def enlarged_copy(path: str, repeat: int) -> str:
+    # a bigger sample made of the same pages over and over, so small filings give stable numbers
+    from PyPDF2 import PdfReader, PdfWriter
+    reader = PdfReader(path)
+    writer = PdfWriter()
+    for _ in range(repeat):
+        for page in reader.pages:
+            writer.add_page(page)
+    handle, copy_path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(handle, "wb") as f:
+        writer.write(f)
+    return copy_path
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", required=True, help="PDF to extract")
+    parser.add_argument("--repeat", type=int, default=1, help="concatenate the PDF with itself N times")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--min-pages-per-shard", type=int, default=16)
+    args = parser.parse_args()
+
+    path = enlarged_copy(args.pdf, args.repeat) if args.repeat > 1 else args.pdf
+    try:
+        with pdfplumber.open(path) as pdf:
+            pages = len(pdf.pages)
+        print(f"{pages} pages, {os.cpu_count()} cpus\n")
+        print(f"{'method':<34}{'seconds':>10}{'pages/sec':>12}{'speedup':>10}")
+
+        baseline, expected = timed(lambda: serial_extract(path))
+        print(f"{'serial (original)':<34}{baseline:>10.3f}{pages / baseline:>12.1f}{1.0:>10.2f}")
+
+        with override_settings(PDF_MIN_PAGES_PER_SHARD=args.min_pages_per_shard):
+            for skip_tables in (False, True):
+                for processes in sorted(set(args.processes)):
+                    # the first call starts the worker processes, warm them up so startup is not timed
+                    extract_pdf_pages(path, processes=processes, skip_tables_without_lines=skip_tables)
+                    seconds, result = timed(lambda: extract_pdf_pages(
+                        path, processes=processes, skip_tables_without_lines=skip_tables))
+                    label = f"sharded p={processes}{' skip-tables' if skip_tables else ''}"
+                    same = "" if skip_tables or "".join(result) == expected else "  (output differs!)"
+                    print(f"{label:<34}{seconds:>10.3f}{pages / seconds:>12.1f}{baseline / seconds:>10.2f}{same}")
+    finally:
+        if path != args.pdf:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Vector backend latency benchmark: chroma hnsw vs the exact numpy index
+======================================================================
+
+Builds collections of random 384-d vectors (the MiniLM size) with filing-like metadata at
+several sizes and searches each one through both VectorStore implementations
+(research/vector_store.py ChromaVectorStore, research/exact_index.py ExactVectorStore):
+
+  chroma         in-memory chroma collection, hnsw with the default parameters
+  exact f32      one float32 matrix-vector product plus argpartition
+  exact f16      the same over a float16 matrix (half the memory)
+
+For each it reports the per-query p50 / p95 latency without and with a metadata filter, the
+memory the vectors take and chroma's recall@k against the exact result. The size where chroma
+becomes faster is where RAG_EXACT_MAX_CHUNKS should be set for RAG_VECTOR_BACKEND = "auto".
+
+No models are loaded.
+
+Usage:
+    python benchmarks/bench_vector_backends.py
+    python benchmarks/bench_vector_backends.py --chunks 1000 5000 20000 50000 --queries 300
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# make the django project importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "market_research.settings")
+
+import django
+
+django.setup()
+
+import chromadb
+import numpy as np
+
+from research.exact_index import ExactVectorStore
+from research.filters import build_where
+from research.vector_store import ChromaVectorStore
+
+DIMENSION = 384
+COMPANIES = ["Apple", "Microsoft", "Nvidia", "Amazon", "Alphabet", "Meta", "Tesla", "JPMorgan", "Exxon", "UnitedHealth"]
+DOC_TYPES = ["10-K", "10-Q", "8-K"]
+# one company and a date range, roughly what the ask filters look like
+FILTERS = {"company": "Nvidia", "date_from": "2021-01-01"}
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+
+def synthetic_collection(size: int, rng):
+    vectors = rng.standard_normal((size, DIMENSION)).astype(np.float32)
+    metadatas = [{
+        "company": COMPANIES[i % len(COMPANIES)],
+        "doc_type": DOC_TYPES[i % len(DOC_TYPES)],
+        # spread over 2015-2025
+        "date_filed_ts": 1_420_070_400 + int(rng.integers(0, 11 * 365)) * 86400,
+        "chunk_index": i,
+    } for i in range(size)]
+    return [f"chunk-{i}" for i in range(size)], [f"chunk text {i}" for i in range(size)], vectors, metadatas
+
+
+def timed_searches(store, queries, top_k, where):
+    times, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found = store.search(query, top_k=top_k, where=where)
+        times.append(time.perf_counter() - start)
+        results.append([result["id"] for result in found])
+    return times, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 5000, 20000, 50000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=9, help="chunks per search (3 x top_k in hybrid mode)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    client = chromadb.Client()
+    where = build_where(FILTERS)
+    print(f"{os.cpu_count()} cpus, {args.queries} queries, top_k {args.top_k}, filter {FILTERS}\n")
+    print(f"{'chunks':>8}  {'backend':<11}{'build s':>9}{'MB':>8}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p50 filt':>10}{'p95 filt':>10}{'recall':>8}")
+
+    for size in args.chunks:
+        ids, documents, vectors, metadatas = synthetic_collection(size, rng)
+        queries = rng.standard_normal((args.queries, DIMENSION)).astype(np.float32)
+
+        # exact f32 first, its results are the reference chroma's recall is measured against
+        stores = []
+        name = f"bench_vector_backends_{size}"
+        for label, dtype in (("exact f32", "float32"), ("exact f16", "float16")):
+            start = time.perf_counter()
+            exact = ExactVectorStore(name, dtype=dtype)
+            exact.append(ids, documents, vectors, metadatas)
+            stores.append((label, exact, time.perf_counter() - start, exact.stats()["vector_bytes"]))
+
+        start = time.perf_counter()
+        chroma = ChromaVectorStore(client.get_or_create_collection(name, metadata={"hnsw:space": "cosine"}))
+        for offset in range(0, size, 5000):
+            chroma.add(ids=ids[offset:offset + 5000], documents=documents[offset:offset + 5000],
+                       embeddings=vectors[offset:offset + 5000], metadatas=metadatas[offset:offset + 5000])
+        # hnsw keeps every vector as float32 plus ~M * 2 neighbour ids per node, roughly
+        stores.append(("chroma", chroma, time.perf_counter() - start, size * (DIMENSION * 4 + 16 * 2 * 4)))
+
+        reference = None
+        for label, store, build, memory in stores:
+            # the first search of a store warms caches, it is not timed
+            store.search(queries[0], top_k=args.top_k)
+            times, results = timed_searches(store, queries, args.top_k, None)
+            filtered_times, _ = timed_searches(store, queries, args.top_k, where)
+            if label == "exact f32":
+                reference = results
+            recall = np.mean([len(set(found) & set(expected)) / len(expected)
+                              for found, expected in zip(results, reference)])
+            print(f"{size:>8}  {label:<11}{build:>9.2f}{memory / 1e6:>8.1f}{percentile(times, 0.5):>9.3f}"
+                  f"{percentile(times, 0.95):>9.3f}{percentile(filtered_times, 0.5):>10.3f}"
+                  f"{percentile(filtered_times, 0.95):>10.3f}{recall:>8.3f}")
+        print()
+        client.delete_collection(name)
+
+
+if __name__ == "__main__":
+    main()
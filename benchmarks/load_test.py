@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test for /rag/upload/ and /rag/ask/
+===================================================
+
+Boots the Django app in a subprocess (`manage.py runserver`) with its own sqlite database and chroma
+directory, seeds it with a few synthetic filings, then replays a fixed, seeded mix of uploads and
+questions at each concurrency level. For every level it reports
+
+  per endpoint   requests, errors, throughput and p50 / p95 / p99 latency
+                 (upload = the request, ingest = upload until its background job is done)
+  per stage      p50 / p95 / p99 wall time of every pipeline stage, from the /rag/metrics/
+                 histograms scraped before and after the level (bucket interpolated)
+
+By default the server runs the 'stub' inference backend (research/inference_backends.py): hashed word
+vectors and an answer copied from the context after RAG_STUB_GENERATION_MS, so the numbers measure our
+code and do not move with flan-t5. --real-models uses the configured models instead.
+The answer cache is off unless --answer-cache, otherwise repeated questions would measure the cache.
+
+Results are compared with a stored baseline (benchmarks/baselines/load_test_<stub|models>.json when
+it exists): a p95 more than --tolerance (and --min-delta-ms) slower or a throughput more than
+--tolerance lower is reported as a regression and the script exits with status 1. Endpoints and stages
+with fewer than 20 samples in a level are shown but not compared. Baselines are machine specific,
+record one with --save-baseline on the machine that runs the comparison.
+
+Usage:
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --concurrency 1 8 16 --requests 400 --mix ask=9 upload=1
+    python benchmarks/load_test.py --save-baseline
+    python benchmarks/load_test.py --real-models --output results.json
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, "benchmarks", "baselines")
+TENANT = {"X-Tenant-ID": "loadtest"}
+
+COMPANIES = ["Apple", "Microsoft", "Nvidia", "Amazon", "Alphabet", "Meta", "Tesla", "JPMorgan"]
+LINE_ITEMS = ["revenue", "operating income", "net income", "capital expenditures", "free cash flow",
+              "research and development expense", "gross margin", "share repurchases"]
+
+
+# SYNTHETIC WORKLOAD
+
+def synthetic_filing(rng: random.Random, number: int) -> str:
+    company = rng.choice(COMPANIES)
+    sentences = []
+    for i in range(rng.randint(30, 60)):
+        item, year = rng.choice(LINE_ITEMS), rng.randint(2015, 2024)
+        sentences.append(f"{company} segment {i} {item} was ${rng.randint(1, 999)}.{rng.randint(0, 9)} million "
+                         f"in fiscal {year}, compared with ${rng.randint(1, 999)} million a year earlier.")
+    return f"{company} annual report {number}\n\n" + " ".join(sentences)
+
+
+def synthetic_question(rng: random.Random) -> str:
+    return (f"What was {rng.choice(COMPANIES)} segment {rng.randint(0, 59)} {rng.choice(LINE_ITEMS)} "
+            f"in fiscal {rng.randint(2015, 2024)}?")
+
+
+def operations(mix, count: int, seed: int):
+    # the same seed always gives the same sequence of requests
+    rng = random.Random(seed)
+    kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+    return [(rng.choice(kinds), rng.randint(0, 2 ** 31)) for _ in range(count)]
+
+
+# SERVER
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def boot_server(workdir: str, port: int, args) -> subprocess.Popen:
+    env = dict(os.environ,
+               DJANGO_SETTINGS_MODULE="market_research.settings",
+               RAG_SQLITE_PATH=os.path.join(workdir, "load_test.sqlite3"),
+               CHROMA_PERSIST_DIR=os.path.join(workdir, "chroma"),
+               ANSWER_CACHE_ENABLED="1" if args.answer_cache else "0",
+               # every simulated user works in the one "loadtest" tenant named by the header
+               RAG_TENANT_HEADER_ENABLED="1",
+               PYTHONUNBUFFERED="1")
+    if not args.real_models:
+        env["RAG_INFERENCE_BACKEND"] = "stub"
+        env["RAG_STUB_GENERATION_MS"] = str(args.stub_generation_ms)
+    manage = os.path.join(ROOT, "manage.py")
+    subprocess.run([sys.executable, manage, "migrate", "--noinput"], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen([sys.executable, manage, "runserver", f"127.0.0.1:{port}", "--noreload"],
+                              cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + args.boot_timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}, see {log.name}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/rag/models/health/", timeout=2)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"server did not answer within {args.boot_timeout}s, see {log.name}")
+
+
+# CLIENT
+
+def upload(session: requests.Session, base: str, rng: random.Random, number: int, samples, poll_interval: float):
+    text = synthetic_filing(rng, number).encode("utf-8")
+    start = time.perf_counter()
+    response = session.post(f"{base}/rag/upload/", files={"file": (f"filing_{number}.txt", text)}, headers=TENANT)
+    samples.append(("upload", time.perf_counter() - start, response.status_code == 202))
+    if response.status_code != 202:
+        return
+    job_id = response.json()["job_id"]
+    # ingestion runs on the server's worker threads, wait for the job to finish
+    while True:
+        job = session.get(f"{base}/rag/jobs/{job_id}/", headers=TENANT).json()
+        if job["status"] in ("done", "failed", "cancelled"):
+            samples.append(("ingest", time.perf_counter() - start, job["status"] == "done"))
+            return
+        time.sleep(poll_interval)
+
+
+def ask(session: requests.Session, base: str, rng: random.Random, samples, mode: str):
+    body = {"query": synthetic_question(rng)}
+    if mode:
+        body["mode"] = mode
+    start = time.perf_counter()
+    response = session.post(f"{base}/rag/ask/", json=body, headers=TENANT)
+    ok = response.status_code == 200 and not response.json()["answer"].startswith("Error generating response")
+    samples.append(("ask", time.perf_counter() - start, ok))
+
+
+def run_level(base: str, concurrency: int, ops, args):
+    samples = []
+    pending = iter(ops)
+    pending_lock = threading.Lock()
+    counter = [args.seed_docs]
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with pending_lock:
+                op = next(pending, None)
+                counter[0] += 1
+                number = counter[0]
+            if op is None:
+                return
+            kind, seed = op
+            rng = random.Random(seed)
+            try:
+                if kind == "upload":
+                    upload(session, base, rng, number, samples, args.poll_interval)
+                else:
+                    ask(session, base, rng, samples, args.mode)
+            except requests.RequestException:
+                samples.append((kind, 0.0, False))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return samples, time.perf_counter() - start
+
+
+# STATISTICS
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def endpoint_stats(samples, seconds: float):
+    stats = {}
+    for kind in sorted({kind for kind, _, _ in samples}):
+        latencies = [latency for k, latency, ok in samples if k == kind and ok]
+        errors = sum(1 for k, _, ok in samples if k == kind and not ok)
+        stats[kind] = {
+            "requests": len(latencies) + errors,
+            "errors": errors,
+            "throughput_rps": round(len(latencies) / seconds, 2) if seconds else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        }
+    return stats
+
+
+BUCKET_RE = re.compile(r'^rag_stage_wall_seconds_bucket\{stage="([^"]+)",le="([^"]+)"\} (\d+)$')
+
+
+def scrape_stage_buckets(base: str):
+    """
+    {stage: [(upper bound, cumulative count), ...]} of the stage wall time histograms
+    """
+    buckets = {}
+    for line in requests.get(f"{base}/rag/metrics/").text.splitlines():
+        match = BUCKET_RE.match(line)
+        if match:
+            stage, bound, count = match.groups()
+            buckets.setdefault(stage, []).append((float(bound), int(count)))
+    return buckets
+
+
+def bucket_quantile(buckets, q: float) -> float:
+    """
+    quantile of a cumulative histogram, interpolated linearly inside the bucket like prometheus does
+    """
+    total = buckets[-1][1]
+    if not total:
+        return 0.0
+    target = q * total
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= target:
+            if bound == float("inf"):
+                return lower_bound
+            share = (target - lower_count) / (count - lower_count) if count > lower_count else 0.0
+            return lower_bound + (bound - lower_bound) * share
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def stage_stats(before, after):
+    stats = {}
+    for stage, buckets in sorted(after.items()):
+        previous = dict(before.get(stage, []))
+        # only what this level observed
+        delta = [(bound, count - previous.get(bound, 0)) for bound, count in buckets]
+        if not delta[-1][1]:
+            continue
+        stats[stage] = {
+            "count": delta[-1][1],
+            "p50_ms": round(bucket_quantile(delta, 0.50) * 1000, 1),
+            "p95_ms": round(bucket_quantile(delta, 0.95) * 1000, 1),
+            "p99_ms": round(bucket_quantile(delta, 0.99) * 1000, 1),
+        }
+    return stats
+
+
+# BASELINE
+
+# endpoints and stages seen fewer times than this in a level have too few samples for a stable p95
+MIN_SAMPLES = 20
+
+
+def compare(results, baseline, tolerance: float, min_delta_ms: float):
+    """
+    list of regressions: p95 slower than the baseline by more than tolerance and by more than min_delta_ms
+    (millisecond stages jitter by whole histogram buckets), or throughput lower by more than tolerance
+    """
+    regressions = []
+    for level, current in results["levels"].items():
+        previous = baseline.get("levels", {}).get(level)
+        if not previous:
+            continue
+        for group in ("endpoints", "stages"):
+            for name, now in current[group].items():
+                before = previous[group].get(name)
+                count = "requests" if group == "endpoints" else "count"
+                if not before or min(now[count], before[count]) < MIN_SAMPLES:
+                    continue
+                if before["p95_ms"] and now["p95_ms"] > before["p95_ms"] * (1 + tolerance) \
+                        and now["p95_ms"] - before["p95_ms"] > min_delta_ms:
+                    regressions.append(f"c={level} {name}: p95 {before['p95_ms']} -> {now['p95_ms']} ms")
+                if group == "endpoints" and now["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+                    regressions.append(f"c={level} {name}: throughput {before['throughput_rps']} -> "
+                                       f"{now['throughput_rps']} req/s")
+    return regressions
+
+
+def print_level(level: str, result, baseline):
+    previous = baseline.get("levels", {}).get(level, {}) if baseline else {}
+
+    def delta(group, name, key):
+        before = previous.get(group, {}).get(name, {}).get(key)
+        now = result[group][name][key]
+        return f"{(now - before) / before * 100:+.0f}%" if before else ""
+
+    print(f"\nconcurrency {level}  ({result['seconds']:.1f}s)")
+    print(f"  {'endpoint':<16}{'reqs':>6}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'vs baseline p95':>17}")
+    for name, stats in result["endpoints"].items():
+        print(f"  {name:<16}{stats['requests']:>6}{stats['errors']:>8}{stats['throughput_rps']:>9.2f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+              f"{delta('endpoints', name, 'p95_ms'):>17}")
+    print(f"  {'stage':<16}{'count':>6}{'':>8}{'':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in result["stages"].items():
+        print(f"  {name:<16}{stats['count']:>6}{'':>8}{'':>9}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{delta('stages', name, 'p95_ms'):>17}")
+
+
+def parse_mix(values):
+    mix = {}
+    for value in values:
+        kind, _, weight = value.partition("=")
+        if kind not in ("ask", "upload") or not weight.isdigit():
+            raise argparse.ArgumentTypeError(f"bad mix entry '{value}', expected ask=N or upload=N")
+        mix[kind] = int(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--mix", nargs="+", default=["ask=9", "upload=1"], help="relative weights, ask=N upload=N")
+    parser.add_argument("--mode", choices=["dense", "lexical", "hybrid"], help="retrieval mode of the questions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--seed-docs", type=int, default=5, help="filings uploaded before measuring")
+    parser.add_argument("--real-models", action="store_true", help="use the configured models instead of the stub")
+    parser.add_argument("--stub-generation-ms", type=int, default=50, help="time one stub generation batch takes")
+    parser.add_argument("--answer-cache", action="store_true", help="leave the answer cache on")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="seconds between ingestion job polls")
+    parser.add_argument("--boot-timeout", type=float, default=120)
+    parser.add_argument("--baseline", help="baseline JSON (default benchmarks/baselines/load_test_<stub|models>.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--min-delta-ms", type=float, default=25, help="smaller p95 slowdowns are noise")
+    parser.add_argument("--output", help="also write the results JSON here")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    baseline_path = args.baseline or os.path.join(
+        BASELINE_DIR, f"load_test_{'models' if args.real_models else 'stub'}.json")
+
+    workdir = tempfile.mkdtemp(prefix="rag_load_test_")
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    server = boot_server(workdir, port, args)
+    try:
+        print(f"server on {base}, {os.cpu_count()} cpus, {'real models' if args.real_models else 'stub models'}, "
+              f"mix {mix}, {args.requests} requests per level")
+        # the corpus every level asks about, also loads the models before anything is timed
+        seed_samples = []
+        session = requests.Session()
+        for number in range(args.seed_docs):
+            upload(session, base, random.Random(args.seed + number), number, seed_samples, args.poll_interval)
+        ask(session, base, random.Random(args.seed), seed_samples, args.mode)
+        if not all(ok for _, _, ok in seed_samples):
+            raise RuntimeError(f"seeding the corpus failed, see {os.path.join(workdir, 'server.log')}")
+
+        results = {
+            "config": {"requests": args.requests, "mix": mix, "mode": args.mode, "seed": args.seed,
+                       "real_models": args.real_models, "stub_generation_ms": args.stub_generation_ms,
+                       "answer_cache": args.answer_cache, "cpus": os.cpu_count()},
+            "levels": {},
+        }
+        for level, concurrency in enumerate(args.concurrency):
+            before = scrape_stage_buckets(base)
+            ops = operations(mix, args.requests, args.seed + level + 1)
+            samples, seconds = run_level(base, concurrency, ops, args)
+            results["levels"][str(concurrency)] = {
+                "seconds": round(seconds, 2),
+                "endpoints": endpoint_stats(samples, seconds),
+                "stages": stage_stats(before, scrape_stage_buckets(base)),
+            }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    baseline = None
+    if os.path.exists(baseline_path) and not args.save_baseline:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        recorded = baseline.get("config", {})
+        if any(recorded.get(key) != results["config"][key] for key in results["config"]):
+            print(f"\nbaseline {baseline_path} was recorded with another workload or machine "
+                  f"({recorded}), not comparing")
+            baseline = None
+
+    for level, result in results["levels"].items():
+        print_level(level, result, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"\nbaseline saved to {baseline_path}")
+        return 0
+    if baseline is None:
+        print("\nno baseline to compare with, record one with --save-baseline")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) against {baseline_path} (tolerance {args.tolerance:.0%}):")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"\nno regressions against {baseline_path} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -77,10 +80,11 @@ WSGI_APPLICATION = 'market_research.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# RAG_SQLITE_PATH points a throwaway server (benchmarks/load_test.py) at its own database
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('RAG_SQLITE_PATH') or BASE_DIR / 'db.sqlite3',
     }
 }
 
@@ -127,3 +131,212 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_ALL_ORIGINS = True
+
+# the frontend sends its session cookie along, the session is its tenant (research/tenancy.py)
+CORS_ALLOW_CREDENTIALS = True
+
+# deployments that turn RAG_TENANT_HEADER_ENABLED on name the tenant with this header
+CORS_ALLOW_HEADERS = (*default_headers, 'x-tenant-id')
+
+
+# RAG models
+# loaded lazily by research/model_registry.py the first time they are needed
+
+RAG_EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+RAG_GENERATION_MODEL = 'google/flan-t5-base'
+
+# how many chunks are encoded per forward pass when documents are indexed
+RAG_EMBEDDING_BATCH_SIZE = 64
+
+# how the models run on the cpu: 'torch' (fp32), 'int8' (dynamic quantization) or 'onnx' (onnxruntime,
+# needs optimum[onnxruntime]). RAG_EMBEDDING_BACKEND / RAG_GENERATION_BACKEND override it per model.
+# compare them with benchmarks/bench_backends.py before switching.
+# 'stub' loads no model at all (hashed word vectors, the first context sentence as answer after
+# RAG_STUB_GENERATION_MS), for load tests that must not depend on flan-t5
+RAG_INFERENCE_BACKEND = os.environ.get('RAG_INFERENCE_BACKEND', 'torch')
+
+RAG_EMBEDDING_BACKEND = os.environ.get('RAG_EMBEDDING_BACKEND') or None
+
+RAG_GENERATION_BACKEND = os.environ.get('RAG_GENERATION_BACKEND') or None
+
+RAG_STUB_GENERATION_MS = int(os.environ.get('RAG_STUB_GENERATION_MS', '50'))
+
+# onnx exports are written here once and loaded from here afterwards
+RAG_ONNX_CACHE_DIR = BASE_DIR / 'onnx_models'
+
+
+# Vector store
+# chromadb keeps the index on disk here so it survives restarts and is shared by every worker on this host.
+# set CHROMA_PERSIST_DIR to an empty string to use a throwaway in-memory store instead
+
+CHROMA_PERSIST_DIR = os.environ.get('CHROMA_PERSIST_DIR', str(BASE_DIR / 'chroma_db'))
+
+CHROMA_COLLECTION_NAME = 'financial_documents'
+
+# memory budget for loaded collection indexes, idle (least recently used) ones are unloaded past it
+CHROMA_MEMORY_LIMIT_BYTES = int(os.environ.get('CHROMA_MEMORY_LIMIT_BYTES', 1024 * 1024 * 1024))
+
+# hnsw parameters of chroma's approximate index (research/vector_store.py), these are chroma's defaults.
+# RAG_HNSW_COLLECTIONS overrides them per collection name, e.g. {'financial_documents': {'search_ef': 50}}.
+# M and construction_ef apply to collections created afterwards (run rebuild_index to recreate one),
+# search_ef also to existing ones after a restart.
+# `python manage.py tune_hnsw` sweeps them over a collection and recommends a configuration
+RAG_HNSW = {'M': 16, 'construction_ef': 100, 'search_ef': 100}
+
+RAG_HNSW_COLLECTIONS = {}
+
+# which index answers a search. chroma always stores the chunks, with 'auto' a collection of at most
+# RAG_EXACT_MAX_CHUNKS chunks is searched by an exact in-process numpy index that mirrors it
+# (research/exact_index.py), bigger ones by chroma's hnsw. 'exact' and 'chroma' force one of the two.
+# benchmarks/bench_vector_backends.py shows where the two cross over on this machine
+RAG_VECTOR_BACKEND = os.environ.get('RAG_VECTOR_BACKEND', 'auto')
+
+RAG_EXACT_MAX_CHUNKS = 20000
+
+# 'float16' halves the memory of the exact index, but every search converts the matrix back to float32,
+# which made searches ~10x slower in bench_vector_backends.py. only for collections that do not fit otherwise
+RAG_EXACT_DTYPE = 'float32'
+
+# keep the exact index matrices in memory mapped files in this directory instead of RAM (None = RAM)
+RAG_EXACT_MMAP_DIR = None
+
+# exact indexes kept in memory at once, one per collection, the least recently used is dropped
+RAG_EXACT_MAX_LOADED = 32
+
+
+# Tenants
+# every logged in user or session gets its own collection, "shared" puts everyone in
+# CHROMA_COLLECTION_NAME. a tenant collection holds at most RAG_TENANT_MAX_CHUNKS chunks
+# (~1.5KB of vector + graph each with MiniLM)
+
+RAG_TENANT_MODE = 'session'
+
+# off: callers are told apart by login or session only. the X-Tenant-ID header is trusted as sent, any client
+# can name any tenant with it (research/tenancy.py), so only turn this on behind an authenticating proxy
+# that sets the header itself
+RAG_TENANT_HEADER_ENABLED = os.environ.get('RAG_TENANT_HEADER_ENABLED', '0') == '1'
+
+RAG_TENANT_MAX_CHUNKS = 20000
+
+
+# Retrieval
+# dense (chroma cosine), lexical (bm25 over an in-process inverted index) or hybrid (both, rank fused).
+# the ask endpoints can override it per request with "mode".
+# the bm25 index is built from the Chunk rows, documents indexed before those rows existed are only
+# found by the dense leg until they are uploaded again
+
+RAG_RETRIEVAL_MODE = 'dense'
+
+RAG_BM25_K1 = 1.5
+
+RAG_BM25_B = 0.75
+
+# bm25 indexes kept in memory at once, one per collection, the least recently used is dropped
+RAG_LEXICAL_MAX_LOADED = 32
+
+
+# Reranking
+# with RAG_RERANK_ENABLED the search over-fetches RAG_RERANK_CANDIDATES chunks and a small cpu
+# cross-encoder keeps the best top_k of them. when scoring would take longer than RAG_RERANK_BUDGET_MS
+# (None = no limit) the retrieval order is used instead. scores are cached per (question, chunk)
+
+RAG_RERANK_ENABLED = False
+
+RAG_RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+
+RAG_RERANK_CANDIDATES = 20
+
+RAG_RERANK_BATCH_SIZE = 16
+
+RAG_RERANK_BUDGET_MS = 150
+
+RAG_RERANK_CACHE_ENTRIES = 20000
+
+
+# Prompt budget
+# the augmented prompt (rules, retrieved chunks and question) is packed into this many generator tokens.
+# flan-t5 reads 512, anything past that would be cut by the model after paying for the tokenization
+
+RAG_PROMPT_MAX_TOKENS = 512
+
+
+# Embedding cache
+# embeddings are remembered by (model name, text hash) in a bounded in-memory LRU.
+# set EMBEDDING_CACHE_DIR to also spill evicted entries to a memory mapped file on disk
+
+EMBEDDING_CACHE_MAX_ENTRIES = 50000
+
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR') or None
+
+
+# Answer cache
+# generated answers are reused for exact repeats and for questions whose embedding has at least
+# this cosine similarity with an already answered one. uploads and clear_docs invalidate it
+
+ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE_ENABLED', '1') == '1'
+
+ANSWER_CACHE_MAX_ENTRIES = 1000
+
+ANSWER_CACHE_SIMILARITY = 0.95
+
+
+# Inference executor
+# the async endpoints run pdf extraction, embedding and generation on this many worker threads.
+# at most RAG_EXECUTOR_MAX_QUEUE more tasks may wait, past that requests are rejected with 503
+
+RAG_EXECUTOR_WORKERS = 8
+
+RAG_EXECUTOR_MAX_QUEUE = 16
+
+# seconds each stage may take before the request gives up with 504
+RAG_STAGE_TIMEOUTS = {
+    'extract': 120,
+    'index': 120,
+    'retrieve': 30,
+    'generate': 60,
+}
+
+
+# Generation micro-batching
+# prompts arriving within RAG_BATCH_WINDOW_MS of each other are generated together as one batch
+# of up to RAG_BATCH_MAX_SIZE. the batch size and queue wait histograms are on /rag/models/health/
+# a batch can only be as big as the number of requests waiting at once, so keep
+# RAG_EXECUTOR_WORKERS (async endpoints) or the server's thread count at least this large
+
+RAG_BATCHING_ENABLED = True
+
+RAG_BATCH_MAX_SIZE = 8
+
+RAG_BATCH_WINDOW_MS = 10
+
+
+# Background ingestion
+# uploads are saved to INGEST_UPLOAD_DIR and queued in the IngestionJob table.
+# with INGEST_RUN_IN_PROCESS the web process runs INGEST_WORKERS worker threads itself,
+# otherwise run `python manage.py run_ingest_workers` next to it
+
+INGEST_UPLOAD_DIR = BASE_DIR / 'uploads'
+
+INGEST_RUN_IN_PROCESS = True
+
+INGEST_WORKERS = 2
+
+INGEST_POLL_INTERVAL = 1.0
+
+# a running job whose worker has not reported progress for this many seconds is requeued
+INGEST_STALE_AFTER = 300
+
+INGEST_MAX_ATTEMPTS = 3
+
+
+# PDF extraction
+# PDFs of at least 2 * PDF_MIN_PAGES_PER_SHARD pages are split by page across this many processes
+# (None = one per CPU). PDF_SKIP_TABLES_WITHOUT_LINES skips the table search on pages without
+# lines, rectangles or curves, faster but a table drawn without any ruling is missed
+
+PDF_EXTRACT_PROCESSES = None
+
+PDF_MIN_PAGES_PER_SHARD = 16
+
+PDF_SKIP_TABLES_WITHOUT_LINES = False
@@ -2,16 +2,75 @@ import axios from "axios";
 
 // this file sets base backend url 
 // creates reusable functions
+// the backend keeps each browser's documents apart by its session cookie, so every request sends it.
+// the X-Tenant-ID header (a random id per tab) is only used by backends that turn RAG_TENANT_HEADER_ENABLED on
+const tenantId = () => {
+  let id = sessionStorage.getItem("ragTenantId");
+  if (!id) {
+    id = crypto.randomUUID();
+    sessionStorage.setItem("ragTenantId", id);
+  }
+  return id;
+};
+
 const api = axios.create({
   baseURL: "http://127.0.0.1:8000",
+  withCredentials: true,
   headers: {
-    "Content-Type": "application/json"
+    "Content-Type": "application/json",
+    "X-Tenant-ID": tenantId()
   }
 });
 
 // this function asks question
-export const askRag = (query) => {
-  return api.post("/rag/ask/", { query });
+// filters is optional, e.g. { company: ["Apple", "Microsoft"], doc_type: "10-K", date_from: "2023-01-01" }
+export const askRag = (query, filters) => {
+  return api.post("/rag/ask/", { query, filters });
+};
+
+// this function asks a question and streams the answer back
+// the backend sends server-sent events: "sources" first, then a "token" per piece of text, then "done"
+// axios cannot read a response while it is still arriving, so this one uses fetch
+export const askRagStream = async (query, { onSources, onToken, onDone, filters } = {}) => {
+  const res = await fetch(`${api.defaults.baseURL}/rag/ask/stream/`, {
+    method: "POST",
+    credentials: "include",
+    headers: { "Content-Type": "application/json", "X-Tenant-ID": tenantId() },
+    body: JSON.stringify({ query, filters }),
+  });
+  if (!res.ok || !res.body) {
+    throw new Error(`Stream request failed with status ${res.status}`);
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    // events are separated by a blank line, keep any half received event in the buffer
+    const events = buffer.split("\n\n");
+    buffer = events.pop();
+
+    for (const raw of events) {
+      let name = "message";
+      let data = "";
+      for (const line of raw.split("\n")) {
+        if (line.startsWith("event: ")) name = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      }
+      if (!data) continue;
+      const payload = JSON.parse(data);
+
+      if (name === "sources") onSources?.(payload.sources);
+      else if (name === "token") onToken?.(payload.text);
+      else if (name === "done") onDone?.(payload.answer);
+      else if (name === "error") throw new Error(payload.error);
+    }
+  }
 };
 
 // this function uploads documents
@@ -23,6 +82,19 @@ export const uploadDocument = (formData) => {
   });
 };
 
+// uploads are processed in the background, this reports the job's status and progress
+export const getJobStatus = (jobId) => api.get(`/rag/jobs/${jobId}/`);
+
+// polls a job until it is done or failed, calls onProgress with every status report
+export const waitForJob = async (jobId, onProgress, intervalMs = 1000) => {
+  while (true) {
+    const res = await getJobStatus(jobId);
+    onProgress?.(res.data);
+    if (["done", "failed", "cancelled"].includes(res.data.status)) return res.data;
+    await new Promise((resolve) => setTimeout(resolve, intervalMs));
+  }
+};
+
 export const clearDocs = () => api.post("/rag/clear_docs/");
 
 export default api;
@@ -1,5 +1,5 @@
 import { useState, useRef, useEffect } from "react";
-import { askRag, uploadDocument, clearDocs } from "../../api/api";
+import { askRagStream, uploadDocument, waitForJob, clearDocs } from "../../api/api";
 import "./ChatInterface.css";
 
 function parseFinancialData(text) {
@@ -47,10 +47,26 @@ export default function ChatInterface() {
     setInput("");
     setLoading(true);
 
+    // the answer bubble is created on the first token and then grows as tokens arrive
+    const answerId = Date.now();
+    let started = false;
+    const setAnswer = (update) => {
+      if (!started) {
+        started = true;
+        setMessages((prev) => [...prev, { id: answerId, role: "assistant", content: "" }]);
+      }
+      setMessages((prev) =>
+        prev.map((msg) => (msg.id === answerId ? { ...msg, content: update(msg.content) } : msg))
+      );
+      setLoading(false);
+    };
+
     try {
-      const res = await askRag(trimmed);
-      const text = res.data.answer || "No response received.";
-      setMessages((prev) => [...prev, { role: "assistant", content: text }]);
+      await askRagStream(trimmed, {
+        onToken: (text) => setAnswer((content) => content + text),
+        // the final answer is cleaned up on the server, replace the streamed text with it
+        onDone: (answer) => setAnswer(() => answer || "No response received."),
+      });
     } catch {
       setMessages((prev) => [
         ...prev,
@@ -82,7 +98,11 @@ export default function ChatInterface() {
     formData.append("file", file);
 
     try {
-      await uploadDocument(formData);
+      const res = await uploadDocument(formData);
+      // the server queues the file, wait for the background job to finish indexing it
+      setUploadStatus("processing");
+      const job = await waitForJob(res.data.job_id);
+      if (job.status !== "done") throw new Error(job.error || "Processing failed");
       setUploadStatus("success");
       setDocumentName(file.name);
       setMessages((prev) => [
@@ -202,8 +222,13 @@ export default function ChatInterface() {
             </svg>
             <span>{file.name}</span>
             {uploadStatus === "uploading" && <span className="chip-status">Uploading...</span>}
+            {uploadStatus === "processing" && <span className="chip-status">Processing...</span>}
             {uploadStatus === "error" && <span className="chip-status chip-error">Failed</span>}
-            <button className="chip-upload-btn" onClick={handleUpload} disabled={uploadStatus === "uploading"}>
+            <button
+              className="chip-upload-btn"
+              onClick={handleUpload}
+              disabled={uploadStatus === "uploading" || uploadStatus === "processing"}
+            >
               Upload
             </button>
             <button
@@ -0,0 +1,133 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+from django.conf import settings
+
+# SEMANTIC ANSWER CACHE
+# generation is by far the slowest step of the pipeline, so answers are cached in front of it.
+#   exact repeats: hash of the normalized question -> answer
+#   near duplicates: cosine similarity between question embeddings above ANSWER_CACHE_SIMILARITY
+# every entry is keyed by the corpus version (research/vector_store.py), so uploading or clearing
+# documents makes all older answers unreachable, and invalidate() frees them.
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_SIMILARITY = 0.95
+
+
+def _query_hash(query: str) -> str:
+    normalized = " ".join(query.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class AnswerCache:
+    """
+    bounded cache of generated answers with an exact lookup and a similarity lookup
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, similarity_threshold: float = DEFAULT_SIMILARITY):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        # (scope, query hash) -> {"answer", "embedding"}, in least recently used order
+        self._entries: "OrderedDict[tuple, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def lookup(self, scope: tuple, query: str, query_embedding=None) -> Optional[str]:
+        """
+        scope is whatever the answer depends on besides the question (collection, corpus version, top_k)
+        """
+        key = (scope, _query_hash(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry["answer"]
+
+            if query_embedding is not None and self.similarity_threshold < 1.0:
+                candidates = [(k, e) for k, e in self._entries.items() if k[0] == scope and e["embedding"] is not None]
+                if candidates:
+                    # one matrix-vector product over this scope's cached questions
+                    matrix = np.stack([e["embedding"] for _, e in candidates])
+                    similarities = matrix @ _unit(query_embedding)
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        best_key, best_entry = candidates[best]
+                        self._entries.move_to_end(best_key)
+                        self.semantic_hits += 1
+                        return best_entry["answer"]
+
+            self.misses += 1
+            return None
+
+    def store(self, scope: tuple, query: str, answer: str, query_embedding=None):
+        key = (scope, _query_hash(query))
+        with self._lock:
+            self._entries[key] = {
+                "answer": answer,
+                "embedding": _unit(query_embedding) if query_embedding is not None else None,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection: str = None):
+        """
+        drop cached answers, called whenever documents are uploaded or cleared.
+        with a collection only that collection's answers go (scopes start with the collection name)
+        """
+        with self._lock:
+            if collection is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0][0] == collection]:
+                del self._entries[key]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "similarity_threshold": self.similarity_threshold,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """
+    process wide answer cache, None when ANSWER_CACHE_ENABLED is off
+    """
+    global _cache
+    if not getattr(settings, "ANSWER_CACHE_ENABLED", True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnswerCache(
+                    max_entries=getattr(settings, "ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+                    similarity_threshold=getattr(settings, "ANSWER_CACHE_SIMILARITY", DEFAULT_SIMILARITY),
+                )
+    return _cache
+
+
+def reset_answer_cache():
+    global _cache
+    with _cache_lock:
+        _cache = None
@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+
+from research.metrics import SIZE_BUCKETS, histogram
+
+# DYNAMIC MICRO-BATCHING
+# flan-t5 on CPU does far more work per second on a padded batch of prompts than on the same
+# prompts one at a time. concurrent questions hand their prompt to this scheduler instead of
+# calling the generator themselves. a single background thread waits up to RAG_BATCH_WINDOW_MS after
+# the first prompt for more to arrive (at most RAG_BATCH_MAX_SIZE), runs them as one batch and gives
+# every caller its own answer back. a lone request pays at most the window in extra latency.
+
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_WINDOW_MS = 10
+
+
+class _Request:
+    __slots__ = ("prompt", "future", "enqueued_at")
+
+    def __init__(self, prompt: str):
+        self.prompt = prompt
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class GenerationBatcher:
+    """
+    collects prompts that arrive within a short window and generates them as one batch
+    """
+
+    def __init__(self, generate_batch: Callable[[List[str]], List[str]],
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, window_ms: float = DEFAULT_WINDOW_MS,
+                 name: str = "generation"):
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        # how many prompts went into each batch, and how long each prompt waited before its batch ran
+        self.batch_sizes = histogram(f"rag_{name}_batch_size", SIZE_BUCKETS, "Prompts per generation batch")
+        self.queue_wait = histogram(f"rag_{name}_queue_wait_seconds", help_text="Time a prompt waited for its batch")
+
+    def _ensure_started(self):
+        # the worker thread starts on the first prompt, not at import time
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="rag-generation-batcher", daemon=True)
+                    self._thread.start()
+
+    def submit(self, prompt: str) -> Future:
+        self._ensure_started()
+        request = _Request(prompt)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, prompt: str, timeout: Optional[float] = None) -> str:
+        """
+        blocking helper, waits at most timeout seconds for this prompt's answer
+        """
+        future = self.submit(prompt)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            # a prompt still waiting in the queue is dropped, one already in a batch just finishes unread
+            future.cancel()
+            raise
+
+    def _collect(self) -> List[_Request]:
+        # block until there is at least one prompt, then wait out the window for more
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued_at + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                # whatever is already queued joins even if the window has passed
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # prompts whose caller gave up before their batch started are skipped
+            batch = [request for request in self._collect() if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            self.batch_sizes.observe(len(batch))
+            for request in batch:
+                self.queue_wait.observe(started - request.enqueued_at)
+
+            try:
+                outputs = self.generate_batch([request.prompt for request in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            outputs = list(outputs)
+            for request, output in zip(batch, outputs):
+                request.future.set_result(output)
+            # a backend that answered fewer prompts than it was given must not leave callers waiting
+            for request in batch[len(outputs):]:
+                request.future.set_exception(
+                    RuntimeError(f"Generation returned {len(outputs)} outputs for a batch of {len(batch)} prompts"))
+
+    def stats(self) -> Dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "window_ms": self.window * 1000.0,
+            "queued": self._queue.qsize(),
+            "batch_size": self.batch_sizes.snapshot(),
+            "queue_wait_seconds": self.queue_wait.snapshot(),
+        }
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_generation_batcher(generate_batch: Callable[[List[str]], List[str]]) -> GenerationBatcher:
+    """
+    process wide batcher built from RAG_BATCH_MAX_SIZE / RAG_BATCH_WINDOW_MS
+    """
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = GenerationBatcher(
+                    generate_batch,
+                    max_batch_size=getattr(settings, "RAG_BATCH_MAX_SIZE", DEFAULT_MAX_BATCH_SIZE),
+                    window_ms=getattr(settings, "RAG_BATCH_WINDOW_MS", DEFAULT_WINDOW_MS),
+                )
+    return _batcher
+
+
+def current_batcher() -> Optional[GenerationBatcher]:
+    """
+    the batcher if one has been started in this process, for stats
+    """
+    return _batcher
@@ -0,0 +1,186 @@
+from typing import Dict, List
+
+from django.conf import settings
+
+from research.model_registry import get_tokenizer
+
+# TOKEN BUDGETED CONTEXT PACKING
+# flan-t5 reads at most 512 input tokens and silently cuts the rest, so a prompt with too many
+# chunks costs encoder time for text the model never sees, and the cut usually lands in the
+# middle of the question. the packer measures the context in real generator tokens instead:
+#   1. neighbouring chunks of the same document (chunk_index n and n+1) share ~50 characters of
+#      overlap (chunk_documents), they are merged into one block with the overlap written once
+#   2. blocks are taken best first until the budget is used up, a block that does not fit
+#      completely is cut at the last token that still fits (when enough room is left to be useful)
+#   3. the tokens that did not fit are counted, so we can see how much context the budget costs us
+
+DEFAULT_PROMPT_MAX_TOKENS = 512
+# a trimmed block shorter than this is just noise, the rest of the budget stays empty instead
+MIN_TRIMMED_TOKENS = 24
+# how far back the end of one chunk is searched for the start of the next, a few times the chunk overlap
+MAX_OVERLAP_CHARS = 200
+# the shortest shared text taken for an overlap rather than a coincidence
+MIN_OVERLAP_CHARS = 5
+
+
+def prompt_max_tokens() -> int:
+    return getattr(settings, "RAG_PROMPT_MAX_TOKENS", DEFAULT_PROMPT_MAX_TOKENS)
+
+
+class WordTokenizer:
+    """
+    whitespace tokenizer used when the generator's tokenizer cannot be loaded (no transformers, offline).
+    it undercounts subword tokens, but generation fails in that case anyway
+    """
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[str]:
+        return text.split()
+
+    def decode(self, tokens: List[str], skip_special_tokens: bool = True) -> str:
+        return " ".join(tokens)
+
+
+# set the first time the generator's tokenizer fails to load, later calls do not try again
+# (every attempt goes back to the hugging face hub or the disk, once per counted chunk)
+_fallback_tokenizer = None
+
+
+def _tokenizer():
+    global _fallback_tokenizer
+    if _fallback_tokenizer is not None:
+        return _fallback_tokenizer
+    try:
+        return get_tokenizer()
+    except Exception as e:
+        print(f"Generator tokenizer unavailable ({e}), counting prompt tokens as words")
+        _fallback_tokenizer = WordTokenizer()
+        return _fallback_tokenizer
+
+
+def reset_tokenizer_fallback():
+    """
+    try loading the generator's tokenizer again on the next count (tests, after installing transformers)
+    """
+    global _fallback_tokenizer
+    _fallback_tokenizer = None
+
+
+def count_tokens(text: str, tokenizer=None) -> int:
+    """
+    number of generator tokens in text, special tokens (the closing </s>) not included
+    """
+    tokenizer = tokenizer or _tokenizer()
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def join_overlapping(first: str, second: str) -> str:
+    """
+    first followed by second, with the text they share (end of first == start of second) written once
+    """
+    longest = min(len(first), len(second), MAX_OVERLAP_CHARS)
+    for size in range(longest, MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return f"{first} {second}"
+
+
+def merge_neighbours(results: List[Dict]) -> List[Dict]:
+    """
+    group best-first search results into blocks, neighbouring chunks of one document become a single block.
+    a block keeps the rank of its best chunk: {"content", "metadata", "results", "first", "last"}
+    """
+    blocks: List[Dict] = []
+    for result in results:
+        content = result["content"].strip()
+        metadata = result["metadata"]
+        document_id = metadata.get("document_id")
+        chunk_index = metadata.get("chunk_index")
+
+        block = None
+        if document_id is not None and chunk_index is not None:
+            for candidate in blocks:
+                if candidate["metadata"].get("document_id") != document_id or candidate["last"] is None:
+                    continue
+                if chunk_index == candidate["last"] + 1:
+                    candidate["content"] = join_overlapping(candidate["content"], content)
+                    candidate["last"] = chunk_index
+                elif chunk_index == candidate["first"] - 1:
+                    candidate["content"] = join_overlapping(content, candidate["content"])
+                    candidate["first"] = chunk_index
+                else:
+                    continue
+                candidate["results"].append(result)
+                block = candidate
+                break
+        if block is None:
+            blocks.append({"content": content, "metadata": metadata, "results": [result],
+                           "first": chunk_index, "last": chunk_index})
+            continue
+
+        # the chunk may have closed the gap to another block of the same document (3 and 5, then 4)
+        for other in blocks:
+            if other is block or other["metadata"].get("document_id") != document_id or other["last"] is None:
+                continue
+            if other["first"] == block["last"] + 1:
+                block["content"] = join_overlapping(block["content"], other["content"])
+                block["last"] = other["last"]
+            elif other["last"] == block["first"] - 1:
+                block["content"] = join_overlapping(other["content"], block["content"])
+                block["first"] = other["first"]
+            else:
+                continue
+            block["results"].extend(other["results"])
+            blocks.remove(other)
+            break
+    return blocks
+
+
+def pack_context(results: List[Dict], budget: int, format_block) -> Dict:
+    """
+    pack best-first search results into at most budget tokens.
+    format_block(number, block) turns a block into its prompt text (source header included).
+    returns {"blocks": [prompt text, ...], "sources": results that made it in, "context_tokens",
+    "dropped_tokens", "dropped_chunks", "merged_chunks"}
+    """
+    tokenizer = _tokenizer()
+    blocks = merge_neighbours(results)
+    # the same text retrieved twice (the same filing uploaded to two documents) is only sent once
+    seen_contents = set()
+
+    packed, sources = [], []
+    used = dropped = dropped_chunks = 0
+    for block in blocks:
+        if block["content"] in seen_contents:
+            continue
+        seen_contents.add(block["content"])
+
+        text = format_block(len(packed) + 1, block)
+        tokens = tokenizer.encode(text, add_special_tokens=False)
+        # every block after the first is separated from the previous one by a blank line, about one token
+        separator = 1 if packed else 0
+        if used + separator + len(tokens) <= budget:
+            packed.append(text)
+            sources.extend(block["results"])
+            used += separator + len(tokens)
+            continue
+
+        # one token is kept for the " ..." that marks the cut
+        room = budget - used - separator - 1
+        if room >= MIN_TRIMMED_TOKENS:
+            # keep the start of the block (the header and the first sentences), cut at the budget
+            packed.append(tokenizer.decode(tokens[:room], skip_special_tokens=True) + " ...")
+            sources.extend(block["results"])
+            used += separator + room + 1
+            dropped += len(tokens) - room
+        else:
+            dropped += len(tokens)
+            dropped_chunks += len(block["results"])
+
+    return {
+        "blocks": packed,
+        "sources": sources,
+        "context_tokens": used,
+        "dropped_tokens": dropped,
+        "dropped_chunks": dropped_chunks,
+        "merged_chunks": len(results) - len(blocks),
+    }
@@ -0,0 +1,270 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # windows, the disk tier then assumes a single process
+    fcntl = None
+
+# EMBEDDING CACHE
+# the same chunk text and the same questions get embedded again and again (repeat questions,
+# re-uploads, clear_docs then upload). this cache remembers embeddings by (model name, text hash).
+#   tier 1: bounded in-memory LRU
+#   tier 2 (optional): append-only float32 file on disk, read through np.memmap. entries evicted
+#           from memory spill here, so a restart or another worker can still find them.
+
+DEFAULT_MAX_ENTRIES = 50000
+
+
+def normalize_text(text: str) -> str:
+    # whitespace differences should not produce a different embedding key
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class DiskEmbeddingStore:
+    """
+    append-only on-disk tier.
+    vectors.f32 holds one row per entry, keys.txt holds "key row" lines that point into it.
+    rows are read through a memory map so only the rows we touch are paged in.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = str(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.keys_path = os.path.join(self.directory, "keys.txt")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self.lock_path = os.path.join(self.directory, ".lock")
+        self.dimension = None
+        self.rows: Dict[str, int] = {}
+        self._keys_offset = 0
+        # (size, mtime) of keys.txt when we last read it, a miss only rereads it when this changed
+        self._keys_stat = None
+        self._memmap = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dimension = json.load(f)["dimension"]
+        self._refresh()
+
+    def _file_lock(self):
+        # other worker processes may append at the same time, flock keeps rows and keys in step
+        handle = open(self.lock_path, "a")
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def _refresh(self):
+        """
+        pick up keys appended since we last looked (possibly by another process)
+        """
+        try:
+            stat = os.stat(self.keys_path)
+        except FileNotFoundError:
+            return
+        if (stat.st_size, stat.st_mtime_ns) == self._keys_stat:
+            return
+        self._keys_stat = (stat.st_size, stat.st_mtime_ns)
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # a half written line, read it next time
+                    self._keys_stat = None
+                    break
+                self._keys_offset += len(line)
+                parts = line.split()
+                # every key carries its own row, so a line lost in a crash cannot shift the others.
+                # lines without one (written before rows were recorded) are skipped and embedded again
+                if len(parts) == 2 and parts[1].isdigit():
+                    self.rows.setdefault(parts[0].decode("ascii"), int(parts[1]))
+
+    def _vectors(self, row: int):
+        # the vectors file grows as rows are appended, map it again when the row is past the end
+        if self._memmap is None or row >= self._memmap.shape[0]:
+            if not self.dimension or not os.path.exists(self.vectors_path):
+                return None
+            # whole rows only, a crashed writer may have left part of one at the end
+            count = os.path.getsize(self.vectors_path) // (self.dimension * 4)
+            if count == 0:
+                return None
+            self._memmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(count, self.dimension))
+        return self._memmap
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        row = self.rows.get(key)
+        if row is None:
+            # a stat call, the keys file is only read again when another writer changed it
+            self._refresh()
+            row = self.rows.get(key)
+            if row is None:
+                return None
+        vectors = self._vectors(row)
+        if vectors is None or row >= vectors.shape[0]:
+            return None
+        return np.array(vectors[row], dtype=np.float32)
+
+    def put_many(self, items: List):
+        if not items:
+            return
+        handle = self._file_lock()
+        try:
+            self._refresh()
+            items = [(key, vector) for key, vector in items if key not in self.rows]
+            if not items:
+                return
+            if self.dimension is None:
+                self.dimension = int(items[0][1].shape[0])
+                with open(self.meta_path, "w") as f:
+                    json.dump({"dimension": self.dimension}, f)
+            row_bytes = self.dimension * 4
+            with open(self.vectors_path, "ab") as f:
+                size = f.tell()
+                if size % row_bytes:
+                    # a crash left half a row behind, drop it so the new rows start on a row boundary
+                    size -= size % row_bytes
+                    f.truncate(size)
+                first_row = size // row_bytes
+                f.write(np.stack([vector for _, vector in items]).astype(np.float32).tobytes())
+            # vectors first, then keys: a reader never sees a key whose row is not written yet.
+            # rows written without their keys (a crash in between) are never pointed at
+            with open(self.keys_path, "a") as f:
+                f.write("".join(f"{key} {first_row + i}\n" for i, (key, _) in enumerate(items)))
+            self._refresh()
+        finally:
+            handle.close()
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class EmbeddingCache:
+    """
+    bounded LRU of embeddings with an optional memory mapped disk tier behind it.
+    counts hits (memory and disk), misses and evictions.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, disk_dir: Optional[str] = None):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.disk = DiskEmbeddingStore(disk_dir) if disk_dir else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                # most recently used goes to the end
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+            if self.disk is not None:
+                vector = self.disk.get(key)
+                if vector is not None:
+                    self.disk_hits += 1
+                    # it is already on disk, nothing evicted here needs a second copy of it
+                    self._spill(self._insert(key, vector))
+                    return vector
+            self.misses += 1
+            return None
+
+    def put(self, key: str, vector: np.ndarray):
+        self.put_many([(key, vector)])
+
+    def put_many(self, items: List):
+        with self._lock:
+            spilled = []
+            for key, vector in items:
+                spilled.extend(self._insert(key, np.asarray(vector, dtype=np.float32)))
+            # one disk write for the whole batch instead of one per evicted entry
+            self._spill(spilled)
+
+    def _insert(self, key: str, vector: np.ndarray) -> List:
+        """
+        add to the LRU and return the entries pushed out of it (caller holds the lock)
+        """
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False))
+            self.evictions += 1
+        return evicted
+
+    def _spill(self, evicted: List):
+        if evicted and self.disk is not None:
+            self.disk.put_many(evicted)
+
+    def flush(self):
+        """
+        write everything still in memory to the disk tier (used on shutdown)
+        """
+        if self.disk is None:
+            return
+        with self._lock:
+            self.disk.put_many(list(self._entries.items()))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk_entries": len(self.disk) if self.disk is not None else None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    process wide cache built from EMBEDDING_CACHE_MAX_ENTRIES / EMBEDDING_CACHE_DIR
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(
+                    max_entries=getattr(settings, "EMBEDDING_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+                    disk_dir=getattr(settings, "EMBEDDING_CACHE_DIR", None),
+                )
+                if _cache.disk is not None:
+                    # whatever is still only in memory is written to disk when the process exits
+                    atexit.register(_cache.flush)
+    return _cache
+
+
+def reset_embedding_cache():
+    """
+    drop the process wide cache, the next call builds a new one from settings
+    """
+    global _cache
+    with _cache_lock:
+        _cache = None
@@ -0,0 +1,88 @@
+from typing import List, Optional
+
+import numpy as np
+from django.conf import settings
+
+from research.embedding_cache import cache_key, get_embedding_cache
+from research.inference_backends import embedding_backend, embedding_cache_name
+from research.model_registry import embedding_model_name, get_embedding_model
+
+# BATCHED EMBEDDING STAGE
+# encoding one chunk at a time means one forward pass and one tokenizer call per chunk.
+# here chunks are sorted by length and encoded in batches, so every batch holds texts of similar
+# length and the model pads as little as possible. results stay float32 numpy arrays the whole way.
+# every text goes through the embedding cache first, only cache misses reach the model.
+
+DEFAULT_BATCH_SIZE = 64
+
+
+def embedding_batch_size() -> int:
+    return getattr(settings, "RAG_EMBEDDING_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+
+
+def _encode_batches(texts: List[str], batch_size: int) -> np.ndarray:
+    """
+    encode texts in length sorted batches, returns float32 vectors in the original order
+    """
+    model = get_embedding_model()
+
+    # sort by length so each batch pads to roughly the same size
+    order = np.argsort([len(text) for text in texts], kind="stable")
+
+    embeddings = None
+    for start in range(0, len(order), batch_size):
+        batch_indices = order[start:start + batch_size]
+        batch = model.encode(
+            [texts[i] for i in batch_indices],
+            batch_size=len(batch_indices),
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        batch = np.asarray(batch, dtype=np.float32)
+        # allocate the output once we know the embedding dimension
+        if embeddings is None:
+            embeddings = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+        # put every vector back at the position of its original text
+        embeddings[batch_indices] = batch
+
+    return embeddings
+
+
+def embed_texts(texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+    """
+    embed a list of texts in length sorted batches.
+    texts already in the embedding cache are not encoded again.
+    returns a float32 array of shape (len(texts), dimension) in the same order as texts.
+    """
+    batch_size = batch_size or embedding_batch_size()
+
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    cache = get_embedding_cache()
+    # vectors of the int8 and onnx backends differ a little from fp32, they are cached apart
+    model_name = embedding_cache_name(embedding_model_name(), embedding_backend())
+    keys = [cache_key(model_name, text) for text in texts]
+    cached = [cache.get(key) for key in keys]
+
+    # encode each distinct missing text once, even if it appears several times in this call
+    missing = {}
+    for i, vector in enumerate(cached):
+        if vector is None:
+            missing.setdefault(keys[i], i)
+
+    if missing:
+        missing_positions = list(missing.values())
+        encoded = _encode_batches([texts[i] for i in missing_positions], batch_size)
+        cache.put_many(zip(missing.keys(), encoded))
+        encoded_by_key = dict(zip(missing.keys(), encoded))
+        cached = [vector if vector is not None else encoded_by_key[key] for key, vector in zip(keys, cached)]
+
+    return np.stack(cached).astype(np.float32, copy=False)
+
+
+def embed_query(query: str) -> np.ndarray:
+    """
+    embed a single question, repeated questions come straight from the cache
+    """
+    return embed_texts([query])[0]
@@ -0,0 +1,318 @@
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+from django.conf import settings
+
+from research.lexical_index import FILTER_KEYS, matches
+from research.vector_store import VectorStore, chroma_store, corpus_version
+
+# EXACT IN-PROCESS VECTOR INDEX
+# for a collection of a few thousand chunks a chroma query (client call, hnsw walk, metadata
+# decoding) costs more than the math. this index keeps the collection's vectors, normalized, in
+# one contiguous matrix and answers a search with one matrix-vector product plus argpartition:
+#   vectors    (n, dimension) float32, or float16 with RAG_EXACT_DTYPE (half the memory, but converted
+#              back to float32 block by block on every search, which is slow), in RAM or in a memory
+#              mapped file under RAG_EXACT_MMAP_DIR
+#   columns    the metadata filters use (company, doc_type, date_filed_ts) as numpy arrays, so a
+#              where clause becomes a boolean mask instead of a loop over dicts
+# the result is exact, no recall is lost to the hnsw approximation.
+# chroma stays the store of record: writes go to chroma first and are then appended here, and an
+# index catches up with chunks other workers stored whenever the collection's corpus version changes.
+
+DEFAULT_DTYPE = "float32"
+DEFAULT_MAX_LOADED = 32
+# rows scored per step when the matrix is float16, keeps the float32 copy small
+SCORE_BLOCK_ROWS = 8192
+INITIAL_CAPACITY = 1024
+NUMERIC_KEYS = ("date_filed_ts",)
+
+
+class ExactVectorStore(VectorStore):
+    """
+    brute force cosine search over a collection mirrored from chroma
+    """
+
+    backend = "exact"
+
+    def __init__(self, name: str, dtype: str = DEFAULT_DTYPE, mmap_dir: Optional[str] = None, source=None):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.mmap_dir = mmap_dir
+        # where writes go, refreshed on every sync (a cleared collection is a new chroma collection)
+        self.source = source
+        # add() and search() take this, never both at once
+        self._lock = threading.Lock()
+        # one catch up with chroma at a time
+        self.sync_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._vectors = None
+            self._count = 0
+            self._ids: List[str] = []
+            self._rows: Dict[str, int] = {}
+            self._documents: List[str] = []
+            self._metadatas: List[Dict] = []
+            # categorical columns: int32 codes (-1 = missing) and value -> code, numeric columns: float64 (nan = missing)
+            self._codes: Dict[str, np.ndarray] = {}
+            self._vocab: Dict[str, Dict] = {key: {} for key in FILTER_KEYS if key not in NUMERIC_KEYS}
+            self._values: Dict[str, np.ndarray] = {}
+            # bookkeeping for catching up with chroma
+            self.version = None
+            self.oversized = False
+
+    def __len__(self):
+        return self._count
+
+    def count(self) -> int:
+        return self._count
+
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        return {chunk_id for chunk_id in ids if chunk_id in self._rows}
+
+    def _allocate(self, capacity: int, dimension: int) -> np.ndarray:
+        if not self.mmap_dir:
+            return np.empty((capacity, dimension), dtype=self.dtype)
+        # an unnamed file (deleted as soon as it is created), the os pages the matrix in and out
+        # and frees the file once the last mapping of it is gone
+        with tempfile.TemporaryFile(dir=self.mmap_dir, prefix=f"{self.name}-") as file:
+            return np.memmap(file, dtype=self.dtype, mode="w+", shape=(capacity, dimension))
+
+    def _grow(self, needed: int, dimension: int):
+        # doubling keeps appends amortized O(1), rows [0, count) stay one contiguous block
+        if self._vectors is not None and needed <= len(self._vectors):
+            return
+        capacity = max(INITIAL_CAPACITY, needed, 2 * (len(self._vectors) if self._vectors is not None else 0))
+        vectors = self._allocate(capacity, dimension)
+        codes = {key: np.full(capacity, -1, dtype=np.int32) for key in self._vocab}
+        numbers = {key: np.full(capacity, np.nan, dtype=np.float64) for key in NUMERIC_KEYS}
+        if self._vectors is not None:
+            vectors[:self._count] = self._vectors[:self._count]
+            for key in codes:
+                codes[key][:self._count] = self._codes[key][:self._count]
+            for key in numbers:
+                numbers[key][:self._count] = self._values[key][:self._count]
+        self._vectors, self._codes, self._values = vectors, codes, numbers
+
+    def append(self, ids: List[str], documents: List[str], embeddings, metadatas: List[Dict]) -> int:
+        """
+        add chunks to this index only (they are already in chroma), ids already here are skipped.
+        returns how many were new
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            rows, seen = [], set()
+            for i, chunk_id in enumerate(ids):
+                # the same id twice in one call is added once
+                if chunk_id not in self._rows and chunk_id not in seen:
+                    seen.add(chunk_id)
+                    rows.append(i)
+            if not rows:
+                return 0
+            vectors = embeddings[rows]
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1.0, norms)
+            self._grow(self._count + len(rows), vectors.shape[1])
+
+            start = self._count
+            self._vectors[start:start + len(rows)] = vectors
+            for offset, i in enumerate(rows):
+                number = start + offset
+                metadata = dict(metadatas[i] or {})
+                self._rows[ids[i]] = number
+                self._ids.append(ids[i])
+                self._documents.append(documents[i])
+                self._metadatas.append(metadata)
+                for key, vocab in self._vocab.items():
+                    value = metadata.get(key)
+                    if value is not None:
+                        self._codes[key][number] = vocab.setdefault(value, len(vocab))
+                for key in NUMERIC_KEYS:
+                    value = metadata.get(key)
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        self._values[key][number] = value
+            self._count += len(rows)
+            return len(rows)
+
+    def add(self, ids: List[str], documents: List[str], embeddings, metadatas: List[Dict]):
+        # chroma first, a chunk is only searchable here once it is stored
+        self.source.add(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+        self.append(ids, documents, embeddings, metadatas)
+
+    def delete(self, ids: List[str]):
+        # rows cannot be taken out of the matrix, the next search reloads the index from chroma
+        self.source.delete(ids)
+        self.version = None
+
+    def _column_mask(self, key: str, condition, count: int) -> Optional[np.ndarray]:
+        # None when the condition cannot be answered from the columns (a range over strings)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        mask = np.ones(count, dtype=bool)
+        if key in NUMERIC_KEYS:
+            values = self._values[key][:count]
+            for operator, operand in condition.items():
+                if operator in ("$in", "$nin"):
+                    found = np.isin(values, [value for value in operand if isinstance(value, (int, float))])
+                    mask &= found if operator == "$in" else ~found
+                elif operator in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+                    if not isinstance(operand, (int, float)):
+                        return None
+                    # comparisons with nan are false, a chunk without the field matches only $ne
+                    mask &= {"$eq": np.equal, "$ne": np.not_equal, "$gt": np.greater, "$gte": np.greater_equal,
+                             "$lt": np.less, "$lte": np.less_equal}[operator](values, operand)
+                else:
+                    return None
+            return mask
+
+        codes = self._codes[key][:count]
+        vocab = self._vocab[key]
+        for operator, operand in condition.items():
+            if operator in ("$eq", "$ne"):
+                # a value no chunk has gets a code no row carries
+                found = codes == vocab.get(operand, -2)
+                mask &= found if operator == "$eq" else ~found
+            elif operator in ("$in", "$nin"):
+                found = np.isin(codes, [vocab[value] for value in operand if value in vocab])
+                mask &= found if operator == "$in" else ~found
+            else:
+                return None
+        return mask
+
+    def _mask(self, where: Dict, count: int) -> np.ndarray:
+        mask = np.ones(count, dtype=bool)
+        for key, condition in where.items():
+            if key == "$and":
+                for part in condition:
+                    mask &= self._mask(part, count)
+            elif key == "$or":
+                any_part = np.zeros(count, dtype=bool)
+                for part in condition:
+                    any_part |= self._mask(part, count)
+                mask &= any_part
+            else:
+                column = self._column_mask(key, condition, count) if key in FILTER_KEYS else None
+                if column is None:
+                    # not a column, fall back to the metadata dicts
+                    column = np.fromiter((matches(metadata, {key: condition}) for metadata in self._metadatas[:count]),
+                                         dtype=bool, count=count)
+                mask &= column
+        return mask
+
+    def _scores(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        vectors = self._vectors[:self._count] if rows is None else self._vectors[rows]
+        if vectors.dtype == np.float32:
+            return vectors @ query
+        scores = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+            scores[start:start + SCORE_BLOCK_ROWS] = vectors[start:start + SCORE_BLOCK_ROWS].astype(np.float32) @ query
+        return scores
+
+    def search(self, query_embedding, top_k: int = 3, where: Dict = None) -> List[Dict]:
+        """
+        the top_k chunks by cosine similarity, same result format as ChromaVectorStore.search
+        """
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(query))
+        if norm:
+            query = query / norm
+        with self._lock:
+            if self._count == 0 or top_k <= 0:
+                return []
+            rows = None
+            if where:
+                rows = np.flatnonzero(self._mask(where, self._count))
+                if len(rows) == 0:
+                    return []
+            scores = self._scores(query, rows)
+            k = min(top_k, len(scores))
+            # only the best k are sorted
+            best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+            best = best[np.argsort(-scores[best], kind="stable")]
+            numbers = best if rows is None else rows[best]
+            return [
+                {"id": self._ids[number], "content": self._documents[number], "metadata": dict(self._metadatas[number])}
+                for number in numbers
+            ]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            capacity = len(self._vectors) if self._vectors is not None else 0
+            dimension = self._vectors.shape[1] if self._vectors is not None else 0
+            return {
+                "chunks": self._count,
+                "dtype": self.dtype.name,
+                "mmap": bool(self.mmap_dir),
+                "vector_bytes": capacity * dimension * self.dtype.itemsize,
+            }
+
+
+_indexes: "OrderedDict[str, ExactVectorStore]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _sync(index: ExactVectorStore, max_chunks: Optional[int]):
+    """
+    bring an index up to date with chroma after the collection's corpus version changed
+    """
+    version = corpus_version(index.name)
+    if index.version == version:
+        return
+    with index.sync_lock:
+        if index.version == version:
+            return
+        source = chroma_store(index.name)
+        total = source.count()
+        if max_chunks is not None and total > max_chunks:
+            # too big for brute force, chroma's hnsw answers the searches. checked again on the next version
+            index.reset()
+            index.source, index.oversized, index.version = source, True, version
+            return
+        stored_ids = list(source.collection.get(include=[])["ids"]) if total else []
+        stored = set(stored_ids)
+        if index.oversized or any(chunk_id not in stored for chunk_id in index._ids):
+            # chunks were deleted (clear), an append only index cannot forget them, start over
+            index.reset()
+        index.source = source
+        missing = [chunk_id for chunk_id in stored_ids if chunk_id not in index._rows]
+        for ids, documents, embeddings, metadatas in source.iter_rows(missing):
+            index.append(ids, documents, embeddings, metadatas)
+        index.version = version
+
+
+def get_exact_store(name: str, max_chunks: Optional[int] = None) -> Optional[ExactVectorStore]:
+    """
+    the collection's exact index, loaded from chroma on first use and kept up to date.
+    None when the collection has more than max_chunks chunks (search it with chroma instead).
+    at most RAG_EXACT_MAX_LOADED collections stay in memory, the least recently used is dropped
+    """
+    with _indexes_lock:
+        index = _indexes.get(name)
+        if index is None:
+            index = _indexes[name] = ExactVectorStore(
+                name,
+                dtype=getattr(settings, "RAG_EXACT_DTYPE", DEFAULT_DTYPE),
+                mmap_dir=getattr(settings, "RAG_EXACT_MMAP_DIR", None),
+            )
+        _indexes.move_to_end(name)
+        while len(_indexes) > getattr(settings, "RAG_EXACT_MAX_LOADED", DEFAULT_MAX_LOADED):
+            _indexes.popitem(last=False)
+    _sync(index, max_chunks)
+    if index.oversized or (max_chunks is not None and len(index) > max_chunks):
+        return None
+    return index
+
+
+def drop_exact_index(name: str = None):
+    """
+    forget a collection's index (all of them without a name), it is reloaded from chroma on next use
+    """
+    with _indexes_lock:
+        if name is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(name, None)
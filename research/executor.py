@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+
+# BOUNDED INFERENCE EXECUTOR
+# the async views never run CPU heavy work (pdf extraction, encoding, generation) on the event loop.
+# they hand it to this pool instead. the pool has a fixed number of worker threads plus a bounded
+# waiting line, when both are full new work is rejected right away so the view can answer 503
+# instead of letting requests pile up behind each other. every stage also has its own timeout.
+# threads (not processes) because torch and the tokenizers release the GIL while they work.
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_QUEUE = 16
+DEFAULT_STAGE_TIMEOUTS = {
+    "extract": 120,
+    "index": 120,
+    "retrieve": 30,
+    "generate": 60,
+}
+
+
+class ExecutorSaturated(Exception):
+    """
+    every worker is busy and the waiting line is full
+    """
+
+
+class StageTimeout(Exception):
+    """
+    a pipeline stage took longer than its timeout
+    """
+
+    def __init__(self, stage: str, timeout: float):
+        self.stage = stage
+        self.timeout = timeout
+        super().__init__(f"Stage '{stage}' timed out after {timeout}s")
+
+
+class BoundedExecutor:
+    """
+    thread pool with a hard limit on running + waiting work
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_WORKERS, max_queue: int = DEFAULT_MAX_QUEUE,
+                 stage_timeouts: Optional[Dict[str, float]] = None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.stage_timeouts = dict(DEFAULT_STAGE_TIMEOUTS, **(stage_timeouts or {}))
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-worker")
+        # one slot per running or waiting task
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        queue fn on the pool, raises ExecutorSaturated instead of waiting when there is no room
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ExecutorSaturated(f"{self.max_workers} workers busy and {self.max_queue} tasks waiting")
+        with self._lock:
+            self.in_flight += 1
+        try:
+            # the worker runs in a copy of the caller's context, so a request's trace (research/tracing.py)
+            # still collects the stages that run on the pool
+            future = self._pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        # the slot is given back when the work really finishes, even if the caller timed out
+        # and stopped waiting, a timed out thread still occupies a cpu until it is done
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    async def run(self, stage: str, fn: Callable, *args, **kwargs) -> Any:
+        """
+        run fn on the pool and await it, with the timeout configured for this stage
+        """
+        future = self.submit(fn, *args, **kwargs)
+        timeout = self.stage_timeouts.get(stage)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise StageTimeout(stage, timeout)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queued": max(self.in_flight - self.max_workers, 0),
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> BoundedExecutor:
+    """
+    process wide executor built from RAG_EXECUTOR_WORKERS / RAG_EXECUTOR_MAX_QUEUE / RAG_STAGE_TIMEOUTS
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = BoundedExecutor(
+                    max_workers=getattr(settings, "RAG_EXECUTOR_WORKERS", DEFAULT_WORKERS),
+                    max_queue=getattr(settings, "RAG_EXECUTOR_MAX_QUEUE", DEFAULT_MAX_QUEUE),
+                    stage_timeouts=getattr(settings, "RAG_STAGE_TIMEOUTS", None),
+                )
+    return _executor
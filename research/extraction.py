@@ -0,0 +1,184 @@
+import codecs
+import math
+import mmap
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from typing import Callable, Iterator, List, Optional
+
+from django.conf import settings
+
+# TEXT EXTRACTION
+# turns an uploaded file (.txt or .pdf) into plain text, used by the upload views and the ingestion workers.
+# big PDFs are split into page ranges ("shards") that separate processes extract at the same time,
+# pdfplumber is pure python so threads would just take turns on one core. the shards are put back
+# together in page order. text is collected in lists and joined once instead of growing a string.
+# files already on disk are read as a stream: text files are decoded a block at a time and PDFs are
+# memory mapped, so the whole upload never has to sit in memory and the indexer can chunk it as it goes.
+
+# a PDF with fewer pages than this is extracted in the calling process, starting workers is not worth it
+DEFAULT_MIN_PAGES_PER_SHARD = 16
+# bytes of a text file decoded per step
+TEXT_READ_SIZE = 1024 * 1024
+
+
+def page_text(page, skip_tables_without_lines: bool = False) -> str:
+    """
+    text of one pdfplumber page followed by its tables, one " | " joined line per table row
+    """
+    # extract text
+    parts = [page.extract_text() or "", "\n"]
+
+    # extract tables if any. pdfplumber finds tables from ruling lines, with skip_tables_without_lines a page
+    # without any edges (lines, rectangle sides or curves) is assumed to have none and the (slow) table
+    # search is skipped. off by default, tables drawn some other way would be lost
+    if not skip_tables_without_lines or page.edges:
+        for table in page.extract_tables():
+            # convert table rows into string
+            for row in table:
+                parts.append(" | ".join([str(cell) for cell in row if cell]))
+                parts.append("\n")
+    return "".join(parts)
+
+
+@contextmanager
+def _open_pdf(path: str, pages: Optional[List[int]] = None):
+    """
+    pdfplumber over a read only memory map of the file. pages are read from the page cache on
+    demand instead of being copied into the process, and processes extracting the same file share them
+    """
+    import pdfplumber
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with pdfplumber.open(mapped, pages=pages) as pdf:
+            yield pdf
+
+
+def _extract_page_range(path: str, start: int, stop: int, skip_tables_without_lines: bool) -> List[str]:
+    """
+    runs in a worker process: text of pages [start, stop) of the PDF at path
+    """
+    # pdfplumber numbers pages from 1, only the requested pages are parsed
+    with _open_pdf(path, pages=list(range(start + 1, stop + 1))) as pdf:
+        return [page_text(page, skip_tables_without_lines) for page in pdf.pages]
+
+
+def pdf_page_count(path: str) -> int:
+    with _open_pdf(path) as pdf:
+        return len(pdf.pages)
+
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+
+def _process_pool(processes: int) -> ProcessPoolExecutor:
+    """
+    one long lived pool per process. "spawn" because the web process has threads (workers, batcher)
+    and forking a threaded process can copy held locks into the child
+    """
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None or _pool_size != processes:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=get_context("spawn"))
+            _pool_size = processes
+        return _pool
+
+
+def iter_pdf_pages(path: str, processes: Optional[int] = None, skip_tables_without_lines: Optional[bool] = None,
+                   progress: Optional[Callable[[int, int], None]] = None) -> Iterator[str]:
+    """
+    text of every page of the PDF at path, yielded in page order.
+    pages are split into shards and extracted by a pool of processes, only a few shards per process
+    are in flight at once so a slow consumer does not pile up the text of the whole file.
+    progress(done_pages, total_pages) is called as pages are handed out
+    """
+    if processes is None:
+        processes = getattr(settings, "PDF_EXTRACT_PROCESSES", None) or os.cpu_count() or 1
+    if skip_tables_without_lines is None:
+        skip_tables_without_lines = getattr(settings, "PDF_SKIP_TABLES_WITHOUT_LINES", False)
+    min_pages = getattr(settings, "PDF_MIN_PAGES_PER_SHARD", DEFAULT_MIN_PAGES_PER_SHARD)
+
+    total = pdf_page_count(path)
+    if processes <= 1 or total < 2 * min_pages:
+        # small file, one page at a time in this process
+        with _open_pdf(path) as pdf:
+            for done, page in enumerate(pdf.pages, start=1):
+                yield page_text(page, skip_tables_without_lines)
+                # pdfplumber caches parsed layout on the page, drop it once the text is out
+                page.close()
+                if progress:
+                    progress(done, total)
+        return
+
+    # a few shards per process so a slow shard (table heavy pages) does not leave the others idle
+    shard_size = max(min_pages, math.ceil(total / (processes * 4)))
+    shards = deque((start, min(start + shard_size, total)) for start in range(0, total, shard_size))
+
+    pool = _process_pool(processes)
+    in_flight = deque()
+    done = 0
+    while shards or in_flight:
+        # keep every process busy with one shard and one more waiting
+        while shards and len(in_flight) < processes * 2:
+            start, stop = shards.popleft()
+            in_flight.append(pool.submit(_extract_page_range, path, start, stop, skip_tables_without_lines))
+        # shards are handed out in page order
+        pages = in_flight.popleft().result()
+        done += len(pages)
+        yield from pages
+        if progress:
+            progress(done, total)
+
+
+def extract_pdf_pages(path: str, processes: Optional[int] = None, skip_tables_without_lines: Optional[bool] = None,
+                      progress: Optional[Callable[[int, int], None]] = None) -> List[str]:
+    """
+    text of every page of the PDF at path, in page order
+    """
+    return list(iter_pdf_pages(path, processes, skip_tables_without_lines, progress))
+
+
+def iter_text_file(path: str, read_size: int = TEXT_READ_SIZE,
+                   progress: Optional[Callable[[int, int], None]] = None) -> Iterator[str]:
+    """
+    decode a UTF-8 file a block at a time. the incremental decoder keeps the bytes of a character
+    that is split between two blocks until the rest of it arrives
+    """
+    total = os.path.getsize(path)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    done = 0
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(read_size)
+            if not block:
+                break
+            done += len(block)
+            text = decoder.decode(block)
+            if text:
+                yield text
+            if progress:
+                progress(done, total)
+    # raises if the file ends in the middle of a character, like bytes.decode would
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def iter_file_text(path: str, name: Optional[str] = None,
+                   progress: Optional[Callable[[int, int], None]] = None) -> Iterator[str]:
+    """
+    text of a file that is already on disk (spooled uploads) as a stream of pieces.
+    progress is reported in pages for PDFs and in bytes for text files
+    """
+    name = name or path
+    if name.endswith(".pdf"):
+        yield from iter_pdf_pages(path, progress=progress)
+    elif name.endswith(".txt"):
+        yield from iter_text_file(path, progress=progress)
+
@@ -0,0 +1,104 @@
+import calendar
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+# METADATA FILTERS
+# questions can be limited to some companies, document types or a filing date range.
+# the filters are turned into a chromadb `where` clause so the vector search itself only looks at
+# matching chunks and still returns top_k of them, instead of dropping hits after the search.
+# chroma compares numbers only, so every chunk also stores its filing date as a unix timestamp
+# (date_filed_ts). chunks of documents without a filing date never match a date range.
+#
+#   {"company": "Apple"}                          equality
+#   {"company": ["Apple", "Microsoft"]}           any of a list
+#   {"doc_type": "10-K", "date_from": "2023-01-01", "date_to": "2023-12-31"}
+
+FILTER_FIELDS = ("company", "doc_type")
+DATE_FIELDS = ("date_from", "date_to")
+
+
+class InvalidFilter(ValueError):
+    """
+    a filter the API cannot turn into a where clause, answered with 400
+    """
+
+
+def parse_date(value) -> Optional[date]:
+    """
+    a date from a date, a datetime or an ISO string ("2024-03-31" or "2024-03-31T12:00:00"), None stays None
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).strip()).date()
+    except ValueError:
+        raise InvalidFilter(f"Invalid date '{value}', expected YYYY-MM-DD")
+
+
+def date_timestamp(value) -> Optional[int]:
+    """
+    unix timestamp (UTC midnight) of a filing date, what chunks store as date_filed_ts
+    """
+    parsed = parse_date(value)
+    if parsed is None:
+        return None
+    return calendar.timegm(parsed.timetuple())
+
+
+def _values(field: str, value) -> List[str]:
+    values = value if isinstance(value, list) else [value]
+    if not values or not all(isinstance(v, str) and v for v in values):
+        raise InvalidFilter(f"'{field}' must be a string or a non-empty list of strings")
+    return values
+
+
+def build_where(filters: Optional[Dict]) -> Optional[Dict]:
+    """
+    chromadb where clause for the ask API's "filters", None when there is nothing to filter on
+    """
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise InvalidFilter("'filters' must be an object")
+    unknown = set(filters) - set(FILTER_FIELDS) - set(DATE_FIELDS)
+    if unknown:
+        raise InvalidFilter(f"Unknown filter(s): {', '.join(sorted(unknown))}")
+
+    conditions = []
+    for field in FILTER_FIELDS:
+        if filters.get(field) in (None, ""):
+            continue
+        values = _values(field, filters[field])
+        conditions.append({field: values[0]} if len(values) == 1 else {field: {"$in": values}})
+
+    date_from = date_timestamp(filters.get("date_from"))
+    date_to = parse_date(filters.get("date_to"))
+    if date_from is not None:
+        conditions.append({"date_filed_ts": {"$gte": date_from}})
+    if date_to is not None:
+        # the whole last day is included
+        conditions.append({"date_filed_ts": {"$lt": date_timestamp(date_to + timedelta(days=1))}})
+
+    if not conditions:
+        return None
+    # chroma wants a single condition as is and several wrapped in $and
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def upload_metadata(data) -> Dict:
+    """
+    optional company / doc_type / date_filed form fields of an upload, validated
+    """
+    metadata = {}
+    for field in FILTER_FIELDS:
+        value = (data.get(field) or "").strip()
+        if value:
+            metadata[field] = value[:200]
+    date_filed = parse_date(data.get("date_filed"))
+    if date_filed is not None:
+        metadata["date_filed"] = date_filed.isoformat()
+    return metadata
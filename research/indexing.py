@@ -0,0 +1,327 @@
+import hashlib
+import re
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from django.utils import timezone
+
+from research.extraction import iter_file_text
+from research.filters import parse_date
+from research.models import Chunk, Document
+from research.rag_pipeline import clean_text, content_hash, stream_chunks, vector_db
+from research.vector_store import get_collection, delete_collection, bump_corpus_version
+from research.vector_store import collection_name as shared_collection_name
+from research.tenancy import check_quota
+from research.lexical_index import add_to_lexical_index, drop_lexical_index
+from research.answer_cache import get_answer_cache
+from research.tracing import traced_iter
+
+# INDEXING STAGE
+# documents are chunked and embedded exactly once, when they are uploaded.
+# the question path (run_rag_pipeline) only embeds the question and searches what is already stored.
+# uploads on disk are indexed as a stream (index_file), extraction, chunking and embedding overlap and
+# only one step of chunks is in memory at a time.
+# every document and chunk is also written to the database (Document / Chunk rows) with flags for
+# how far it got, so a crashed ingest resumes, every worker sees the same corpus and the vector db
+# collection can be rebuilt from the rows (manage.py rebuild_index).
+
+
+# how many chunks are embedded and stored per step, progress is reported after each step
+INDEX_STEP_SIZE = 256
+
+
+class IngestionCancelled(Exception):
+    """
+    the ingest was cancelled (clear_docs) while it ran, it stops before its next step
+    """
+
+
+
+def build_document(title: str, content: str, company: str = "Unknown", doc_type: str = "uploaded",
+                   date_filed: str = None) -> Dict:
+    """
+    the document dict the indexing stage expects, with extra whitespace cleaned out of the text.
+    company / doc_type / date_filed end up in every chunk's metadata and can be filtered on
+    """
+    return {
+        "title": title,
+        "company": company,
+        "doc_type": doc_type,
+        "content": re.sub(r'\s+', ' ', content).strip(),
+        "date_filed": date_filed
+    }
+
+
+def index_document(document: Dict, progress: Optional[Callable[[str, int, int], None]] = None,
+                   collection_name: str = None) -> Dict:
+    """
+    chunk a single uploaded document and store only its chunks in the vector db.
+    chunk ids are content hashes, so indexing the same document again adds nothing.
+    progress, if given, is called as progress(stage, done, total) for "chunking" and "embedding".
+    returns how many chunks the document produced and how many were new.
+    collection_name is the tenant's collection, the shared one by default
+    """
+    content = clean_text(document["content"])
+    # the document id is a hash of its text so it stays the same across uploads and restarts
+    return index_stream(document, [content], content_hash(content)[:16], progress, collection_name)
+
+
+def index_file(path: str, title: str, progress: Optional[Callable[[str, int, int], None]] = None,
+               collection_name: str = None, metadata: Optional[Dict] = None,
+               cancelled: Optional[Callable[[], bool]] = None) -> Dict:
+    """
+    extract, chunk and embed a file on disk as one stream. text is read a block or a page at a time
+    and chunks are embedded INDEX_STEP_SIZE at a time, so memory stays the same whatever the file size.
+    the document id is a hash of the file bytes, the text is never held in one piece to hash it.
+    progress also gets ("extracting", pages or bytes done, total).
+    metadata holds the optional company / doc_type / date_filed given with the upload,
+    cancelled is asked before every step and stops the ingest with IngestionCancelled when it says so
+    """
+    extract_progress = (lambda done, total: progress("extracting", done, total)) if progress else None
+    pieces = iter_file_text(path, name=title, progress=extract_progress)
+    document = build_document(title, "", **(metadata or {}))
+    return index_stream(document, pieces, file_hash(path)[:16], progress, collection_name, cancelled)
+
+
+def index_stream(document: Dict, pieces: Iterable[str], document_id: str,
+                 progress: Optional[Callable[[str, int, int], None]] = None, collection_name: str = None,
+                 cancelled: Optional[Callable[[], bool]] = None) -> Dict:
+    """
+    chunk text that arrives as pieces and store the chunks step by step, see index_document.
+    every step is first written as Chunk rows, then embedded, then flagged embedding_generated,
+    so an ingest whose worker died half way picks up from the rows instead of starting over.
+    an ingest that fails (quota, bad file, cancelled) removes what it already stored of the document
+    """
+    collection = get_collection(collection_name)
+    name = collection.name
+    before = collection.count()
+    row = _document_row(document, document_id, name)
+
+    failed = True
+    try:
+        chunks = _index_rows(row, document, pieces, document_id, progress, cancelled)
+        failed = False
+    except Exception:
+        # a half indexed document would be searched, and count against the quota, without being complete
+        _remove_document(row)
+        raise
+    finally:
+        # answers and the bm25 index built on the corpus during the ingest must not outlive it
+        total = get_collection(name).count()
+        if failed or total != before:
+            corpus_changed(name)
+
+    if not chunks:
+        return {"document_id": None, "document": row.pk, "collection": name,
+                "chunks": 0, "added": 0, "total_chunks": before}
+    # vector_db already skipped existing ids, so the count difference is what this document added
+    return {
+        "document_id": document_id,
+        "document": row.pk,
+        "collection": name,
+        "chunks": chunks,
+        "added": total - before,
+        "total_chunks": total,
+    }
+
+
+def _index_rows(row: Document, document: Dict, pieces: Iterable[str], document_id: str,
+                progress: Optional[Callable[[str, int, int], None]],
+                cancelled: Optional[Callable[[], bool]]) -> int:
+    # the steps of index_stream, returns how many chunks the document has
+    if row.chunks_generated:
+        # chunked before (re-upload, or a worker died while embedding), the text is not read again
+        chunks = row.chunks.count()
+        _embed_pending(row, chunks, progress, cancelled)
+    else:
+        # chunks a previous attempt already embedded are only written again, not re-embedded
+        embedded = set(row.chunks.filter(embedding_generated=True).values_list("chunk_index", flat=True))
+        chunks = 0
+        step = []
+        # time spent reading, extracting and splitting the text, the stores in between are not counted
+        for chunk in traced_iter("extract_chunk", stream_chunks(document, pieces, document_id)):
+            step.append(chunk)
+            chunks += 1
+            if len(step) == INDEX_STEP_SIZE:
+                _check_cancelled(cancelled)
+                _store_step(row, step, embedded, chunks, progress)
+                step = []
+        if step:
+            _check_cancelled(cancelled)
+            _store_step(row, step, embedded, chunks, progress)
+        # a cancel that arrived during the last step still wins over finishing
+        _check_cancelled(cancelled)
+        row.chunks_generated = True
+        row.save(update_fields=["chunks_generated", "updated_at"])
+    if progress:
+        progress("chunking", chunks, chunks)
+    return chunks
+
+
+def delete_document(row: Document):
+    """
+    remove one stored document: its chunks from the vector db and the bm25 index, and its rows
+    """
+    _remove_document(row)
+    corpus_changed(row.collection)
+
+
+def _remove_document(row: Document):
+    # delete_document without the corpus version bump, index_stream bumps it itself
+    vector_ids = list(Chunk.objects.filter(document_id=row.pk).values_list("vector_id", flat=True))
+    if vector_ids:
+        get_collection(row.collection).delete(vector_ids)
+    # chunks go with their document (on_delete=CASCADE), the bm25 index reloads from the rows
+    Document.objects.filter(pk=row.pk).delete()
+    drop_lexical_index(row.collection)
+
+
+def _document_row(document: Dict, document_id: str, collection_name: str) -> Document:
+    defaults = {
+        "title": document["title"][:200],
+        "company": document["company"],
+        "doc_type": document["doc_type"],
+        "content": document["content"],
+    }
+    # unknown filing dates keep the model default
+    if document["date_filed"]:
+        filed = parse_date(document["date_filed"])
+        defaults["date_filed"] = timezone.make_aware(datetime.combine(filed, datetime.min.time()))
+    row, _ = Document.objects.get_or_create(collection=collection_name, fingerprint=document_id, defaults=defaults)
+    return row
+
+
+def _store_step(row: Document, step: List[Dict], embedded: Set[int], chunks: int,
+                 progress: Optional[Callable[[str, int, int], None]]):
+    # the total is not known until the stream ends, so done and total grow together
+    Chunk.objects.bulk_create([
+        Chunk(
+            document=row,
+            chunk_index=chunk["chunk_index"],
+            content=chunk["content"],
+            vector_id=chunk["id"],
+            metadata=chunk["metadata"],
+        )
+        for chunk in step
+    ], ignore_conflicts=True)
+    if progress:
+        progress("chunking", chunks, chunks)
+
+    pending = [chunk for chunk in step if chunk["chunk_index"] not in embedded]
+    if pending:
+        # a tenant's collection may only grow up to its quota
+        check_quota(row.collection, len(pending))
+        vector_db(pending, row.collection)
+        row.chunks.filter(chunk_index__in=[chunk["chunk_index"] for chunk in pending]).update(embedding_generated=True)
+    # the bm25 index grows with the same steps
+    add_to_lexical_index(row.collection, step)
+    if progress:
+        progress("embedding", chunks, chunks)
+
+
+def _check_cancelled(cancelled: Optional[Callable[[], bool]]):
+    if cancelled is not None and cancelled():
+        raise IngestionCancelled("Ingestion was cancelled")
+
+
+def _embed_pending(row: Document, chunks: int, progress: Optional[Callable[[str, int, int], None]],
+                   cancelled: Optional[Callable[[], bool]] = None):
+    # chunk rows that were written but never embedded
+    pending = row.chunks.filter(embedding_generated=False).order_by("chunk_index")
+    done = chunks - pending.count()
+    while True:
+        step = list(pending[:INDEX_STEP_SIZE])
+        if not step:
+            break
+        _check_cancelled(cancelled)
+        check_quota(row.collection, len(step))
+        chunk_dicts = [chunk_from_row(chunk, row.fingerprint) for chunk in step]
+        vector_db(chunk_dicts, row.collection)
+        add_to_lexical_index(row.collection, chunk_dicts)
+        Chunk.objects.filter(pk__in=[chunk.pk for chunk in step]).update(embedding_generated=True)
+        done += len(step)
+        if progress:
+            progress("embedding", done, chunks)
+
+
+def chunk_from_row(chunk: Chunk, document_id: str) -> Dict:
+    """
+    the chunk dict vector_db expects, from a stored Chunk row
+    """
+    return {
+        "id": chunk.vector_id,
+        "document_id": document_id,
+        "chunk_index": chunk.chunk_index,
+        "content": chunk.content,
+        "metadata": chunk.metadata,
+    }
+
+
+def rebuild_index(progress: Optional[Callable[[str, int, int], None]] = None, collection_name: str = None) -> Dict:
+    """
+    throw vector db collections away and embed every stored Chunk row into new ones.
+    the rows are the source of truth, the collections can always be recreated from them.
+    rebuilds every tenant's collection unless collection_name is given
+    """
+    if collection_name:
+        names = [collection_name]
+    else:
+        names = list(Document.objects.values_list("collection", flat=True).distinct().order_by("collection"))
+    done = 0
+    for name in names:
+        done += _rebuild_collection(name, progress)
+    return {"collections": len(names), "chunks": done}
+
+
+def _rebuild_collection(name: str, progress: Optional[Callable[[str, int, int], None]]) -> int:
+    delete_collection(name)
+    rows = Chunk.objects.filter(document__collection=name).exclude(vector_id="") \
+        .select_related("document").order_by("pk")
+    total = rows.count()
+    done = 0
+    last_pk = 0
+    while True:
+        # keyset pagination, a large table is never loaded at once
+        step = list(rows.filter(pk__gt=last_pk)[:INDEX_STEP_SIZE])
+        if not step:
+            break
+        vector_db([chunk_from_row(chunk, chunk.document.fingerprint) for chunk in step], name)
+        Chunk.objects.filter(pk__in=[chunk.pk for chunk in step]).update(embedding_generated=True)
+        last_pk = step[-1].pk
+        done += len(step)
+        if progress:
+            progress(f"embedding {name}", done, total)
+    corpus_changed(name)
+    return done
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def clear_index(collection_name: str = None):
+    """
+    remove every indexed chunk and the stored documents of one collection (the shared one by default),
+    the next upload starts from an empty collection. other tenants are not touched
+    """
+    name = collection_name or shared_collection_name()
+    # chunks go with their documents (on_delete=CASCADE)
+    Document.objects.filter(collection=name).delete()
+    delete_collection(name)
+    drop_lexical_index(name)
+    corpus_changed(name)
+
+
+def corpus_changed(collection_name: str = None):
+    """
+    bump the collection's corpus version and drop its cached answers
+    """
+    name = collection_name or shared_collection_name()
+    bump_corpus_version(name)
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        answer_cache.invalidate(name)
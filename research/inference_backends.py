@@ -0,0 +1,181 @@
+import hashlib
+import os
+import re
+import time
+from typing import Any, Callable, List
+
+from django.conf import settings
+
+# CPU INFERENCE BACKENDS
+# we serve without a GPU, and by default both models run in fp32 pytorch. the backend decides how
+# the embedding model and flan-t5 are loaded, every backend gives back the same kind of object
+# (a SentenceTransformer, a hugging face text2text pipeline) so the rest of the pipeline does not change:
+#   torch  fp32 pytorch, the reference
+#   int8   pytorch with dynamic int8 quantization of every nn.Linear (weights int8, activations
+#          quantized on the fly), ~4x smaller linear layers and usually 1.5-2.5x faster on x86 cpus
+#   onnx   the model exported to ONNX and run by onnxruntime (needs `pip install optimum[onnxruntime]`),
+#          the export happens once and is kept in RAG_ONNX_CACHE_DIR
+#   stub   no model: hashed bag of words vectors and an answer copied from the context after a fixed
+#          delay, deterministic and cheap, so load tests (benchmarks/load_test.py) measure our code
+# pick one with RAG_INFERENCE_BACKEND, or per model with RAG_EMBEDDING_BACKEND / RAG_GENERATION_BACKEND.
+# benchmarks/bench_backends.py compares their latency and answer quality on a fixed question set.
+
+BACKENDS = ("torch", "int8", "onnx", "stub")
+DEFAULT_BACKEND = "torch"
+STUB_DIMENSION = 384
+
+
+def _backend(setting: str) -> str:
+    backend = getattr(settings, setting, None) or getattr(settings, "RAG_INFERENCE_BACKEND", DEFAULT_BACKEND)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}' in {setting}, expected one of {', '.join(BACKENDS)}")
+    return backend
+
+
+def embedding_backend() -> str:
+    return _backend("RAG_EMBEDDING_BACKEND")
+
+
+def generation_backend() -> str:
+    return _backend("RAG_GENERATION_BACKEND")
+
+
+def onnx_cache_dir() -> str:
+    return str(getattr(settings, "RAG_ONNX_CACHE_DIR", os.path.join(str(settings.BASE_DIR), "onnx_models")))
+
+
+class StubEmbeddingModel:
+    """
+    SentenceTransformer stand-in: every word is hashed into one of STUB_DIMENSION slots, vectors are unit length.
+    texts that share words are close, which is enough for retrieval to return sensible chunks
+    """
+
+    def encode(self, texts, batch_size: int = 32, **kwargs):
+        import numpy as np
+
+        single = isinstance(texts, str)
+        batch = [texts] if single else list(texts)
+        vectors = np.zeros((len(batch), STUB_DIMENSION), dtype=np.float32)
+        for row, text in enumerate(batch):
+            for word in re.findall(r"\w+", text.lower()):
+                slot = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "little")
+                vectors[row, slot % STUB_DIMENSION] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1.0, norms)
+        return vectors[0] if single else vectors
+
+
+class StubGenerator:
+    """
+    text2text pipeline stand-in: waits RAG_STUB_GENERATION_MS per batch (one forward pass) and answers
+    with the first sentence of the prompt's context
+    """
+
+    def __init__(self, delay_ms: float):
+        from research.context_packing import WordTokenizer
+
+        self.delay_ms = delay_ms
+        self.tokenizer = WordTokenizer()
+
+    def _answer(self, prompt: str) -> str:
+        context = prompt.split("Content:", 1)[-1].strip()
+        return re.split(r"(?<=[.!?])\s", context, maxsplit=1)[0][:200] or "I don't know based on the provided documents"
+
+    def __call__(self, prompts, **kwargs) -> List:
+        batch = [prompts] if isinstance(prompts, str) else list(prompts)
+        time.sleep(self.delay_ms / 1000.0)
+        return [{"generated_text": self._answer(prompt)} for prompt in batch]
+
+    def stream(self, prompt: str, on_text: Callable[[str], None], **kwargs):
+        # the same answer, handed over word by word after the same delay
+        time.sleep(self.delay_ms / 1000.0)
+        for word in self._answer(prompt).split(" "):
+            on_text(word + " ")
+
+
+def _quantize_linear_layers(model):
+    import torch
+    # only the weights are stored as int8, activations are quantized per batch at run time,
+    # so no calibration data is needed
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_embedding_model(model_name: str, backend: str = DEFAULT_BACKEND) -> Any:
+    """
+    the sentence transformer for model_name on the given backend
+    """
+    if backend == "stub":
+        return StubEmbeddingModel()
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "onnx":
+        # sentence-transformers exports the model on first load and runs it with onnxruntime
+        return SentenceTransformer(model_name, device="cpu", backend="onnx",
+                                   cache_folder=os.path.join(onnx_cache_dir(), "sentence_transformers"))
+    if backend == "int8":
+        # quantized kernels are cpu only
+        return _quantize_linear_layers(SentenceTransformer(model_name, device="cpu"))
+    # all-MiniLM-L6-v2 is the model that converts text into numeric vectors that captures semantic meaning
+    return SentenceTransformer(model_name)
+
+
+def _onnx_seq2seq(model_name: str):
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+    export_dir = os.path.join(onnx_cache_dir(), model_name.replace("/", "--"))
+    if os.path.isdir(export_dir):
+        return ORTModelForSeq2SeqLM.from_pretrained(export_dir)
+    # first use: export encoder and decoder to ONNX and keep them, later loads skip the export
+    model = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True)
+    model.save_pretrained(export_dir)
+    return model
+
+
+def load_generator(model_name: str, backend: str = DEFAULT_BACKEND) -> Any:
+    """
+    the text2text generation pipeline for model_name on the given backend
+    """
+    if backend == "stub":
+        return StubGenerator(getattr(settings, "RAG_STUB_GENERATION_MS", 50))
+    from transformers import AutoTokenizer, pipeline
+
+    if backend == "onnx":
+        return pipeline(task="text2text-generation", model=_onnx_seq2seq(model_name),
+                        tokenizer=AutoTokenizer.from_pretrained(model_name))
+    if backend == "int8":
+        generator = pipeline(task="text2text-generation", model=model_name, device="cpu")
+        generator.model = _quantize_linear_layers(generator.model)
+        return generator
+    # create text generation pipeline using a hugging face, this model receives text and returns text
+    return pipeline(task="text2text-generation", model=model_name)
+
+
+def stream_generate(generator: Any, prompt: str, on_text: Callable[[str], None], max_input_tokens: int = 512,
+                    **kwargs):
+    """
+    generate the answer to prompt and call on_text with every piece of text as it is produced.
+    blocks until generation is done, the caller decides which thread that happens on
+    """
+    if hasattr(generator, "stream"):
+        # the stub (and any backend that streams by itself)
+        return generator.stream(prompt, on_text, **kwargs)
+    from transformers import TextStreamer
+
+    class CallbackStreamer(TextStreamer):
+        # TextStreamer prints decoded words, hand them to on_text instead
+        def on_finalized_text(self, text: str, stream_end: bool = False):
+            on_text(text)
+
+    tokenizer = generator.tokenizer
+    # the model only reads max_input_tokens, truncate here like the pipeline would
+    inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=max_input_tokens)
+    inputs = inputs.to(generator.model.device)
+    streamer = CallbackStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    generator.model.generate(**inputs, streamer=streamer, **kwargs)
+
+
+def embedding_cache_name(model_name: str, backend: str) -> str:
+    """
+    what the embedding cache keys vectors by, other backends give slightly different vectors
+    """
+    return model_name if backend == DEFAULT_BACKEND else f"{model_name}@{backend}"
@@ -0,0 +1,272 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from research.indexing import IngestionCancelled, delete_document, index_file
+from research.models import Document, IngestionJob
+
+# BACKGROUND INGESTION QUEUE
+# upload_document only writes the file to INGEST_UPLOAD_DIR and inserts an IngestionJob row, then
+# returns the job id. workers (threads in the web process, or `manage.py run_ingest_workers`) claim
+# queued rows one at a time and run extraction, chunking and embedding, writing progress
+# back to the row. the database table is the queue, so no broker is needed and nothing is lost when a
+# worker dies: a running job whose heartbeat goes stale is put back in the queue.
+
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_STALE_AFTER = 300
+DEFAULT_MAX_ATTEMPTS = 3
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def upload_dir() -> str:
+    return str(getattr(settings, "INGEST_UPLOAD_DIR", os.path.join(str(settings.BASE_DIR), "uploads")))
+
+
+def spool_upload(file) -> str:
+    """
+    copy an uploaded file to INGEST_UPLOAD_DIR in UPLOAD_CHUNK_SIZE pieces and return its path,
+    the upload is never read into memory as a whole
+    """
+    os.makedirs(upload_dir(), exist_ok=True)
+    # unique name on disk, the original name is kept by the caller for the document title
+    path = os.path.join(upload_dir(), f"{uuid.uuid4().hex}_{os.path.basename(file.name)}")
+    with open(path, "wb") as destination:
+        for piece in file.chunks(UPLOAD_CHUNK_SIZE):
+            destination.write(piece)
+    return path
+
+
+def index_spooled_file(path: str, title: str, collection_name: str = None, metadata: Optional[Dict] = None) -> Dict:
+    """
+    index a spooled upload right away (the async upload view) and remove it afterwards
+    """
+    try:
+        return index_file(path, title, collection_name=collection_name, metadata=metadata)
+    finally:
+        os.remove(path)
+
+
+def enqueue_upload(file, collection_name: str, metadata: Optional[Dict] = None) -> IngestionJob:
+    """
+    save an uploaded file to disk and queue it for ingestion into the uploader's collection
+    """
+    job = IngestionJob.objects.create(original_name=file.name, file_path=spool_upload(file),
+                                      collection=collection_name, metadata=metadata or {})
+
+    if getattr(settings, "INGEST_RUN_IN_PROCESS", True):
+        ensure_local_workers()
+    return job
+
+
+def claim_next_job(worker_id: str) -> Optional[IngestionJob]:
+    """
+    take the oldest queued job. the status check is part of the UPDATE, so when two workers race
+    for the same row only one of them gets it
+    """
+    while True:
+        candidate = IngestionJob.objects.filter(status=IngestionJob.QUEUED).order_by("created_at", "id").first()
+        if candidate is None:
+            return None
+        now = timezone.now()
+        claimed = IngestionJob.objects.filter(pk=candidate.pk, status=IngestionJob.QUEUED).update(
+            status=IngestionJob.RUNNING,
+            worker=worker_id,
+            attempts=F("attempts") + 1,
+            started_at=now,
+            heartbeat_at=now,
+            error="",
+        )
+        if claimed:
+            return IngestionJob.objects.get(pk=candidate.pk)
+        # someone else claimed it first, try the next one
+
+
+def requeue_stale_jobs(stale_after: Optional[float] = None) -> int:
+    """
+    put running jobs whose worker stopped sending heartbeats back in the queue,
+    or fail them once they used up INGEST_MAX_ATTEMPTS. returns how many were touched
+    """
+    stale_after = stale_after if stale_after is not None else getattr(settings, "INGEST_STALE_AFTER", DEFAULT_STALE_AFTER)
+    max_attempts = getattr(settings, "INGEST_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    stale = IngestionJob.objects.filter(status=IngestionJob.RUNNING, heartbeat_at__lt=cutoff)
+
+    failed = stale.filter(attempts__gte=max_attempts).update(
+        status=IngestionJob.FAILED,
+        error="Worker stopped responding too many times",
+        finished_at=timezone.now(),
+    )
+    requeued = stale.filter(attempts__lt=max_attempts).update(status=IngestionJob.QUEUED, worker="")
+    return failed + requeued
+
+
+def _save_progress(job: IngestionJob, stage: str, done: int, total: int):
+    job.stage = stage
+    job.progress[stage] = {"done": done, "total": total}
+    job.heartbeat_at = timezone.now()
+    job.save(update_fields=["stage", "progress", "heartbeat_at", "updated_at"])
+
+
+def process_job(job: IngestionJob) -> IngestionJob:
+    """
+    run every ingestion stage for a claimed job and record the outcome on the row
+    """
+    indexed = None
+    try:
+        # the file is extracted, chunked and embedded as one stream, the stages overlap.
+        # clear_docs may cancel the job while it runs, the row is checked between steps
+        indexed = index_file(job.file_path, job.original_name,
+                             progress=lambda stage, done, total: _save_progress(job, stage, done, total),
+                             collection_name=job.collection, metadata=job.metadata,
+                             cancelled=lambda: _is_cancelled(job))
+        outcome = {"status": IngestionJob.DONE, "stage": "done", "result": indexed,
+                   "document_id": indexed["document"]}
+    except IngestionCancelled:
+        outcome = {"status": IngestionJob.CANCELLED}
+    except Exception as e:
+        outcome = {"status": IngestionJob.FAILED, "error": str(e)}
+    finally:
+        # the spooled upload is only needed until the job is finished, whatever the outcome
+        _remove_upload(job.file_path)
+
+    try:
+        finished = _finish_job(job, outcome)
+    except Exception as e:
+        # e.g. clear_docs deleted the document after the last check and the foreign key fails
+        outcome = {"status": IngestionJob.FAILED, "error": str(e)}
+        finished = _finish_job(job, outcome)
+
+    if not finished:
+        # the job was cancelled (or taken back from us) after its last check, so its outcome is dropped
+        # and the document it may have indexed must not survive the clear that cancelled it
+        IngestionJob.objects.filter(pk=job.pk, status=IngestionJob.CANCELLED, finished_at__isnull=True).update(
+            finished_at=timezone.now(), updated_at=timezone.now(),
+        )
+    if indexed is not None and (not finished or outcome["status"] != IngestionJob.DONE):
+        _remove_indexed_document(indexed["document"])
+    job.refresh_from_db()
+    return job
+
+
+def _finish_job(job: IngestionJob, outcome: Dict) -> bool:
+    """
+    record the outcome only if the job is still running. the status check is part of the UPDATE (like
+    claim_next_job) so a cancel from clear_docs is never overwritten. returns whether the row was updated
+    """
+    now = timezone.now()
+    return bool(IngestionJob.objects.filter(pk=job.pk, status=IngestionJob.RUNNING).update(
+        finished_at=now, updated_at=now, **outcome,
+    ))
+
+
+def _remove_indexed_document(document_id: int):
+    row = Document.objects.filter(pk=document_id).first()
+    if row is not None:
+        delete_document(row)
+
+
+def _is_cancelled(job: IngestionJob) -> bool:
+    return IngestionJob.objects.filter(pk=job.pk, status=IngestionJob.CANCELLED).exists()
+
+
+def _remove_upload(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def cancel_jobs(collection_name: str) -> int:
+    """
+    used by clear_docs so documents uploaded before the clear do not reappear after it.
+    queued jobs are cancelled and their files removed here, running ones are marked cancelled
+    and their worker stops at its next step. returns how many jobs were cancelled
+    """
+    cancelled = 0
+    for job in IngestionJob.objects.filter(status=IngestionJob.QUEUED, collection=collection_name):
+        # a worker may claim it in the meantime, then it is cancelled as a running job below
+        if IngestionJob.objects.filter(pk=job.pk, status=IngestionJob.QUEUED).update(
+                status=IngestionJob.CANCELLED, finished_at=timezone.now()):
+            _remove_upload(job.file_path)
+            cancelled += 1
+    # finished_at is set by the worker once it has stopped
+    cancelled += IngestionJob.objects.filter(status=IngestionJob.RUNNING, collection=collection_name).update(
+        status=IngestionJob.CANCELLED,
+    )
+    return cancelled
+
+
+class IngestionWorkerPool:
+    """
+    a few threads that keep claiming and processing jobs until stopped
+    """
+
+    def __init__(self, workers: int = 1, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.id_prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        # jobs left running by a crashed worker are picked up again first
+        requeue_stale_jobs()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run_worker, args=(f"{self.id_prefix}:{i}",),
+                                      name=f"rag-ingest-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run_worker(self, worker_id: str):
+        last_stale_check = time.monotonic()
+        while not self._stop.is_set():
+            # long lived threads must not keep broken or expired db connections around
+            close_old_connections()
+            try:
+                if time.monotonic() - last_stale_check > self.poll_interval * 30:
+                    requeue_stale_jobs()
+                    last_stale_check = time.monotonic()
+                job = claim_next_job(worker_id)
+                if job is None:
+                    self._stop.wait(self.poll_interval)
+                    continue
+                process_job(job)
+            except Exception as e:
+                print(f"Ingestion worker {worker_id} error: {e}")
+                self._stop.wait(self.poll_interval)
+        close_old_connections()
+
+
+_local_pool = None
+_local_pool_lock = threading.Lock()
+
+
+def ensure_local_workers() -> IngestionWorkerPool:
+    """
+    start the in-process worker threads once (INGEST_WORKERS of them)
+    """
+    global _local_pool
+    if _local_pool is None:
+        with _local_pool_lock:
+            if _local_pool is None:
+                pool = IngestionWorkerPool(
+                    workers=getattr(settings, "INGEST_WORKERS", 2),
+                    poll_interval=getattr(settings, "INGEST_POLL_INTERVAL", DEFAULT_POLL_INTERVAL),
+                )
+                pool.start()
+                _local_pool = pool
+    return _local_pool
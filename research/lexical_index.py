@@ -0,0 +1,260 @@
+import math
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from research.vector_store import corpus_version
+
+# LEXICAL (BM25) INDEX
+# dense search is good at meaning but weak at exact tokens: tickers, line items, fiscal years.
+# this is a small inverted index per collection, kept in process next to chroma:
+#   term -> postings, two compact arrays (chunk numbers as uint32, term counts as uint16)
+#   per chunk: its vector db id, its length in tokens and the metadata fields filters can use
+# chunks are appended as they are indexed, nothing is ever rebuilt for an upload. the Chunk rows
+# are the source of truth, an index is loaded from them on first use and catches up with rows other
+# workers added whenever the collection's corpus version changes.
+
+DEFAULT_K1 = 1.5
+DEFAULT_B = 0.75
+DEFAULT_MAX_LOADED = 32
+
+# numbers keep their dots and dashes ("10-k", "383.3", "fy2023"), everything else splits on punctuation
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were what "
+    "which with how did does do".split()
+)
+# metadata the filters (research/filters.py) can refer to
+FILTER_KEYS = ("company", "doc_type", "date_filed_ts")
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+def matches(metadata: Dict, where: Optional[Dict]) -> bool:
+    """
+    evaluate a chroma style where clause against one chunk's metadata, for the operators build_where uses
+    """
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches(metadata, part) for part in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches(metadata, part) for part in condition):
+                return False
+            continue
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, operand in condition.items():
+            if operator == "$eq" and value != operand:
+                return False
+            if operator == "$ne" and value == operand:
+                return False
+            if operator == "$in" and value not in operand:
+                return False
+            if operator == "$nin" and value in operand:
+                return False
+            # a chunk without the field never matches a range
+            if operator in ("$gt", "$gte", "$lt", "$lte") and value is None:
+                return False
+            if operator == "$gt" and not value > operand:
+                return False
+            if operator == "$gte" and not value >= operand:
+                return False
+            if operator == "$lt" and not value < operand:
+                return False
+            if operator == "$lte" and not value <= operand:
+                return False
+    return True
+
+
+class LexicalIndex:
+    """
+    append only BM25 index over chunk texts
+    """
+
+    def __init__(self, k1: float = DEFAULT_K1, b: float = DEFAULT_B):
+        self.k1 = k1
+        self.b = b
+        # add() grows the arrays, search() reads them through numpy views, never both at once
+        self._lock = threading.Lock()
+        # one catch up with the Chunk rows at a time
+        self.sync_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._terms: Dict[str, int] = {}
+            self._postings_docs: List[array] = []
+            self._postings_counts: List[array] = []
+            self._doc_lengths = array("I")
+            self._doc_ids: List[str] = []
+            self._doc_numbers: Dict[str, int] = {}
+            self._doc_metadata: List[Tuple] = []
+            self._total_length = 0
+            # bookkeeping for catching up with the Chunk rows
+            self.version = None
+            self.last_pk = 0
+            self.synced_rows = 0
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def __contains__(self, chunk_id: str):
+        return chunk_id in self._doc_numbers
+
+    def add(self, chunks: Iterable[Tuple[str, str, Dict]]) -> int:
+        """
+        index (chunk id, text, metadata) triples, ids already in the index are skipped. returns how many were new
+        """
+        added = 0
+        with self._lock:
+            for chunk_id, text, metadata in chunks:
+                if chunk_id in self._doc_numbers:
+                    continue
+                number = len(self._doc_ids)
+                self._doc_numbers[chunk_id] = number
+                self._doc_ids.append(chunk_id)
+                self._doc_metadata.append(tuple((metadata or {}).get(key) for key in FILTER_KEYS))
+
+                counts: Dict[str, int] = {}
+                tokens = tokenize(text)
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+                for token, count in counts.items():
+                    term = self._terms.get(token)
+                    if term is None:
+                        term = self._terms[token] = len(self._postings_docs)
+                        self._postings_docs.append(array("I"))
+                        self._postings_counts.append(array("H"))
+                    self._postings_docs[term].append(number)
+                    self._postings_counts[term].append(min(count, 65535))
+                self._doc_lengths.append(len(tokens))
+                self._total_length += len(tokens)
+                added += 1
+        return added
+
+    def search(self, query: str, top_k: int = 10, where: Optional[Dict] = None) -> List[Tuple[str, float]]:
+        """
+        [(chunk id, bm25 score), ...] best first, only chunks that contain a query term and match where
+        """
+        tokens = tokenize(query)
+        with self._lock:
+            terms = {self._terms[token] for token in tokens if token in self._terms}
+            if not terms or top_k <= 0:
+                return []
+            count = len(self._doc_ids)
+            average_length = self._total_length / count if count else 1.0
+            lengths = np.frombuffer(self._doc_lengths, dtype=np.uint32)
+            scores = np.zeros(count, dtype=np.float32)
+            for term in terms:
+                docs = np.frombuffer(self._postings_docs[term], dtype=np.uint32)
+                frequencies = np.frombuffer(self._postings_counts[term], dtype=np.uint16).astype(np.float32)
+                idf = math.log(1.0 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                norm = self.k1 * (1.0 - self.b + self.b * lengths[docs] / average_length)
+                scores[docs] += idf * frequencies * (self.k1 + 1.0) / (frequencies + norm)
+            # views must not outlive the lock, add() cannot grow an array numpy is looking at
+            del lengths, docs, frequencies
+
+            candidates = np.flatnonzero(scores)
+            if where:
+                candidates = np.array([
+                    number for number in candidates
+                    if matches(dict(zip(FILTER_KEYS, self._doc_metadata[number])), where)
+                ], dtype=np.int64)
+            if len(candidates) > top_k:
+                # only the best top_k are sorted
+                best = np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+                candidates = candidates[best]
+            ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+            return [(self._doc_ids[number], float(scores[number])) for number in ranked]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            postings = sum(len(docs) for docs in self._postings_docs)
+            return {
+                "chunks": len(self._doc_ids),
+                "terms": len(self._terms),
+                "postings": postings,
+                # 4 bytes per chunk number + 2 per count, plus 4 per chunk length
+                "postings_bytes": postings * 6 + len(self._doc_lengths) * 4,
+            }
+
+
+_indexes: "OrderedDict[str, LexicalIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _sync(index: LexicalIndex, name: str):
+    """
+    bring an index up to date with the Chunk rows of its collection after the corpus version changed
+    """
+    from research.models import Chunk
+
+    version = corpus_version(name)
+    if index.version == version:
+        return
+    with index.sync_lock:
+        if index.version == version:
+            return
+        rows = Chunk.objects.filter(document__collection=name).exclude(vector_id="")
+        if rows.filter(pk__lte=index.last_pk).count() < index.synced_rows or rows.count() < len(index):
+            # rows were deleted (clear), an append only index cannot forget them, start over
+            index.reset()
+        new_rows = rows.filter(pk__gt=index.last_pk).order_by("pk").values_list("pk", "vector_id", "content", "metadata")
+        for pk, vector_id, content, metadata in new_rows.iterator(chunk_size=2000):
+            index.add([(vector_id, content, metadata)])
+            index.last_pk = pk
+            index.synced_rows += 1
+        index.version = version
+
+
+def get_lexical_index(name: str) -> LexicalIndex:
+    """
+    the collection's index, loaded from the Chunk rows on first use and kept up to date.
+    at most RAG_LEXICAL_MAX_LOADED collections stay in memory, the least recently used is dropped
+    """
+    with _indexes_lock:
+        index = _indexes.get(name)
+        if index is None:
+            index = _indexes[name] = LexicalIndex(
+                k1=getattr(settings, "RAG_BM25_K1", DEFAULT_K1),
+                b=getattr(settings, "RAG_BM25_B", DEFAULT_B),
+            )
+        _indexes.move_to_end(name)
+        while len(_indexes) > getattr(settings, "RAG_LEXICAL_MAX_LOADED", DEFAULT_MAX_LOADED):
+            _indexes.popitem(last=False)
+    _sync(index, name)
+    return index
+
+
+def add_to_lexical_index(name: str, chunks: List[Dict]):
+    """
+    called by the indexer for every stored step. only an index that is already loaded is updated,
+    one that is not gets the chunks from the rows when it is first used
+    """
+    with _indexes_lock:
+        index = _indexes.get(name)
+    if index is not None:
+        index.add((chunk["id"], chunk["content"], chunk["metadata"]) for chunk in chunks)
+
+
+def drop_lexical_index(name: str = None):
+    """
+    forget a collection's index (all of them without a name), it is reloaded from the rows on next use
+    """
+    with _indexes_lock:
+        if name is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(name, None)
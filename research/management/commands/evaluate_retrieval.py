@@ -0,0 +1,274 @@
+import itertools
+import json
+import os
+import time
+import uuid
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from research.embedding_cache import reset_embedding_cache
+from research.inference_backends import embedding_backend
+from research.lexical_index import LexicalIndex
+from research.model_registry import embedding_model_name, registry
+from research.rag_pipeline import (HYBRID_CANDIDATES, RETRIEVAL_MODES, chunk_documents, process_query,
+                                   reciprocal_rank_fusion, search_vector)
+from research.vector_store import ChromaVectorStore, hnsw_metadata
+
+# RETRIEVAL EVALUATION
+# an offline, repeatable answer to "did this change make retrieval better or worse, faster or slower".
+# a labelled corpus (benchmarks/data/retrieval_eval.json) is chunked with chunk_documents and
+# searched with search_vector, exactly like uploads and questions are, for every combination of
+# the settings given on the command line. a question is labelled with the document and a short
+# answer span ("$41.7 billion"), a retrieved chunk is relevant when it comes from that document and
+# contains the span, so the labels stay valid for any chunk size. per configuration we report:
+#   recall@k   share of the labelled spans found in the top k chunks, averaged over questions
+#   mrr        1 / rank of the first relevant chunk (0 when none is retrieved), averaged
+#   p50 / p95  per question latency of embedding the question plus the search
+#   build      seconds to chunk, embed and index the corpus
+# every configuration gets a throwaway in-memory collection, the real vector store is not touched.
+# the embedding cache is emptied (and its disk tier left out) before every build and every mode,
+# otherwise later configurations would report build time and latency without the encoding cost.
+# embedding models other than the configured one are loaded through the model registry, so the
+# usual backend settings apply (RAG_INFERENCE_BACKEND=stub runs without any model).
+
+DEFAULT_DATASET = os.path.join(str(settings.BASE_DIR), "benchmarks", "data", "retrieval_eval.json")
+
+
+def _csv(cast):
+    # "300,500" -> [300, 500]
+    return lambda value: [cast(item) for item in value.split(",") if item.strip()]
+
+
+def _optional_int(value: str):
+    # "default" keeps chroma's own value for an hnsw parameter
+    return None if value == "default" else int(value)
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def load_dataset(path: str) -> Dict:
+    try:
+        with open(path) as f:
+            dataset = json.load(f)
+    except (OSError, ValueError) as e:
+        raise CommandError(f"Cannot read dataset {path}: {e}")
+    documents = {document["id"]: document for document in dataset.get("documents", [])}
+    for question in dataset.get("questions", []):
+        for relevant in question["relevant"]:
+            if relevant["document"] not in documents:
+                raise CommandError(f"Question '{question['query']}' is labelled with unknown document "
+                                   f"'{relevant['document']}'")
+    return dataset
+
+
+def is_relevant(chunk: Dict, relevant: Dict) -> bool:
+    return chunk["metadata"].get("eval_document") == relevant["document"] and relevant["contains"] in chunk["content"]
+
+
+def score_question(results: List[Dict], labels: List[Dict], top_k: int) -> Dict:
+    """
+    recall@k and reciprocal rank of one question's best-first results
+    """
+    top = results[:top_k]
+    found = sum(any(is_relevant(chunk, label) for chunk in top) for label in labels)
+    reciprocal_rank = 0.0
+    for rank, chunk in enumerate(top, start=1):
+        if any(is_relevant(chunk, label) for label in labels):
+            reciprocal_rank = 1.0 / rank
+            break
+    return {"recall": found / len(labels), "reciprocal_rank": reciprocal_rank}
+
+
+class EvalIndex:
+    """
+    one configuration's corpus: a temporary chroma collection plus a bm25 index for the lexical modes
+    """
+
+    def __init__(self, client, chunks: List[Dict], hnsw: Dict):
+        from research.embeddings import embed_texts
+
+        self.client = client
+        self.collection = ChromaVectorStore(
+            client.create_collection(name=f"retrieval_eval_{uuid.uuid4().hex[:12]}", metadata=hnsw_metadata(hnsw)))
+        self.chunks = {chunk["id"]: chunk for chunk in chunks}
+        chunks = list(self.chunks.values())
+
+        start = time.perf_counter()
+        embeddings = embed_texts([chunk["content"] for chunk in chunks])
+        # chroma limits the size of one add, large corpora go in slices
+        for offset in range(0, len(chunks), 1000):
+            part = chunks[offset:offset + 1000]
+            self.collection.add(
+                ids=[chunk["id"] for chunk in part],
+                documents=[chunk["content"] for chunk in part],
+                embeddings=embeddings[offset:offset + 1000],
+                metadatas=[chunk["metadata"] for chunk in part],
+            )
+        self.lexical = LexicalIndex()
+        self.lexical.add((chunk["id"], chunk["content"], chunk["metadata"]) for chunk in chunks)
+        self.build_seconds = time.perf_counter() - start
+
+    def search(self, query: str, top_k: int, mode: str) -> List[Dict]:
+        # the same steps as retrieve(), against this index instead of the stored Chunk rows
+        if mode == "lexical":
+            return [self.chunks[chunk_id] for chunk_id, _ in self.lexical.search(query, top_k)]
+        query_embedding = process_query(query)
+        n_results = min(top_k if mode == "dense" else top_k * HYBRID_CANDIDATES, len(self.chunks))
+        dense = search_vector(self.collection, query_embedding, top_k=n_results)
+        if mode == "dense":
+            return dense
+        lexical_hits = self.lexical.search(query, n_results)
+        fused = reciprocal_rank_fusion([[result["id"] for result in dense], [chunk_id for chunk_id, _ in lexical_hits]])
+        return [self.chunks[chunk_id] for chunk_id in fused[:top_k]]
+
+    def close(self):
+        self.client.delete_collection(self.collection.name)
+
+
+def build_chunks(documents: List[Dict], chunk_size: int, chunk_overlap: int) -> List[Dict]:
+    chunks = []
+    for document in documents:
+        # chunked one document at a time so every chunk knows its labelled document id
+        for chunk in chunk_documents([document], chunk_size=chunk_size, chunk_overlap=chunk_overlap):
+            chunk["metadata"]["eval_document"] = document["id"]
+            chunks.append(chunk)
+    return chunks
+
+
+def evaluate(dataset: Dict, configs: List[Dict], top_ks: List[int], modes: List[str], progress=None) -> List[Dict]:
+    """
+    one row per (config, mode, top_k): the config plus recall, mrr, latency and build time
+    """
+    import chromadb
+
+    client = chromadb.EphemeralClient()
+    questions = dataset["questions"]
+    largest_k = max(top_ks)
+    rows = []
+    current_model = None
+    try:
+        for config in configs:
+            if config["embedding_model"] != current_model:
+                # the registry loads the other model on the next embed, the embedding cache keys by model name
+                registry.unload("embedding")
+                current_model = config["embedding_model"]
+            with override_settings(RAG_EMBEDDING_MODEL=current_model, EMBEDDING_CACHE_DIR=None):
+                chunks = build_chunks(dataset["documents"], config["chunk_size"], config["chunk_overlap"])
+                # every build and every mode pays for its own encoding, like the first one did
+                reset_embedding_cache()
+                index = EvalIndex(client, chunks, config["hnsw"])
+                try:
+                    for mode in modes:
+                        reset_embedding_cache()
+                        # search once at the largest k, the smaller ks are prefixes of the same ranking
+                        latencies, rankings = [], []
+                        for question in questions:
+                            start = time.perf_counter()
+                            rankings.append(index.search(question["query"], largest_k, mode))
+                            latencies.append((time.perf_counter() - start) * 1000)
+                        for top_k in top_ks:
+                            scores = [score_question(results, question["relevant"], top_k)
+                                      for results, question in zip(rankings, questions)]
+                            rows.append({
+                                "embedding_model": current_model,
+                                "chunk_size": config["chunk_size"],
+                                "chunk_overlap": config["chunk_overlap"],
+                                "hnsw": dict(config["hnsw"]),
+                                "mode": mode,
+                                "top_k": top_k,
+                                "chunks": len(index.chunks),
+                                "recall": round(sum(s["recall"] for s in scores) / len(scores), 4),
+                                "mrr": round(sum(s["reciprocal_rank"] for s in scores) / len(scores), 4),
+                                "p50_ms": round(percentile(latencies, 0.5), 2),
+                                "p95_ms": round(percentile(latencies, 0.95), 2),
+                                "build_s": round(index.build_seconds, 3),
+                            })
+                finally:
+                    index.close()
+            if progress:
+                progress(config)
+    finally:
+        # the next request loads the configured model again, with a cache built from the real settings
+        registry.unload("embedding")
+        reset_embedding_cache()
+    return rows
+
+
+def format_table(rows: List[Dict]) -> str:
+    def hnsw_label(hnsw):
+        return "/".join("-" if hnsw.get(key) is None else str(hnsw[key]) for key in ("M", "construction_ef", "search_ef"))
+
+    header = (f"{'model':<28}{'size':>6}{'overlap':>8}{'hnsw M/efC/efS':>16}{'mode':>9}{'k':>4}{'chunks':>8}"
+              f"{'recall@k':>10}{'mrr':>8}{'p50 ms':>9}{'p95 ms':>9}{'build s':>9}")
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(
+            f"{row['embedding_model'][-28:]:<28}{row['chunk_size']:>6}{row['chunk_overlap']:>8}"
+            f"{hnsw_label(row['hnsw']):>16}{row['mode']:>9}{row['top_k']:>4}{row['chunks']:>8}"
+            f"{row['recall']:>10.3f}{row['mrr']:>8.3f}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['build_s']:>9.2f}"
+        )
+    return "\n".join(lines)
+
+
+class Command(BaseCommand):
+    help = ("Measure retrieval quality (recall@k, MRR) and latency on a labelled corpus "
+            "for every combination of chunking, top_k, index and embedding model settings")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dataset", default=DEFAULT_DATASET,
+                            help="json file with 'documents' and labelled 'questions'")
+        parser.add_argument("--chunk-sizes", type=_csv(int), default=[300], help="comma separated, e.g. 200,300,500")
+        parser.add_argument("--chunk-overlaps", type=_csv(int), default=[50], help="comma separated, e.g. 0,50,100")
+        parser.add_argument("--top-k", type=_csv(int), default=[1, 3, 5], help="comma separated ks to report")
+        parser.add_argument("--modes", type=_csv(str), default=["dense"],
+                            help=f"comma separated retrieval modes: {', '.join(RETRIEVAL_MODES)}")
+        parser.add_argument("--hnsw-m", type=_csv(_optional_int), default=[None],
+                            help="comma separated hnsw M values ('default' = chroma's)")
+        parser.add_argument("--hnsw-ef-construction", type=_csv(_optional_int), default=[None])
+        parser.add_argument("--hnsw-ef-search", type=_csv(_optional_int), default=[None])
+        parser.add_argument("--embedding-models", type=_csv(str), default=None,
+                            help="comma separated embedding models (default: RAG_EMBEDDING_MODEL)")
+        parser.add_argument("--output", help="also write the rows as json to this file")
+
+    def handle(self, *args, **options):
+        for mode in options["modes"]:
+            if mode not in RETRIEVAL_MODES:
+                raise CommandError(f"Unknown retrieval mode '{mode}', expected one of {', '.join(RETRIEVAL_MODES)}")
+        if not options["top_k"] or min(options["top_k"]) < 1:
+            raise CommandError("--top-k needs positive values")
+
+        dataset = load_dataset(options["dataset"])
+        models = options["embedding_models"] or [embedding_model_name()]
+        configs = []
+        for model, size, overlap, m, ef_construction, ef_search in itertools.product(
+                models, options["chunk_sizes"], options["chunk_overlaps"], options["hnsw_m"],
+                options["hnsw_ef_construction"], options["hnsw_ef_search"]):
+            if overlap >= size:
+                self.stderr.write(f"Skipping chunk_size={size} chunk_overlap={overlap}, the overlap must be smaller")
+                continue
+            configs.append({"embedding_model": model, "chunk_size": size, "chunk_overlap": overlap,
+                            "hnsw": {"M": m, "construction_ef": ef_construction, "search_ef": ef_search}})
+        if not configs:
+            raise CommandError("No configuration to evaluate")
+
+        self.stdout.write(f"{len(dataset['documents'])} documents, {len(dataset['questions'])} questions, "
+                          f"{len(configs)} configurations, embedding backend {embedding_backend()}")
+
+        def progress(config):
+            self.stdout.write(f"  done: {config['embedding_model']} size={config['chunk_size']} "
+                              f"overlap={config['chunk_overlap']} hnsw={config['hnsw']}")
+
+        rows = evaluate(dataset, configs, sorted(set(options["top_k"])), options["modes"], progress=progress)
+        self.stdout.write("")
+        self.stdout.write(format_table(rows))
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({"dataset": options["dataset"], "rows": rows}, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {len(rows)} rows to {options['output']}"))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from research.indexing import rebuild_index
+from research.models import Chunk, Document
+
+
+class Command(BaseCommand):
+    help = "Recreate the vector db collections from the stored Document/Chunk rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--collection",
+            help="only rebuild this collection (default: every tenant's collection)",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        documents = Document.objects.all()
+        if options["collection"]:
+            documents = documents.filter(collection=options["collection"])
+        chunks = Chunk.objects.filter(document__in=documents).count()
+        self.stdout.write(f"Rebuilding from {documents.count()} documents, {chunks} chunks")
+
+        def progress(stage, done, total):
+            self.stdout.write(f"  {stage}: {done}/{total}")
+
+        rebuilt = rebuild_index(progress=progress, collection_name=options["collection"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {rebuilt['chunks']} chunks into {rebuilt['collections']} collections "
+            f"in {time.perf_counter() - start:.1f}s"
+        ))
@@ -0,0 +1,36 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from research.jobs import DEFAULT_POLL_INTERVAL, IngestionWorkerPool
+
+
+class Command(BaseCommand):
+    help = "Process queued document uploads (extraction, chunking, embedding) until stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=getattr(settings, "INGEST_WORKERS", 2),
+            help="number of worker threads",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=getattr(settings, "INGEST_POLL_INTERVAL", DEFAULT_POLL_INTERVAL),
+            help="seconds to wait between checks when the queue is empty",
+        )
+
+    def handle(self, *args, **options):
+        pool = IngestionWorkerPool(workers=options["workers"], poll_interval=options["poll_interval"])
+        # jobs a previous run left half done are requeued by start()
+        pool.start()
+        self.stdout.write(self.style.SUCCESS(f"Started {options['workers']} ingestion workers, Ctrl+C to stop"))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping, running jobs finish first...")
+            pool.stop()
@@ -0,0 +1,239 @@
+import itertools
+import json
+import os
+import tempfile
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from research.exact_index import ExactVectorStore
+from research.vector_store import ChromaVectorStore, chroma_store, collection_name, hnsw_metadata, hnsw_settings
+
+# HNSW PARAMETER SWEEP
+# builds chroma's hnsw index over a collection's stored vectors for every (M, construction_ef,
+# search_ef) combination and compares its results with the exact brute force top k
+# (research/exact_index.py). chroma reads search_ef when it loads an index, so every combination
+# gets its own build, build time only depends on M and construction_ef. per combination:
+#   build s    seconds to insert every vector (the index is written to disk once, at the end)
+#   index MB   MEASURED size of the hnsw index: the sweep builds in a temporary PersistentClient that
+#              writes the whole index out after the last insert, and the files of the collection's
+#              hnsw segment directory (vectors, level-0 links, upper level links, id maps) are summed.
+#              hnswlib holds the same arrays in memory, chroma's sqlite metadata is not in it
+#   est MB     the same size estimated from hnswlib's layout, kept to compare with: per vector the
+#              floats, 2 * M level-0 links and its label, plus M links on the 1 / (M - 1) upper levels
+#              a node has on average
+#   p50 / p95  per query latency of a search through ChromaVectorStore (metadata decoding included)
+#   recall@k   share of the exact top k the index returned, averaged over the queries
+# the queries are stored chunks held out of the index, so they look like real questions'
+# vectors without being trivially found. the recommendation is the fastest combination (p95)
+# that reaches --target-recall.
+
+DEFAULT_M = [8, 16, 32]
+DEFAULT_CONSTRUCTION_EF = [64, 128]
+DEFAULT_SEARCH_EF = [16, 32, 64, 128]
+
+
+def _csv_ints(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def load_vectors(name: str):
+    """
+    ids and float32 vectors of every chunk stored in a chroma collection
+    """
+    ids, vectors = [], []
+    for batch_ids, _, embeddings, _ in chroma_store(name).iter_rows():
+        ids.extend(batch_ids)
+        vectors.append(np.asarray(embeddings, dtype=np.float32))
+    if not ids:
+        return ids, np.zeros((0, 0), dtype=np.float32)
+    return ids, np.concatenate(vectors)
+
+
+def synthetic_vectors(count: int, dimension: int, seed: int):
+    # random vectors are the hardest case for hnsw, real embeddings cluster and reach a recall sooner
+    vectors = np.random.default_rng(seed).standard_normal((count, dimension)).astype(np.float32)
+    return [f"synthetic-{i}" for i in range(count)], vectors
+
+
+def estimated_index_bytes(count: int, dimension: int, m: int) -> int:
+    """
+    estimated bytes of an hnsw index from hnswlib's layout, not a measurement
+    """
+    level0 = 2 * m * 4 + 4 + dimension * 4 + 8
+    upper = (m * 4 + 4) / max(m - 1, 1)
+    return int(count * (level0 + upper))
+
+
+def directory_bytes(path: str) -> int:
+    """
+    total size of the files under a directory
+    """
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def recommend(rows: List[Dict], target_recall: float) -> Optional[Dict]:
+    """
+    the fastest row (p95, then build time, then memory) with at least target_recall, None if no row gets there
+    """
+    good = [row for row in rows if row["recall"] >= target_recall]
+    if not good:
+        return None
+    return min(good, key=lambda row: (row["p95_ms"], row["build_s"], row["index_bytes"]))
+
+
+def sweep(ids: List[str], vectors: np.ndarray, queries: np.ndarray, top_k: int, ms: List[int],
+          construction_efs: List[int], search_efs: List[int], progress=None) -> List[Dict]:
+    import chromadb
+
+    # the exact answer every hnsw configuration is measured against
+    exact = ExactVectorStore("tune_hnsw")
+    exact.append(ids, ids, vectors, [{}] * len(ids))
+    truth = [{result["id"] for result in exact.search(query, top_k=top_k)} for query in queries]
+
+    # a client on disk so the index size can be measured, every collection gets its own segment directory
+    workdir = tempfile.TemporaryDirectory(prefix="tune_hnsw_")
+    client = chromadb.PersistentClient(path=workdir.name)
+    rows = []
+    try:
+        for m, construction_ef, search_ef in itertools.product(ms, construction_efs, search_efs):
+            params = {"M": m, "construction_ef": construction_ef, "search_ef": search_ef}
+            row = _sweep_one(client, workdir.name, params, ids, vectors, queries, truth, top_k)
+            rows.append(row)
+            if progress:
+                progress(row)
+    finally:
+        workdir.cleanup()
+    return rows
+
+
+def _sweep_one(client, path: str, params: Dict, ids: List[str], vectors: np.ndarray, queries: np.ndarray,
+               truth: List[set], top_k: int) -> Dict:
+    metadata = hnsw_metadata(params)
+    # chroma writes the index out every sync_threshold inserts, so with one per vector the whole index
+    # is on disk right after the last insert and not only the part before the last sync
+    metadata["hnsw:sync_threshold"] = max(len(ids), 2)
+    existing = set(os.listdir(path))
+    collection = client.create_collection(f"tune_hnsw_{uuid.uuid4().hex[:12]}", metadata=metadata)
+    try:
+        start = time.perf_counter()
+        for offset in range(0, len(ids), 1000):
+            collection.add(ids=ids[offset:offset + 1000], documents=ids[offset:offset + 1000],
+                           embeddings=vectors[offset:offset + 1000])
+        build_seconds = time.perf_counter() - start
+        # the new directory next to chroma.sqlite3 is this collection's hnsw segment
+        measured = sum(directory_bytes(os.path.join(path, name)) for name in set(os.listdir(path)) - existing
+                       if os.path.isdir(os.path.join(path, name)))
+        store = ChromaVectorStore(collection)
+        # the first query warms the index, it is not timed
+        store.search(queries[0], top_k=top_k)
+        latencies, recalls = [], []
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            found = store.search(query, top_k=top_k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            recalls.append(len(expected & {result["id"] for result in found}) / len(expected))
+    finally:
+        client.delete_collection(collection.name)
+    row = dict(params)
+    row.update({
+        "build_s": round(build_seconds, 3),
+        "index_bytes": measured,
+        "est_index_bytes": estimated_index_bytes(len(ids), vectors.shape[1], params["M"]),
+        "p50_ms": round(percentile(latencies, 0.5), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "recall": round(float(np.mean(recalls)), 4),
+    })
+    return row
+
+
+class Command(BaseCommand):
+    help = ("Sweep chroma's hnsw parameters over a collection, measure build time, index size on disk, latency "
+            "and recall against exact search, and recommend a configuration for a target recall")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--collection", help="collection whose vectors are used (default: the shared one)")
+        parser.add_argument("--synthetic", type=int, metavar="COUNT",
+                            help="use COUNT random vectors instead of a stored collection")
+        parser.add_argument("--dimension", type=int, default=384, help="dimension of the --synthetic vectors")
+        parser.add_argument("--queries", type=int, default=200, help="chunks held out of the index as queries")
+        parser.add_argument("--top-k", type=int, default=10)
+        parser.add_argument("--m", type=_csv_ints, default=DEFAULT_M, help="comma separated, e.g. 8,16,32")
+        parser.add_argument("--construction-ef", type=_csv_ints, default=DEFAULT_CONSTRUCTION_EF)
+        parser.add_argument("--search-ef", type=_csv_ints, default=DEFAULT_SEARCH_EF)
+        parser.add_argument("--target-recall", type=float, default=0.95)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="also write the rows and the recommendation as json to this file")
+
+    def handle(self, *args, **options):
+        name = options["collection"] or collection_name()
+        if options["synthetic"]:
+            ids, vectors = synthetic_vectors(options["synthetic"], options["dimension"], options["seed"])
+            source = f"{len(ids)} synthetic {options['dimension']}-d vectors"
+        else:
+            ids, vectors = load_vectors(name)
+            source = f"collection '{name}'"
+        # at most a fifth of the corpus is held out, the rest is indexed
+        query_count = min(options["queries"], len(ids) // 5)
+        if query_count < 1:
+            raise CommandError(f"{source} has {len(ids)} chunks, too few to hold out queries")
+        if not options["m"] or not options["construction_ef"] or not options["search_ef"]:
+            raise CommandError("--m, --construction-ef and --search-ef need at least one value")
+
+        held_out = np.random.default_rng(options["seed"]).choice(len(ids), size=query_count, replace=False)
+        keep = np.ones(len(ids), dtype=bool)
+        keep[held_out] = False
+        queries = vectors[held_out]
+        ids = [chunk_id for chunk_id, kept in zip(ids, keep) if kept]
+        vectors = vectors[keep]
+        top_k = min(options["top_k"], len(ids))
+        self.stdout.write(f"{source}: {len(ids)} vectors indexed, {query_count} held out as queries, top_k {top_k}")
+
+        def progress(row):
+            self.stdout.write(f"  M={row['M']} construction_ef={row['construction_ef']} search_ef={row['search_ef']}: "
+                              f"built in {row['build_s']:.1f}s, recall {row['recall']:.3f}")
+
+        rows = sweep(ids, vectors, queries, top_k, options["m"], options["construction_ef"], options["search_ef"],
+                     progress=progress)
+
+        header = (f"{'M':>4}{'constr_ef':>11}{'search_ef':>11}{'build s':>9}{'index MB':>10}{'est MB':>8}"
+                  f"{'p50 ms':>9}{'p95 ms':>9}{f'recall@{top_k}':>11}")
+        self.stdout.write("")
+        self.stdout.write(header)
+        self.stdout.write("-" * len(header))
+        for row in rows:
+            self.stdout.write(f"{row['M']:>4}{row['construction_ef']:>11}{row['search_ef']:>11}{row['build_s']:>9.2f}"
+                              f"{row['index_bytes'] / 1e6:>10.1f}{row['est_index_bytes'] / 1e6:>8.1f}"
+                              f"{row['p50_ms']:>9.3f}{row['p95_ms']:>9.3f}{row['recall']:>11.3f}")
+        self.stdout.write("(index MB is the measured size of the hnsw segment files, "
+                          "est MB the same computed from hnswlib's layout)")
+
+        best = recommend(rows, options["target_recall"])
+        current = hnsw_settings(name)
+        self.stdout.write(f"\ncurrent settings for '{name}': {current}")
+        if best is None:
+            top = max(rows, key=lambda row: row["recall"])
+            self.stdout.write(self.style.WARNING(
+                f"no configuration reached recall {options['target_recall']}, the best was {top['recall']:.3f} "
+                f"(M={top['M']} construction_ef={top['construction_ef']} search_ef={top['search_ef']}), "
+                f"try larger values"))
+        else:
+            params = {key: best[key] for key in ("M", "construction_ef", "search_ef")}
+            self.stdout.write(self.style.SUCCESS(
+                f"recommended for recall@{top_k} >= {options['target_recall']}: {params} "
+                f"(recall {best['recall']:.3f}, p95 {best['p95_ms']:.2f} ms, build {best['build_s']:.1f}s)"))
+            self.stdout.write(f"    RAG_HNSW_COLLECTIONS = {{{name!r}: {params!r}}}")
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({"source": source, "vectors": len(ids), "dimension": int(vectors.shape[1]), "top_k": top_k,
+                           "target_recall": options["target_recall"], "rows": rows, "recommended": best}, f, indent=2)
+            self.stdout.write(f"Wrote {len(rows)} rows to {options['output']}")
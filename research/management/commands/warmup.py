@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from research.model_registry import registry
+from research.vector_store import get_collection
+
+
+class Command(BaseCommand):
+    help = "Load the RAG models, libraries and vector store now instead of on the first request"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--models",
+            nargs="+",
+            help="only warm these registered models (default: all of them)",
+        )
+        parser.add_argument(
+            "--probe",
+            action="store_true",
+            help="run a tiny inference on every model after loading it",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+
+        # open the vector store so chromadb is imported and the collection is ready
+        collection = get_collection()
+        self.stdout.write(f"Vector store ready: '{collection.name}' with {collection.count()} chunks")
+
+        # langchain is only imported by the chunker, pull it in now too
+        from langchain.text_splitter import RecursiveCharacterTextSplitter  # noqa: F401
+
+        stats = registry.warm_up(options["models"])
+        failed = []
+        for name, info in stats.items():
+            if info.get("loaded"):
+                self.stdout.write(
+                    f"  {name}: loaded in {info['load_time_s']}s, "
+                    f"+{info['rss_delta_bytes'] / 1e6:.0f}MB resident"
+                )
+            else:
+                failed.append(name)
+                self.stderr.write(f"  {name}: not loaded {info.get('error', '')}")
+
+        if options["probe"]:
+            report = registry.health(probe=True)
+            for name, info in report["models"].items():
+                self.stdout.write(f"  {name} probe: {info.get('probe', 'skipped')}")
+
+        elapsed = time.perf_counter() - start
+        # non zero exit so deploy scripts notice a worker that would fail its first request
+        if failed:
+            raise CommandError(f"Warm up failed for: {', '.join(failed)} ({elapsed:.2f}s)")
+        self.stdout.write(self.style.SUCCESS(f"Warm up finished in {elapsed:.2f}s"))
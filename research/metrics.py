@@ -0,0 +1,139 @@
+import bisect
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# METRICS
+# small in-process histograms, shared by the parts of the pipeline that need to report distributions
+# (batch sizes, queue waits, stage latencies). buckets are cumulative upper bounds like prometheus uses.
+# histograms with the same name and different labels ({"stage": "retrieve"}) form one metric family,
+# render_prometheus() writes every family in the prometheus text format for /rag/metrics/.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 384, 512, 1024, 2048)
+
+
+class Histogram:
+    """
+    counts observations per bucket and keeps a running sum, safe to observe from any thread
+    """
+
+    def __init__(self, name: str, buckets: Sequence[float] = LATENCY_BUCKETS, help_text: str = "",
+                 labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = dict(labels or {})
+        self.buckets = tuple(sorted(buckets))
+        # one extra slot for observations above the last bucket (+Inf)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        approximate quantile, the upper bound of the bucket the q-th observation falls in
+        """
+        with self._lock:
+            if not self._count:
+                return 0.0
+            target = q * self._count
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+                running += count
+                if running >= target:
+                    return bound
+        return float("inf")
+
+    def cumulative_counts(self) -> List:
+        """
+        [(upper bound, observations <= bound), ...] ending with +Inf
+        """
+        return self.totals()[0]
+
+    def totals(self) -> Tuple[List, float, int]:
+        """
+        cumulative counts, sum and count read together, so the +Inf bucket always equals the count
+        """
+        with self._lock:
+            result = []
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+                running += count
+                result.append((bound, running))
+            return result, self._sum, self._count
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            count, total = self._count, self._sum
+        return {
+            "count": count,
+            "sum": round(total, 6),
+            "mean": round(total / count, 6) if count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bound): running for bound, running in self.cumulative_counts()},
+        }
+
+
+_histograms: Dict[Tuple, Histogram] = {}
+_histograms_lock = threading.Lock()
+
+
+def histogram(name: str, buckets: Sequence[float] = LATENCY_BUCKETS, help_text: str = "",
+              labels: Optional[Dict[str, str]] = None) -> Histogram:
+    """
+    get or create the process wide histogram with this name and labels
+    """
+    key = (name, tuple(sorted((labels or {}).items())))
+    with _histograms_lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram(name, buckets, help_text, labels)
+        return _histograms[key]
+
+
+def all_histograms() -> List[Histogram]:
+    with _histograms_lock:
+        return list(_histograms.values())
+
+
+def _label_text(labels: Dict[str, str]) -> str:
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped))
+
+
+def _bound_text(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def render_prometheus() -> str:
+    """
+    every histogram in the prometheus text exposition format (version 0.0.4)
+    """
+    families: Dict[str, List[Histogram]] = {}
+    for item in all_histograms():
+        families.setdefault(item.name, []).append(item)
+
+    lines = []
+    for name in sorted(families):
+        members = families[name]
+        lines.append(f"# HELP {name} {members[0].help_text or name}")
+        lines.append(f"# TYPE {name} histogram")
+        for item in sorted(members, key=lambda member: sorted(member.labels.items())):
+            cumulative, total, count = item.totals()
+            labels = _label_text(item.labels)
+            prefix = f"{labels}," if labels else ""
+            for bound, running in cumulative:
+                lines.append(f'{name}_bucket{{{prefix}le="{_bound_text(bound)}"}} {running}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {total!r}")
+            lines.append(f"{name}_count{suffix} {count}")
+    return "\n".join(lines) + "\n"
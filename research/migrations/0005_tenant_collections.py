@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research', '0004_document_fingerprint_chunk_vector_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='collection',
+            field=models.CharField(db_index=True, default='financial_documents', max_length=63),
+        ),
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='collection',
+            field=models.CharField(default='financial_documents', max_length=63),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='document',
+            constraint=models.UniqueConstraint(fields=('collection', 'fingerprint'), name='unique_document_per_collection'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research', '0005_tenant_collections'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='metadata',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,246 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from django.conf import settings
+
+# process wide model registry
+# every model the RAG needs (embedding model, generator) is registered here once with a loader function.
+# the loader only runs the first time somebody asks for the model, after that every request and every
+# thread gets the same object back instead of loading it from disk again.
+
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+DEFAULT_GENERATION_MODEL = "google/flan-t5-base"
+# small cpu cross-encoder that scores (question, chunk) pairs for the optional rerank stage
+DEFAULT_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+def _current_rss_bytes() -> int:
+    """
+    resident memory of this process in bytes, 0 if the platform does not tell us
+    """
+    try:
+        # linux: second field of statm is resident pages
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        # fallback for macos, ru_maxrss is peak rss (bytes on mac, kb on linux) but better than nothing
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except Exception:
+        return 0
+
+
+def _parameter_bytes(model: Any) -> int:
+    """
+    size of the weights of a torch model (or a hugging face pipeline wrapping one), 0 if unknown
+    """
+    torch_model = getattr(model, "model", model)
+    parameters = getattr(torch_model, "parameters", None)
+    if parameters is None:
+        return 0
+    try:
+        return sum(p.numel() * p.element_size() for p in parameters())
+    except Exception:
+        return 0
+
+
+class ModelRegistry:
+    """
+    lazily loads models on first use and shares them across requests and threads.
+    keeps load time and memory stats for every model so we can see what each one costs.
+    """
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._probes: Dict[str, Callable[[Any], Any]] = {}
+        # optional models (the reranker) are only warmed up when their setting turns them on
+        self._enabled: Dict[str, Callable[[], bool]] = {}
+        self._models: Dict[str, Any] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        # one lock per model so loading the generator does not block someone who only needs embeddings
+        self._locks: Dict[str, threading.Lock] = {}
+        self._registry_lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[[], Any], probe: Optional[Callable[[Any], Any]] = None,
+                 enabled: Optional[Callable[[], bool]] = None):
+        """
+        register a loader (and optionally a tiny health probe) under a name, nothing is loaded yet.
+        enabled tells warm_up whether the model is in use at all
+        """
+        with self._registry_lock:
+            self._loaders[name] = loader
+            if probe is not None:
+                self._probes[name] = probe
+            if enabled is not None:
+                self._enabled[name] = enabled
+            self._locks.setdefault(name, threading.Lock())
+            self._stats.setdefault(name, {"loaded": False})
+
+    def get(self, name: str) -> Any:
+        """
+        return the model, loading it the first time. concurrent callers wait for the same load.
+        """
+        # fast path, no locking once the model is loaded
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        if name not in self._loaders:
+            raise KeyError(f"No model registered under '{name}'")
+
+        with self._locks[name]:
+            # another thread may have finished loading while we waited for the lock
+            model = self._models.get(name)
+            if model is not None:
+                return model
+
+            rss_before = _current_rss_bytes()
+            start = time.perf_counter()
+            try:
+                model = self._loaders[name]()
+            except Exception as e:
+                self._stats[name] = {"loaded": False, "error": str(e)}
+                raise
+            load_time = time.perf_counter() - start
+
+            self._stats[name] = {
+                "loaded": True,
+                "load_time_s": round(load_time, 3),
+                # how much the process grew while loading, this is what the model really costs us
+                "rss_delta_bytes": max(_current_rss_bytes() - rss_before, 0),
+                "parameter_bytes": _parameter_bytes(model),
+                "loaded_at": time.time(),
+            }
+            self._models[name] = model
+            print(f"Loaded model '{name}' in {load_time:.2f}s")
+            return model
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def warm_up(self, names: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        load the given models (default: all registered ones that are enabled) ahead of the first request
+        """
+        if not names:
+            names = [name for name in self._loaders if self._enabled.get(name, lambda: True)()]
+        for name in list(names):
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"Warm up failed for model '{name}': {e}")
+        return self.stats()
+
+    def health(self, probe: bool = False) -> Dict[str, Any]:
+        """
+        report which models are loaded, optionally running a tiny inference on each loaded model
+        """
+        models = self.stats()
+        healthy = True
+        for name, info in models.items():
+            if info.get("error"):
+                healthy = False
+            if probe and name in self._models and name in self._probes:
+                start = time.perf_counter()
+                try:
+                    self._probes[name](self._models[name])
+                    info["probe"] = "ok"
+                except Exception as e:
+                    info["probe"] = f"failed: {e}"
+                    healthy = False
+                info["probe_time_s"] = round(time.perf_counter() - start, 3)
+        return {
+            "status": "ok" if healthy else "error",
+            "rss_bytes": _current_rss_bytes(),
+            "models": models,
+        }
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: dict(info) for name, info in self._stats.items()}
+
+    def unload(self, name: str):
+        """
+        drop a model so the next get() loads it again (mostly for tests)
+        """
+        with self._locks.get(name, self._registry_lock):
+            self._models.pop(name, None)
+            if name in self._stats:
+                self._stats[name] = {"loaded": False}
+
+
+def embedding_model_name() -> str:
+    return getattr(settings, "RAG_EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL)
+
+
+def generation_model_name() -> str:
+    return getattr(settings, "RAG_GENERATION_MODEL", DEFAULT_GENERATION_MODEL)
+
+
+def rerank_model_name() -> str:
+    return getattr(settings, "RAG_RERANK_MODEL", DEFAULT_RERANK_MODEL)
+
+
+def rerank_enabled() -> bool:
+    return getattr(settings, "RAG_RERANK_ENABLED", False)
+
+
+def _load_embedding_model():
+    # imported here so importing this module never pulls in torch
+    from research.inference_backends import embedding_backend, load_embedding_model
+    # fp32 pytorch, int8 or onnx depending on RAG_EMBEDDING_BACKEND / RAG_INFERENCE_BACKEND
+    return load_embedding_model(embedding_model_name(), embedding_backend())
+
+
+def _load_generator():
+    from research.inference_backends import generation_backend, load_generator
+    # this is a free model that does not require api keys
+    return load_generator(generation_model_name(), generation_backend())
+
+
+def _load_tokenizer():
+    from research.inference_backends import generation_backend
+    if generation_backend() == "stub":
+        # the stub generator counts words
+        from research.context_packing import WordTokenizer
+        return WordTokenizer()
+    from transformers import AutoTokenizer
+    # the generator's own tokenizer, prompts are measured in the tokens the model really reads
+    return AutoTokenizer.from_pretrained(generation_model_name())
+
+
+def _load_reranker():
+    from sentence_transformers import CrossEncoder
+    # runs on the cpu next to the generator, it only ever sees a few dozen short pairs per question
+    return CrossEncoder(rerank_model_name(), device="cpu")
+
+
+registry = ModelRegistry()
+registry.register("embedding", _load_embedding_model, probe=lambda model: model.encode("health check"))
+registry.register("generator", _load_generator, probe=lambda generator: generator("health check", max_new_tokens=1))
+registry.register("tokenizer", _load_tokenizer, probe=lambda tokenizer: tokenizer.encode("health check"))
+registry.register("reranker", _load_reranker, probe=lambda model: model.predict([("health", "check")]),
+                  enabled=rerank_enabled)
+
+
+def get_embedding_model():
+    return registry.get("embedding")
+
+
+def get_generator():
+    return registry.get("generator")
+
+
+def get_tokenizer():
+    # the generator pipeline carries the same tokenizer, no second copy once it is loaded
+    if registry.is_loaded("generator"):
+        return get_generator().tokenizer
+    return registry.get("tokenizer")
+
+
+def get_reranker():
+    return registry.get("reranker")
@@ -7,13 +7,24 @@ class Document(models.Model):
     company = models.CharField(max_length=200)
     doc_type = models.CharField(max_length=50)
     date_filed = models.DateTimeField(default=timezone.now) 
-    content = models.TextField()
+    # empty for uploads indexed as a stream, their text lives in the chunks
+    content = models.TextField(blank=True)
+    # hash that the chunk ids in the vector db are built from, the same upload always gets the same one
+    fingerprint = models.CharField(max_length=64, blank=True, null=True)
+    # vector db collection of the tenant that uploaded it
+    collection = models.CharField(max_length=63, default='financial_documents', db_index=True)
     source_url = models.URLField(blank=True, null=True)
     chunks_generated = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     metadata = models.JSONField(blank=True, null=True)
 
+    class Meta:
+        # the same file uploaded by two tenants is two documents
+        constraints = [
+            models.UniqueConstraint(fields=['collection', 'fingerprint'], name='unique_document_per_collection'),
+        ]
+
     def __str__(self):
         return f'{self.company} - {self.title}'
 
@@ -21,9 +32,60 @@ class Chunk(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='chunks')
     chunk_index = models.IntegerField()
     content= models.TextField()
+    # id of this chunk in the vector db, the index can be rebuilt from the rows
+    vector_id = models.CharField(max_length=64, blank=True, db_index=True)
     embedding_generated = models.BooleanField(default=False)
     metadata = models.JSONField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # a resumed ingest inserts the same chunks again, the duplicates are skipped
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'chunk_index'], name='unique_chunk_per_document'),
+        ]
+
+    def __str__(self):
+        return f'{self.document.title} - Chunk {self.chunk_index}'
+
+class IngestionJob(models.Model):
+    """
+    one uploaded file waiting for / going through extraction, cleaning, chunking and embedding.
+    the table is the queue: workers claim queued rows, so jobs survive restarts without a broker.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    original_name = models.CharField(max_length=255)
+    file_path = models.CharField(max_length=500)
+    # collection the document goes into, the uploader's tenant
+    collection = models.CharField(max_length=63, default='financial_documents')
+    # company / doc_type / date_filed given with the upload, copied into every chunk's metadata
+    metadata = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    stage = models.CharField(max_length=20, default='pending')
+    # per stage progress, e.g. {"extracting": {"done": 3, "total": 3}, "embedding": {"done": 128, "total": 400}}
+    progress = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(blank=True, null=True)
+    document = models.ForeignKey(Document, on_delete=models.SET_NULL, blank=True, null=True,
+                                 related_name='ingestion_jobs')
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
     def __str__(self):
-        return f'{self.document.title} - Chunk {self.chunk_index}'
\ No newline at end of file
+        return f'{self.original_name} - {self.status}'
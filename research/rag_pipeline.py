@@ -1,23 +1,29 @@
-import os
+import queue
 import time
-from typing import List, Dict, Any
-import chromadb
-from sentence_transformers import SentenceTransformer
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import numpy as np
-from research.models import Document
-from transformers import pipeline
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import List, Dict, Iterable, Iterator, Tuple
+from research.model_registry import get_generator, rerank_enabled
+from research.embeddings import embed_texts, embed_query
+from research.vector_store import get_collection, corpus_version
+from research.answer_cache import get_answer_cache
+from research.batching import get_generation_batcher
+from research.executor import StageTimeout, get_executor
+from research.inference_backends import stream_generate
+from research.filters import date_timestamp
+from research.lexical_index import get_lexical_index
+from research.rerank import get_rerank_stage, rerank_candidates
+from research.context_packing import count_tokens, pack_context, prompt_max_tokens
+from research.tracing import observe_stage, stage
+from contextlib import contextmanager
+from django.conf import settings
 import re
+import json
+import hashlib
 
-# global hugging face pipeline(used for generate response)
-
-# create text generation pipeline using a hugging face
-generator = pipeline(
-     # this model receives text and returns text
-    task="text2text-generation",
-    # this is a free model that does not require api keys
-    model="google/flan-t5-base"
-)
+# the embedding model and the hugging face generator live in research/model_registry.py,
+# they are loaded once on first use and shared by every request instead of being rebuilt per call.
+# heavy libraries (torch, transformers, sentence_transformers, chromadb, langchain) are only imported
+# inside the functions that need them, so manage.py commands and worker boot stay fast.
 
 # to clean the text from whitespaces and newlines with a single space
 def clean_text(text):
@@ -33,91 +39,233 @@ def clean_response(response: str) -> str:
 
 # DOC LOADING AND CHUNKING
 
-def chunk_documents(documents: List[Dict], chunk_size: int = 300, chunk_overlap: int = 50) -> List[Dict]:
+def content_hash(text: str) -> str:
     """
-    Load documents and chunk them into pieces
-    chunk size is 500words, with an overlap of 50words
+    stable id for a piece of text, the same text always gives the same id
+    so uploading the same document twice does not store it twice
     """
-    # import the document #REMOVED SINCE WE DONT WANT TO SAVE DOCS TO DB
-    # documents = Document.objects.all()
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# the streaming splitter works on a window of this many chunks worth of text at a time
+STREAM_WINDOW_CHUNKS = 64
+
+def _text_splitter(chunk_size: int, chunk_overlap: int):
+    # imported here so importing the pipeline (and so the views and urls) does not pull in langchain
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
 
     # the structure of how my splitting is designed
-    text_splitter = RecursiveCharacterTextSplitter(
+    return RecursiveCharacterTextSplitter(
         chunk_size = chunk_size,
         chunk_overlap = chunk_overlap,
         # we are defining how chunk is measured and its by len, token is also an option
         length_function = len,
         # "\n\n" is paragraphs, "\n" is lines, " " is words, "" is characters
-        separators = ["\n\n", "\n", " ", ""])
-    
-    all_chunks = []
+        separators = ["\n\n", "\n", " ", ""],
+        # chunks keep the whitespace in front of them, split_text_stream needs their exact start
+        # to carry text over between windows and strips them itself
+        strip_whitespace = False)
 
-    for doc_index, doc in enumerate(documents):
-        chunks = text_splitter.split_text(clean_text(doc["content"]))
-        for i, chunk in enumerate(chunks):
-            all_chunks.append({
-                "document_id": doc_index,
-                "chunk_index": i,
-                "content": chunk,
-                "metadata": {
-                    "title": doc["title"],
-                    "company": doc["company"],
-                    "doc_type": doc["doc_type"],
-                    "date_filed": str(doc["date_filed"])
-                }
-            })
-    return all_chunks
+def _normalize(text: str, after_space: bool) -> Tuple[str, bool]:
+    """
+    clean_text for one piece of a stream, without the strip. after_space tells that the previous piece
+    ended in whitespace, then the whitespace this piece starts with is the same run and was already
+    turned into its space. returns the cleaned piece and whether the piece itself ends in whitespace
+    """
+    if not text:
+        return "", after_space
+    ends_in_space = text[-1].isspace()
+    if after_space:
+        text = text.lstrip()
+    text = re.sub(r'\s+', ' ', text)
+    return re.sub(r'[^\x00-\x7F]+', '', text), ends_in_space
 
-# VECTOR DB SETUP
+def split_text_stream(pieces: Iterable[str], chunk_size: int = 300, chunk_overlap: int = 50) -> Iterator[str]:
+    """
+    split a stream of text pieces (file blocks, pdf pages) into chunks without joining the whole text.
+    every piece is cleaned once as it arrives, giving the same text as clean_text on the joined pieces.
+    the text is split a window at a time, the last chunks of every window depend on the word cut by the
+    window edge so they are carried over and split again with the next text. the chunks are the ones
+    the splitter gives for the whole clean_text output at once
+    """
+    text_splitter = _text_splitter(chunk_size, chunk_overlap)
+    window = chunk_size * STREAM_WINDOW_CHUNKS
+    buffer = ""
+    after_space = False
+    started = False
+    for piece in pieces:
+        # a very large piece (a whole document) is fed in window sized slices
+        for start in range(0, len(piece), window):
+            text, after_space = _normalize(piece[start:start + window], after_space)
+            # carried over text is already clean, only the new text is appended to it.
+            # the start of the document is stripped like clean_text does, carried text keeps its whitespace
+            buffer = buffer + text if started else text.lstrip()
+            started = started or bool(buffer)
+            if len(buffer) < 2 * window:
+                continue
+            chunks = text_splitter.split_text(buffer)
+            if len(chunks) < 3:
+                continue
+            # the word cut by the window edge changes where the last chunk starts (the splitter decides its
+            # overlap by the length of the next word), the chunk before it only depends on whole words.
+            # so everything before that chunk is final, and the text is carried over from its exact start
+            # (its leading whitespace included), where the splitter continues when it sees the whole text
+            carry, carry_start = _carry_point(buffer, chunks, chunk_overlap)
+            yield from _stripped(chunks[:carry])
+            if carry_start < 0:
+                yield from _stripped(chunks[carry:])
+                buffer = ""
+            else:
+                buffer = buffer[carry_start:]
+    # the end of the document is stripped like clean_text does
+    buffer = buffer.rstrip()
+    if buffer:
+        yield from _stripped(text_splitter.split_text(buffer))
+
+def _chunk_starts(text: str, chunks: List[str], chunk_overlap: int) -> List[int]:
+    # where every chunk starts in text, each one is looked for after the end of the one before it
+    # less the overlap (how the splitter's add_start_index finds them). -1 once one is not found
+    starts = []
+    start, previous_length = 0, 0
+    for chunk in chunks:
+        if start >= 0:
+            start = text.find(chunk, max(0, start + previous_length - chunk_overlap))
+        starts.append(start)
+        previous_length = len(chunk)
+    return starts
+
+def _carry_point(text: str, chunks: List[str], chunk_overlap: int) -> Tuple[int, int]:
+    # the chunk split_text_stream carries over from and where it starts in text. a word longer than a chunk
+    # is cut into pieces on its own, text carried from inside it would be split differently, so the
+    # latest chunk before the last that starts at whitespace is taken (the second last if there is none)
+    starts = _chunk_starts(text, chunks, chunk_overlap)
+    for position in range(len(chunks) - 2, 0, -1):
+        if starts[position] > 0 and text[starts[position]].isspace():
+            return position, starts[position]
+    return len(chunks) - 2, starts[-2]
+
+def _stripped(chunks: List[str]) -> Iterator[str]:
+    # what the splitter returns with strip_whitespace on: chunks without outer whitespace, empty ones dropped
+    for chunk in chunks:
+        chunk = chunk.strip()
+        if chunk:
+            yield chunk
+
+# chunks with fewer letters and digits than this carry no information worth retrieving
+MIN_CHUNK_CHARS = 20
+# page furniture that repeats on every page of a filing
+BOILERPLATE_RE = re.compile(
+    r"^(table of contents|page \d+( of \d+)?|\d+|index to financial statements|"
+    r"this page (is )?intentionally (been )?left blank)$",
+    re.IGNORECASE)
+
+def is_indexable(chunk: str) -> bool:
+    """
+    false for chunks that are too short or only page boilerplate, they are never stored
+    so they cannot take a top_k slot away from a real hit
+    """
+    text = chunk.strip()
+    if sum(character.isalnum() for character in text) < MIN_CHUNK_CHARS:
+        return False
+    return not BOILERPLATE_RE.match(text.strip(" .-|"))
 
-# chunks is a list of dictionaries- each dictionary represents a doc chunk with content and metadata
-# https://docs.trychroma.com/docs/overview/getting-started is the chromadb docs
+def stream_chunks(doc: Dict, pieces: Iterable[str], document_id: str,
+                  chunk_size: int = 300, chunk_overlap: int = 50) -> Iterator[Dict]:
+    """
+    chunk dicts for one document whose text arrives as a stream of pieces,
+    doc gives the title/company/doc_type/date_filed metadata.
+    short and boilerplate chunks are skipped, chunk_index still counts them so ids stay stable
+    """
+    metadata = {
+        "title": doc["title"],
+        "company": doc["company"],
+        "doc_type": doc["doc_type"],
+        "date_filed": str(doc["date_filed"]),
+        "document_id": document_id,
+    }
+    # numeric copy of the filing date so date ranges can be filtered inside the vector search
+    date_filed_ts = date_timestamp(doc["date_filed"])
+    if date_filed_ts is not None:
+        metadata["date_filed_ts"] = date_filed_ts
+
+    for i, chunk in enumerate(split_text_stream(pieces, chunk_size, chunk_overlap)):
+        if not is_indexable(chunk):
+            continue
+        yield {
+            "id": content_hash(f"{document_id}:{i}:{chunk}"),
+            "document_id": document_id,
+            "chunk_index": i,
+            "content": chunk,
+            "metadata": dict(metadata, chunk_index=i)
+        }
 
-def vector_db(chunks: List[Dict]):
+def chunk_documents(documents: List[Dict], chunk_size: int = 300, chunk_overlap: int = 50) -> List[Dict]:
     """
-    Setup chromadb vector db and store doc chunks with embeddings
-    Everything that will ever be inputed into this RAG will nest itself into our chromadb called "financial_documents"
-    This is basically creating the brain of our RAG, this is the only data the RAG will ever generate responses off of.
+    Load documents and chunk them into pieces
+    chunk size is 300 characters, with an overlap of 50 characters
+    every chunk gets an "id" that is a hash of its document and its own text
     """
+    # import the document #REMOVED SINCE WE DONT WANT TO SAVE DOCS TO DB
+    # documents = Document.objects.all()
 
-    # initialize chromadb client
-    client = chromadb.Client()
+    all_chunks = []
 
-    # try to create a collection in chromadb called "financial_documents"
-    try:
-        # collection in chromadb is a table database that holds all your doc chunks and embeddings
-        collection = client.create_collection(
-            name="financial_documents",
-            # tells chroma to use cosine similarity for vector comparisons
-            metadata={"hnsw:space": "cosine"}
-        )
-    # if collection already exists just retrieve it 
-    except Exception:
-        collection = client.get_collection("financial_documents")
+    for doc in documents:
+        # the document id is a hash of its text so it stays the same across uploads and restarts
+        document_id = content_hash(clean_text(doc["content"]))[:16]
+        # the stream cleans the text itself, clean_text output would be cleaned a second time
+        all_chunks.extend(stream_chunks(doc, [doc["content"]], document_id, chunk_size, chunk_overlap))
+    return all_chunks
 
-    # initialize embedding model
-    # all-MiniLM-L6-v2 is the model that converts text into numeric vectors that captures semantic meaning
-    model = SentenceTransformer("all-MiniLM-L6-v2")
+# VECTOR DB SETUP
 
-    # convert chunk texts into numeric embeddings
-    # numpy tolist converts embeddings from arrays to plain lists
-    embeddings = [model.encode(chunk["content"]).tolist() for chunk in chunks]
+# chunks is a list of dictionaries- each dictionary represents a doc chunk with content and metadata
+# https://docs.trychroma.com/docs/overview/getting-started is the chromadb docs
 
-    # failsafe to prevent duplication
-    if collection.count() == 0:
-        # add chunks, embeddings, and metadata into chromadb collection
-        # collection.add stores ids, documents, embeddings, and metadata in one table
+def vector_db(chunks: List[Dict], collection_name: str = None):
+    """
+    store doc chunks with embeddings in chromadb, only embedding chunks the collection does not have yet
+    chunk ids are content hashes so a chunk that is already stored is skipped instead of re-encoded
+    collection_name picks the tenant's collection, the shared one by default
+    """
+    collection = get_collection(collection_name)
+
+    # drop duplicate ids inside this batch, keeps the first occurrence
+    seen_ids = set()
+    unique_chunks = []
+    for chunk in chunks:
+        if chunk["id"] in seen_ids:
+            continue
+        seen_ids.add(chunk["id"])
+        unique_chunks.append(chunk)
+    if not unique_chunks:
+        return collection
+
+    # failsafe to prevent duplication, ask the store which of these ids it already has
+    existing_ids = collection.existing_ids([chunk["id"] for chunk in unique_chunks])
+    new_chunks = [chunk for chunk in unique_chunks if chunk["id"] not in existing_ids]
+
+    if not new_chunks:
+        print(f"All {len(unique_chunks)} chunks already stored in '{collection.name}'")
+        return collection
+
+    # convert chunk texts into numeric embeddings in length sorted batches
+    # embeddings stay a float32 numpy array, chroma takes it as is
+    with stage("embed_chunks") as record:
+        embeddings = embed_texts([chunk["content"] for chunk in new_chunks])
+        record["chunks"] = len(new_chunks)
+
+    # add chunks, embeddings, and metadata into the collection (chroma, and the exact index mirroring it)
+    with stage("store") as record:
         collection.add(
-            ids=[f"{chunk['document_id']}_{chunk['chunk_index']}" for chunk in chunks],
-            documents=[chunk["content"] for chunk in chunks],
+            ids=[chunk["id"] for chunk in new_chunks],
+            documents=[chunk["content"] for chunk in new_chunks],
             embeddings=embeddings,
-            metadatas=[chunk["metadata"] for chunk in chunks]
+            metadatas=[chunk["metadata"] for chunk in new_chunks]
         )
-        # log how many chunks were stored
-        print(f"Stored {len(chunks)} chunks in ChromaDB collection '{collection.name}'")
-    else:
-        # if collection already has data, just report count
-        print(f"Collection already contains {collection.count()} chunks")
+        record["chunks"] = len(new_chunks)
+    # log how many chunks were stored
+    print(f"Stored {len(new_chunks)} new chunks in ChromaDB collection '{collection.name}' "
+          f"({len(existing_ids)} already present)")
 
     # return collection object for further usage
     return collection
@@ -129,13 +277,11 @@ def process_query(query: str):
     process user query and convert to embeddings(numbers) for vector search
     """
 
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-
     # lower cased and stripped to remove accidental whitespace. prevents embedding noise problems
     cleaned_query = query.lower().strip()
 
-    # this is what we will pass into chromadb
-    query_embedding = model.encode(cleaned_query)
+    # this is what we will pass into chromadb, a repeated question is served from the embedding cache
+    query_embedding = embed_query(cleaned_query)
 
     return query_embedding
 
@@ -143,72 +289,100 @@ def process_query(query: str):
 
 # the collection is the brain of the documents provided and the query_embedding is the numerical 
 # vector of the question asked. top_k controls how many chunks we retrieve. more chunks = more noise
-def search_vector(collection, query_embedding, top_k=3):
+def search_vector(collection, query_embedding, top_k=3, where=None):
     """
     this will search and compare query_embedding to every stored chunk embedding and rank them based on 
     cosine since we defined that. this function returns chunk text/metadata.
+    where (research/filters.py build_where) limits the search to chunks with matching metadata,
+    it is applied during the search so we still get top_k matching chunks back
     """
-    # search rag memory
-    results= collection.query(
-        # this is the meaning of the users question
-        query_embeddings= [query_embedding],
-        # give me the top_k results
-        n_results = top_k
-    )
-
-    docs_and_metadata = results
-
-
-    filtered = [
-        {"content": doc, "metadata": meta}
-        for doc, meta in zip(docs_and_metadata['documents'][0], docs_and_metadata['metadatas'][0])
-        if len(doc.strip()) > 20  # ignore very short chunks
-    ]
-
-    return filtered
-
-#  Context Augmentation
+    # search rag memory: chroma's hnsw index, or the exact in-process index for small collections
+    # (research/exact_index.py), both give back [{"id", "content", "metadata"}, ...] best first.
+    # short and boilerplate chunks were never indexed (is_indexable), nothing to drop here
+    return collection.search(query_embedding, top_k=top_k, where=where)
+
+# Lexical and hybrid search
+
+RETRIEVAL_MODES = ("dense", "lexical", "hybrid")
+# reciprocal rank fusion constant, bigger = ranks further down count relatively more
+RRF_K = 60
+# how many candidates each leg brings to the fusion, as a multiple of top_k
+HYBRID_CANDIDATES = 3
+
+def _chunks_by_id(collection_name: str, chunk_ids: List[str]) -> Dict[str, Dict]:
+    # text and metadata of chunks found by the lexical index, from the stored Chunk rows
+    from research.models import Chunk
+    rows = Chunk.objects.filter(document__collection=collection_name, vector_id__in=chunk_ids)
+    return {
+        vector_id: {"id": vector_id, "content": content, "metadata": metadata}
+        for vector_id, content, metadata in rows.values_list("vector_id", "content", "metadata")
+    }
+
+def search_lexical(collection_name: str, query: str, top_k=3, where=None) -> List[Dict]:
+    """
+    BM25 search over the collection's inverted index (research/lexical_index.py), same result format as search_vector
+    """
+    hits = get_lexical_index(collection_name).search(query, top_k, where)
+    found = _chunks_by_id(collection_name, [chunk_id for chunk_id, _ in hits])
+    return [found[chunk_id] for chunk_id, _ in hits if chunk_id in found]
 
-def augment_context(query: str, search_results: List[Dict]) -> str:
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> List[str]:
     """
-    Build an augmented prompt using retrieved document chunks.
-    The LLM will only answer using the provided context and say idk if it doesn't know.
+    merge several best-first id lists, every list adds 1 / (k + rank) to each id it contains.
+    only ranks are used, so bm25 scores and cosine distances never have to be put on one scale
     """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda chunk_id: -scores[chunk_id])
 
-    # fail safe incase we dont see any relevant info, we DONT generate an answer
-    # prevents hallucinations
-    if not search_results:
-        return (
-            "No relevant information found in the documents.\n\n"
-            f"Question: {query}\n\n"
-            "Answer: I don't know based on the provided documents."
-        )
-    
-    # each chunk that will be helpfull will be stored here
-    context_blocks = []
-    # creating a set so it doesnt repeat the same chunk over and over
-    seen_contents = set()
-
-    # loop through chunk and source them as: 
-    for i, result in enumerate(search_results, 1):
-        content = result['content'].strip()
-        if content in seen_contents:
-            continue  # skip duplicates
-        seen_contents.add(content)
-        context_blocks.append(
-            f"Source {i}:\n"
-            f"Company: {result['metadata']['company']}\n"
-            f"Document Type: {result['metadata']['doc_type']}\n"
-            f"Content:\n{content}"
-        )
+def retrieve(collection, query: str, query_embedding, top_k=3, where=None, mode="dense") -> List[Dict]:
+    """
+    dense: chroma cosine search, lexical: bm25 over exact tokens (tickers, line items, fiscal years),
+    hybrid: both, fused with reciprocal rank fusion
+    """
+    if mode == "dense":
+        return search_vector(collection, query_embedding, top_k=top_k, where=where)
+    if mode == "lexical":
+        return search_lexical(collection.name, query, top_k=top_k, where=where)
+
+    candidates = top_k * HYBRID_CANDIDATES
+    dense = search_vector(collection, query_embedding, top_k=candidates, where=where)
+    lexical_hits = get_lexical_index(collection.name).search(query, candidates, where)
+    fused = reciprocal_rank_fusion([[result["id"] for result in dense], [chunk_id for chunk_id, _ in lexical_hits]])[:top_k]
+
+    # dense hits already carry their text, only lexical-only hits are looked up
+    found = {result["id"]: result for result in dense}
+    missing = [chunk_id for chunk_id in fused if chunk_id not in found]
+    if missing:
+        found.update(_chunks_by_id(collection.name, missing))
+    return [found[chunk_id] for chunk_id in fused if chunk_id in found]
+
+def retrieval_mode(mode: str = None) -> str:
+    mode = mode or getattr(settings, "RAG_RETRIEVAL_MODE", "dense")
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {', '.join(RETRIEVAL_MODES)}")
+    return mode
+
+# Stage timings
+
+@contextmanager
+def timed(timings: Dict, name: str):
+    """
+    run the with block as a traced pipeline stage (research/tracing.py) and put its wall time,
+    in milliseconds, in timings[name]. yields the stage record for token and chunk counts
+    """
+    with stage(name) as record:
+        yield record
+    timings[name] = record["wall_ms"]
 
-    # Combines all chunk strings into 1 big block context section separated by blank lines
-    context = "\n\n".join(context_blocks)
+#  Context Augmentation
 
-    # this prompt is sent to the LLM, we tell it what it is(financial research assistant)
-    # we tell it the strict rules:
-    # force a grounded answer if it doesnt know:
-    augmented_prompt = f"""
+# this prompt is sent to the LLM, we tell it what it is(financial research assistant)
+# we tell it the strict rules:
+# force a grounded answer if it doesnt know:
+PROMPT_TEMPLATE = """
 You are a financial research assistant.
 
 RULES:
@@ -229,88 +403,300 @@ QUESTION:
 ANSWER:
 """
 
-    return augmented_prompt
+def format_source(number: int, block: Dict) -> str:
+    # one packed block (a chunk or several merged neighbours) with the source header the model sees
+    return (
+        f"Source {number}:\n"
+        f"Company: {block['metadata']['company']}\n"
+        f"Document Type: {block['metadata']['doc_type']}\n"
+        f"Content:\n{block['content']}"
+    )
+
+def pack_prompt(query: str, search_results: List[Dict]) -> Dict:
+    """
+    build the augmented prompt within RAG_PROMPT_MAX_TOKENS generator tokens (research/context_packing.py).
+    search_results are best first, the best ones are packed first and neighbouring chunks are merged.
+    returns {"prompt", "sources" (the results that made it in), "prompt_tokens", "context_tokens",
+    "dropped_tokens", "dropped_chunks", "merged_chunks"}
+    """
+    # fail safe incase we dont see any relevant info, we DONT generate an answer
+    # prevents hallucinations
+    if not search_results:
+        prompt = (
+            "No relevant information found in the documents.\n\n"
+            f"Question: {query}\n\n"
+            "Answer: I don't know based on the provided documents."
+        )
+        return {"prompt": prompt, "sources": [], "prompt_tokens": count_tokens(prompt), "context_tokens": 0,
+                "dropped_tokens": 0, "dropped_chunks": 0, "merged_chunks": 0}
+
+    # whatever the rules and the question leave of the model's input is the context budget,
+    # one token is kept for the </s> the tokenizer appends
+    fixed_tokens = count_tokens(PROMPT_TEMPLATE.format(context="", query=query)) + 1
+    packed = pack_context(search_results, max(prompt_max_tokens() - fixed_tokens, 0), format_source)
+
+    # Combines all chunk strings into 1 big block context section separated by blank lines
+    context = "\n\n".join(packed.pop("blocks"))
+    packed["prompt"] = PROMPT_TEMPLATE.format(context=context, query=query)
+    packed["prompt_tokens"] = fixed_tokens + packed["context_tokens"]
+    return packed
+
+def augment_context(query: str, search_results: List[Dict]) -> str:
+    """
+    Build an augmented prompt using retrieved document chunks.
+    The LLM will only answer using the provided context and say idk if it doesn't know.
+    only as many chunks as fit the model's input are included, see pack_prompt
+    """
+    return pack_prompt(query, search_results)["prompt"]
 
 
 # Response generation 
 
+# generation settings shared by the single prompt and the batched path
+GENERATION_KWARGS = {
+    "max_length": 512,
+    # give short answers, we want concise and to the point responses, not long essays
+    "max_new_tokens": 256,
+    # do sample FALSE means always pick the most likely next token and TRUE means allow for randomness and creativity so it will give you diff answer each times
+    "do_sample": False,
+    # low number means more focused and deterministic, high number means more creative but also more likely to hallucinate
+    "temperature": 0.1,
+}
+
+def generate_responses(augmented_prompts: List[str]) -> List[str]:
+    """
+    run several prompts through flan-t5 as one padded batch, one answer per prompt in the same order
+    """
+    # shared hugging face pipeline from the model registry
+    generator = get_generator()
+    outputs = generator(
+        augmented_prompts,
+        batch_size=len(augmented_prompts),
+        # prompts longer than the model's 512 input tokens are cut instead of failing the whole batch
+        truncation=True,
+        **GENERATION_KWARGS
+    )
+    # depending on the transformers version every item is a dict or a one element list of dicts
+    return [(item[0] if isinstance(item, list) else item)["generated_text"] for item in outputs]
+
 def generate_response(augmented_prompt: str) -> str:
     """
     generate a response using the free Hugging Face model.
     This is the real LLM step of the RAG pipeline.
+    with RAG_BATCHING_ENABLED the prompt goes through the micro-batching scheduler
+    (research/batching.py) and shares a forward pass with other questions asked at the same time.
     """
 
-    # create text generation pipeline using a hugging face
+    # the same deadline the executor gives the generate stage, a stalled batch must not hold this thread forever
+    timeout = get_executor().stage_timeouts.get("generate")
     try:
-        # call the model with controlled parameters
-        # we are sending the augmented prompt, max length, and temperature controls
-        # do_sample means enable sampling for varied outputs
-        # creativity, low value= more facts and is strict
-        output = generator(
-            augmented_prompt,
-            max_length=512,
-            # give short answers, we want concise and to the point responses, not long essays
-            max_new_tokens=256,
-            # do sample FALSE means always pick the most likely next token and TRUE means allow for randomness and creativity so it will give you diff answer each times
-            do_sample=False,
-            # low number means more focused and deterministic, high number means more creative but also more likely to hallucinate
-            temperature=0.1
-        )
-        # this will return a list, we will extract the 1st result
-        response = output[0]["generated_text"]
+        if getattr(settings, "RAG_BATCHING_ENABLED", True):
+            response = get_generation_batcher(generate_responses).generate(augmented_prompt, timeout=timeout)
+        else:
+            response = generate_responses([augmented_prompt])[0]
 
+    except FutureTimeout:
+        response = f"Error generating response: no answer within {timeout}s"
     # incase model doesnt load, network issues
     except Exception as e:
         response = f"Error generating response: {e}"
 
     return response
 
-def run_rag_pipeline(uploaded_docs: List[Dict], query: str, top_k: int = 3):
+def stream_response(augmented_prompt: str) -> Iterator[str]:
     """
-    Run the full RAG pipeline:
-    1. Load documents and chunk
-    2. Store chunks in ChromaDB
-    3. Convert query to embedding
-    4. Retrieve relevant chunks
-    5. Build augmented prompt
-    6. Generate response via Hugging Face
+    same generation as generate_response, but yields text pieces as the generator produces them
+    so the client can show the answer while it is still being written.
+    generation runs on the bounded executor (research/executor.py) like the async endpoints, so it
+    raises ExecutorSaturated when there is no room and StageTimeout past the generate timeout.
+    every stream needs its own token by token output, so streamed prompts are not micro-batched
     """
+    generator = get_generator()
+    executor = get_executor()
+    pieces = queue.Queue()
+    finished = object()
+
+    def generate():
+        try:
+            stream_generate(generator, augmented_prompt, pieces.put, max_new_tokens=256, do_sample=False)
+        finally:
+            # unblock the consumer, otherwise it would wait for pieces forever
+            pieces.put(finished)
+
+    future = executor.submit(generate)
+    timeout = executor.stage_timeouts.get("generate")
+    deadline = time.perf_counter() + timeout if timeout else None
+    while True:
+        try:
+            text = pieces.get(timeout=max(deadline - time.perf_counter(), 0) if deadline else None)
+        except queue.Empty:
+            raise StageTimeout("generate", timeout)
+        if text is finished:
+            break
+        if text:
+            yield text
+    # raises whatever generation failed with
+    future.result()
+
+def prepare_answer(query: str, top_k: int = 3, collection_name: str = None, where: Dict = None,
+                   mode: str = None) -> Dict:
+    """
+    everything before generation:
+    1. Convert query to embedding
+    2. Check the answer cache
+    3. Retrieve relevant chunks
+    4. Rerank them with the cross-encoder (RAG_RERANK_ENABLED)
+    5. Build augmented prompt within the generator's token budget
+    returns {"answer": ...} when there is nothing left to generate (cache hit, empty corpus),
+    otherwise the prompt and sources plus what finish_answer needs to cache the result.
+    only the caller's collection is searched (collection_name, the shared one by default),
+    and only chunks matching the metadata filter where. mode is dense, lexical or hybrid (RAG_RETRIEVAL_MODE).
+    "timings" holds the milliseconds every stage took, "context" the token counts of the packed prompt
+    """
+    mode = retrieval_mode(mode)
+    rerank = rerank_enabled()
+    timings = {}
+    collection = get_collection(collection_name)
+    if collection.count() == 0:
+        return {"answer": "No documents uploaded.", "cached": False, "sources": [], "timings": timings}
+
+    # Step 1: processs user query to embeddings
+    with timed(timings, "embed"):
+        query_embedding = process_query(query)
+
+    # Step 2: same or nearly the same question against the same corpus was already answered, skip generation
+    answer_cache = get_answer_cache()
+    # the same question with other filters is a different question
+    cache_scope = (collection.name, corpus_version(collection.name), top_k, json.dumps(where, sort_keys=True), mode,
+                   rerank)
+    if answer_cache is not None:
+        cached_answer = answer_cache.lookup(cache_scope, query, query_embedding)
+        if cached_answer is not None:
+            return {"answer": cached_answer, "cached": True, "sources": [], "timings": timings}
+
+    # Step 3: search the vector database, the bm25 index or both
+    # retrieve already returns cleaned format. with reranking on we over-fetch a bounded candidate pool
+    fetch_k = max(top_k, rerank_candidates()) if rerank else top_k
+    with timed(timings, "retrieve") as record:
+        docs_and_metadata = retrieve(collection, query, query_embedding, top_k=fetch_k, where=where, mode=mode)
+        record["chunks"] = len(docs_and_metadata)
+
+    # Step 4: let the cross-encoder pick the best top_k of the candidates
+    if rerank:
+        with timed(timings, "rerank") as record:
+            record["chunks"] = len(docs_and_metadata)
+            docs_and_metadata = get_rerank_stage().rerank(query, docs_and_metadata, top_k, timings)
+
+    # Step 5: build augmented prompt for LLM, packed into the generator's input budget
+    with timed(timings, "augment") as record:
+        packed = pack_prompt(query, docs_and_metadata)
+        record["tokens"] = packed["prompt_tokens"]
+        record["chunks"] = len(packed["sources"])
+    if packed["dropped_tokens"]:
+        print(f"Context packing dropped {packed['dropped_tokens']} tokens "
+              f"({packed['dropped_chunks']} chunks) to fit {prompt_max_tokens()} prompt tokens")
+
+    return {
+        "answer": None,
+        "prompt": packed.pop("prompt"),
+        # only the chunks the model actually sees are shown as sources
+        "sources": packed.pop("sources"),
+        "context": packed,
+        "query_embedding": query_embedding,
+        "cache_scope": cache_scope,
+        "timings": timings,
+    }
+
+def finish_answer(query: str, prepared: Dict, response: str) -> str:
+    """
+    clean the generated text and remember it in the answer cache
+    """
+    response = clean_response(response)
 
-    if not uploaded_docs:
-        return "No documents uploaded."
-    
-    # Step 1: load and chunk docs
-    chunks = chunk_documents(uploaded_docs)
-    if not chunks:
-        print("No documents found in DB.")
-        return "No documents available."
-
-    # Step 2: store chunks in vector db
-    collection = vector_db(chunks)
-
-    # Step 3: processs user query to embeddings
-    query_embedding = process_query(query)
-
-    # Step 4: search the vector database
-    results = search_vector(collection, query_embedding, top_k=top_k)
-
-    # Step 5: build docs_and_metadata safely
-    # docs_and_metadata = []
-    # for doc_list, meta_list in zip(results.get('documents', []), results.get('metadatas', [])):
-    #     for doc, meta in zip(doc_list, meta_list):
-    #         if isinstance(meta, list) and len(meta) == 1:
-    #             meta = meta[0]
-    #         docs_and_metadata.append({"content": doc, "metadata": meta})
-
-    
-    # Step 5: search_vector already returns cleaned format
-    docs_and_metadata = results
+    answer_cache = get_answer_cache()
+    # failed generations are not cached so the next attempt tries the model again
+    if answer_cache is not None and not response.startswith("Error generating response"):
+        answer_cache.store(prepared["cache_scope"], query, response, prepared["query_embedding"])
 
-    # Step 6: build augmented prompt for LLM
-    augmented_prompt = augment_context(query, docs_and_metadata)
+    return response
 
-    # Step 7: generate response using hugging face
-    response = generate_response(augmented_prompt)
-    response = clean_response(response)
+def stream_rag_pipeline(query: str, top_k: int = 3, collection_name: str = None, where: Dict = None,
+                        mode: str = None) -> Iterator[Dict]:
+    """
+    streaming version of run_rag_pipeline, yields events instead of returning one string:
+    {"event": "sources", "sources": [...]} as soon as retrieval is done,
+    {"event": "token", "text": "..."} for every piece of generated text,
+    {"event": "done", "answer": "...", "cached": bool, "timings": {...}} with the cleaned full answer at the end
+    """
+    prepared = prepare_answer(query, top_k, collection_name, where, mode)
+    yield from stream_prepared_answer(query, prepared)
 
-    return response
+def stream_prepared_answer(query: str, prepared: Dict) -> Iterator[Dict]:
+    """
+    the events of stream_rag_pipeline for a question prepare_answer already handled
+    (the streaming view runs that step on the bounded executor first)
+    """
+    timings = prepared["timings"]
+    if prepared["answer"] is not None:
+        yield {"event": "token", "text": prepared["answer"]}
+        yield {"event": "done", "answer": prepared["answer"], "cached": prepared["cached"], "timings": timings}
+        return
+
+    # sources go out before generation starts, this is the first thing the user sees
+    yield {
+        "event": "sources",
+        "sources": [
+            {
+                "title": result["metadata"].get("title"),
+                "company": result["metadata"].get("company"),
+                "doc_type": result["metadata"].get("doc_type"),
+                "content": result["content"]
+            }
+            for result in prepared["sources"]
+        ]
+    }
+
+    pieces = []
+    start = time.perf_counter()
+    try:
+        for text in stream_response(prepared["prompt"]):
+            pieces.append(text)
+            yield {"event": "token", "text": text}
+    except Exception as e:
+        yield {"event": "error", "error": f"Error generating response: {e}"}
+        return
+    timings["generate"] = round((time.perf_counter() - start) * 1000, 2)
+    response = "".join(pieces).strip()
+    # the pieces come out on whichever thread pulls the next event, so only wall time is known
+    observe_stage("generate", {"wall_ms": timings["generate"], "tokens": count_tokens(response)})
+
+    response = finish_answer(query, prepared, response)
+    yield {"event": "done", "answer": response, "cached": False, "timings": timings}
+
+def run_rag_pipeline(query: str, top_k: int = 3, collection_name: str = None, where: Dict = None, mode: str = None,
+                     timings: Dict = None):
+    """
+    Run the query side of the RAG pipeline:
+    1. Convert query to embedding
+    2. Retrieve relevant chunks
+    3. Build augmented prompt
+    4. Generate response via Hugging Face
+    Chunking and storing happens once per document at upload time (research/indexing.py),
+    so answering a question never re-chunks or re-embeds the corpus.
+    Answers are cached per corpus version (research/answer_cache.py), a repeated or near
+    duplicate question skips retrieval and generation entirely.
+    pass a dict as timings to get the milliseconds of every stage back in it
+    """
+    timings = timings if timings is not None else {}
+    # Steps 1-3: embed, retrieve (and rerank), build the prompt
+    prepared = prepare_answer(query, top_k, collection_name, where, mode)
+    timings.update(prepared["timings"])
+    if prepared["answer"] is not None:
+        return prepared["answer"]
+
+    # Step 4: generate response using hugging face
+    with timed(timings, "generate") as record:
+        response = generate_response(prepared["prompt"])
+        record["tokens"] = count_tokens(response)
+
+    return finish_answer(query, prepared, response)
@@ -0,0 +1,194 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+
+from research.model_registry import get_reranker, rerank_model_name
+
+# CROSS-ENCODER RERANKING
+# the bi-encoder search compares one question vector with precomputed chunk vectors, fast but coarse.
+# a cross-encoder reads the question and a chunk together and scores how well the chunk answers it,
+# much better at ordering but one forward pass per pair, so it only ever sees a small candidate pool:
+#   retrieve RAG_RERANK_CANDIDATES chunks -> score them in batches -> keep the best top_k
+# with a better top 3 we can send fewer chunks to the generator, so the prompt and the answer get faster.
+# scores are cached per (model, question, chunk id). chunk ids are hashes of the chunk text, so a
+# cached score stays right however the corpus changes around it.
+# the stage has a latency budget: when scoring the pairs that are not cached would take longer than
+# RAG_RERANK_BUDGET_MS, reranking is skipped and the retrieval order is used as is.
+
+DEFAULT_CANDIDATES = 20
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_BUDGET_MS = 150
+DEFAULT_CACHE_ENTRIES = 20000
+# weight of the newest measurement in the running seconds-per-pair estimate
+ESTIMATE_SMOOTHING = 0.2
+
+
+def rerank_candidates() -> int:
+    return getattr(settings, "RAG_RERANK_CANDIDATES", DEFAULT_CANDIDATES)
+
+
+def _query_hash(query: str) -> str:
+    normalized = " ".join(query.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class RerankScoreCache:
+    """
+    bounded LRU of cross-encoder scores keyed by (model name, question hash, chunk id)
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._scores: "OrderedDict[tuple, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: List[tuple]) -> List[Optional[float]]:
+        with self._lock:
+            found = []
+            for key in keys:
+                score = self._scores.get(key)
+                if score is None:
+                    self.misses += 1
+                else:
+                    self._scores.move_to_end(key)
+                    self.hits += 1
+                found.append(score)
+            return found
+
+    def put_many(self, items):
+        with self._lock:
+            for key, score in items:
+                self._scores[key] = float(score)
+                self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._scores), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses}
+
+
+class CrossEncoderReranker:
+    """
+    reorders retrieved chunks with the cross-encoder, within a latency budget
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, budget_ms: float = DEFAULT_BUDGET_MS,
+                 cache: Optional[RerankScoreCache] = None):
+        self.batch_size = batch_size
+        self.budget_ms = budget_ms
+        self.cache = cache if cache is not None else RerankScoreCache()
+        # running estimate of how long one pair takes, None until the first batch was scored
+        self.seconds_per_pair: Optional[float] = None
+        self._lock = threading.Lock()
+        self.reranked = 0
+        self.skipped = 0
+
+    def _record(self, pairs: int, seconds: float):
+        with self._lock:
+            measured = seconds / pairs
+            if self.seconds_per_pair is None:
+                self.seconds_per_pair = measured
+            else:
+                self.seconds_per_pair += ESTIMATE_SMOOTHING * (measured - self.seconds_per_pair)
+
+    def _skip(self, candidates: List[Dict], top_k: int, timings: Optional[Dict]) -> List[Dict]:
+        with self._lock:
+            self.skipped += 1
+        if timings is not None:
+            timings["rerank_skipped"] = True
+        return candidates[:top_k]
+
+    def rerank(self, query: str, candidates: List[Dict], top_k: int, timings: Optional[Dict] = None) -> List[Dict]:
+        """
+        the top_k candidates by cross-encoder score, best first, every result gets its "rerank_score".
+        falls back to the first top_k in retrieval order when the budget does not allow scoring them
+        """
+        if len(candidates) <= 1:
+            return candidates[:top_k]
+        start = time.perf_counter()
+        budget = self.budget_ms / 1000.0 if self.budget_ms else None
+
+        model_name = rerank_model_name()
+        query_hash = _query_hash(query)
+        keys = [(model_name, query_hash, result["id"]) for result in candidates]
+        scores = self.cache.get_many(keys)
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        # the estimate comes from earlier questions, nothing is scored when it already says no
+        if missing and budget is not None and self.seconds_per_pair is not None \
+                and len(missing) * self.seconds_per_pair > budget:
+            return self._skip(candidates, top_k, timings)
+
+        if missing:
+            model = get_reranker()
+            for offset in range(0, len(missing), self.batch_size):
+                batch = missing[offset:offset + self.batch_size]
+                batch_start = time.perf_counter()
+                batch_scores = model.predict([(query, candidates[i]["content"]) for i in batch],
+                                             batch_size=len(batch), show_progress_bar=False)
+                self._record(len(batch), time.perf_counter() - batch_start)
+                batch_scores = np.asarray(batch_scores, dtype=np.float32).ravel()
+                self.cache.put_many((keys[i], score) for i, score in zip(batch, batch_scores))
+                for i, score in zip(batch, batch_scores):
+                    scores[i] = float(score)
+                # a slow batch (cold model, busy cpu) stops the rest, what was scored stays cached
+                if budget is not None and offset + self.batch_size < len(missing) \
+                        and time.perf_counter() - start > budget:
+                    return self._skip(candidates, top_k, timings)
+
+        order = sorted(range(len(candidates)), key=lambda i: -scores[i])[:top_k]
+        with self._lock:
+            self.reranked += 1
+        return [dict(candidates[i], rerank_score=scores[i]) for i in order]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "reranked": self.reranked,
+                "skipped": self.skipped,
+                "budget_ms": self.budget_ms,
+                "ms_per_pair": round(self.seconds_per_pair * 1000, 3) if self.seconds_per_pair is not None else None,
+                "score_cache": self.cache.stats(),
+            }
+
+
+_stage = None
+_stage_lock = threading.Lock()
+
+
+def get_rerank_stage() -> CrossEncoderReranker:
+    """
+    process wide reranker, shares its score cache and latency estimate across requests
+    """
+    global _stage
+    if _stage is None:
+        with _stage_lock:
+            if _stage is None:
+                _stage = CrossEncoderReranker(
+                    batch_size=getattr(settings, "RAG_RERANK_BATCH_SIZE", DEFAULT_BATCH_SIZE),
+                    budget_ms=getattr(settings, "RAG_RERANK_BUDGET_MS", DEFAULT_BUDGET_MS),
+                    cache=RerankScoreCache(getattr(settings, "RAG_RERANK_CACHE_ENTRIES", DEFAULT_CACHE_ENTRIES)),
+                )
+    return _stage
+
+
+def current_rerank_stage() -> Optional[CrossEncoderReranker]:
+    """
+    the reranker if it was ever used, for the health report
+    """
+    return _stage
+
+
+def reset_rerank_stage():
+    global _stage
+    with _stage_lock:
+        _stage = None
@@ -1,7 +1,13 @@
 from rest_framework import serializers
-from .models import Document
+from .models import Document, IngestionJob
 
 class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
         fields = ['id', 'title', 'company', 'doc_type', 'date_filed', 'content']
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IngestionJob
+        fields = ['id', 'original_name', 'status', 'stage', 'progress', 'result', 'document', 'error', 'attempts',
+                  'created_at', 'started_at', 'finished_at']
@@ -0,0 +1,74 @@
+from typing import Optional
+
+from django.conf import settings
+
+from research.vector_store import collection_name, get_collection, tenant_collection_name
+
+# TENANTS
+# every caller searches and uploads into its own collection, so one user's upload or clear never
+# touches another user's documents and search cost depends only on the caller's own corpus.
+# the tenant is the logged in user when there is one, otherwise the django session.
+# RAG_TENANT_MODE = "shared" puts everyone back in the single CHROMA_COLLECTION_NAME collection.
+# the X-Tenant-ID header is only used when a deployment turns RAG_TENANT_HEADER_ENABLED on, and it
+# is NOT an isolation boundary: it is taken as sent, anyone who knows (or guesses) a tenant id can
+# read and clear that tenant's documents. only turn it on behind a proxy that authenticates the
+# caller and sets the header itself (dropping whatever the client sent). the frontend sends a
+# random uuid per tab, which the default setting ignores.
+
+TENANT_HEADER = "X-Tenant-ID"
+# longer header values are cut, the id is hashed into the collection name anyway
+MAX_TENANT_ID_LENGTH = 128
+
+
+class TenantQuotaExceeded(Exception):
+    """
+    storing more chunks would take a tenant over RAG_TENANT_MAX_CHUNKS
+    """
+
+    def __init__(self, collection: str, limit: int):
+        self.collection = collection
+        self.limit = limit
+        super().__init__(f"Document quota reached: at most {limit} chunks can be stored per session")
+
+
+def tenant_for_request(request) -> Optional[str]:
+    """
+    tenant id of a request, None means the shared collection.
+    touches the session (database), so async views call it through sync_to_async
+    """
+    if getattr(settings, "RAG_TENANT_MODE", "session") == "shared":
+        return None
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        # an authenticated identity, the only tenant a client cannot simply claim
+        return f"user:{user.pk}"
+    header = request.headers.get(TENANT_HEADER, "").strip()
+    if header and getattr(settings, "RAG_TENANT_HEADER_ENABLED", False):
+        return f"header:{header[:MAX_TENANT_ID_LENGTH]}"
+    session = request.session
+    if not session.session_key:
+        # a modified session is saved by the middleware, which also sends the cookie back
+        session["rag_tenant"] = True
+        session.save()
+    return f"session:{session.session_key}"
+
+
+def collection_for_request(request) -> str:
+    return tenant_collection_name(tenant_for_request(request))
+
+
+def tenant_quota() -> Optional[int]:
+    return getattr(settings, "RAG_TENANT_MAX_CHUNKS", None)
+
+
+def check_quota(collection: str, adding: int):
+    """
+    raise TenantQuotaExceeded if adding this many chunks would go over the quota.
+    the quota is on chunks because that is what a collection's memory (vectors + hnsw graph) grows with
+    """
+    limit = tenant_quota()
+    # the shared collection is not a tenant, it has no quota
+    if collection == collection_name():
+        return
+    if limit and get_collection(collection).count() + adding > limit:
+        raise TenantQuotaExceeded(collection, limit)
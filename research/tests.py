@@ -1,3 +1,1315 @@
-from django.test import TestCase
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from research.embedding_cache import DiskEmbeddingStore, EmbeddingCache, reset_embedding_cache
+from research.answer_cache import AnswerCache, reset_answer_cache
+from research.embeddings import embed_texts, embed_query
+from research.batching import GenerationBatcher
+from research.extraction import extract_pdf_pages, iter_file_text, iter_text_file, page_text
+from research.executor import BoundedExecutor, ExecutorSaturated, StageTimeout
+from research import indexing
+from research.indexing import index_document, clear_index, rebuild_index
+from research import jobs
+from research.jobs import claim_next_job, process_job, requeue_stale_jobs
+from research.model_registry import ModelRegistry
+from research.models import Chunk, Document, IngestionJob
+from research.filters import InvalidFilter, build_where
+from research.lexical_index import LexicalIndex, drop_lexical_index, get_lexical_index
+from research.rag_pipeline import (chunk_documents, is_indexable, pack_prompt, reciprocal_rank_fusion, retrieve,
+                                   run_rag_pipeline, search_vector, split_text_stream, stream_chunks,
+                                   stream_rag_pipeline)
+from research.tracing import stage, start_trace
+from research.inference_backends import embedding_backend, generation_backend, load_embedding_model, load_generator
+from research.context_packing import (WordTokenizer, count_tokens, join_overlapping, merge_neighbours,
+                                      reset_tokenizer_fallback)
+from research.rerank import CrossEncoderReranker, reset_rerank_stage
+from research.tenancy import TenantQuotaExceeded
+from research.exact_index import ExactVectorStore
+from research.vector_store import (ChromaVectorStore, chroma_store, corpus_version, delete_collection, get_collection,
+                                   hnsw_settings, reset_client, tenant_collection_name)
+
+
+class ModelRegistryTests(SimpleTestCase):
+
+    def test_loader_runs_once_across_threads(self):
+        calls = []
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.05)
+            return object()
+
+        registry = ModelRegistry()
+        registry.register("model", loader)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(registry.get("model"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertTrue(registry.stats()["model"]["loaded"])
+        self.assertGreater(registry.stats()["model"]["load_time_s"], 0)
+
+    def test_nothing_loads_until_first_use(self):
+        registry = ModelRegistry()
+        registry.register("model", lambda: object())
+        self.assertFalse(registry.is_loaded("model"))
+        registry.warm_up()
+        self.assertTrue(registry.is_loaded("model"))
+
+    def test_health_reports_failed_probe(self):
+        def bad_probe(model):
+            raise RuntimeError("broken")
+
+        registry = ModelRegistry()
+        registry.register("model", lambda: object(), probe=bad_probe)
+        registry.get("model")
+        report = registry.health(probe=True)
+        self.assertEqual(report["status"], "error")
+        self.assertIn("broken", report["models"]["model"]["probe"])
+
+    def test_warm_up_endpoint_needs_staff(self):
+        with mock.patch("research.views.registry.warm_up") as warm_up:
+            response = self.client.post("/rag/models/warmup/")
+        self.assertEqual(response.status_code, 403)
+        warm_up.assert_not_called()
+
+
+class FakeEmbeddingModel:
+    """
+    stands in for SentenceTransformer in tests, counts how many texts it was asked to encode
+    """
+
+    def __init__(self, dimension=8):
+        self.dimension = dimension
+        self.encoded = 0
+
+    def encode(self, texts, **kwargs):
+        single = isinstance(texts, str)
+        batch = [texts] if single else list(texts)
+        self.encoded += len(batch)
+        vectors = np.array(
+            [[(hash((text, i)) % 1000) / 1000.0 + 0.001 for i in range(self.dimension)] for text in batch],
+            dtype=np.float32,
+        )
+        return vectors[0] if single else vectors
+
+
+def sample_document(content, title="filing.txt"):
+    return {
+        "title": title,
+        "company": "Unknown",
+        "doc_type": "uploaded",
+        "content": content,
+        "date_filed": None,
+    }
+
+
+class VectorStoreMixin:
+    """
+    points chromadb at a temporary directory and swaps in the fake embedding model
+    """
+
+    def setUp(self):
+        persist_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, persist_dir, ignore_errors=True)
+        settings_override = override_settings(CHROMA_PERSIST_DIR=persist_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_client()
+        self.addCleanup(reset_client)
+
+        self.model = FakeEmbeddingModel()
+        patcher = mock.patch("research.embeddings.get_embedding_model", return_value=self.model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        reset_embedding_cache()
+        self.addCleanup(reset_embedding_cache)
+        reset_answer_cache()
+        self.addCleanup(reset_answer_cache)
+        drop_lexical_index()
+        self.addCleanup(drop_lexical_index)
+        # prompts are measured in words instead of loading the flan-t5 tokenizer
+        patcher = mock.patch("research.context_packing.get_tokenizer", return_value=WordTokenizer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class VectorStoreTestCase(VectorStoreMixin, TestCase):
+    pass
+
+
+class IncrementalIndexingTests(VectorStoreTestCase):
+
+    def test_chunk_ids_are_stable_content_hashes(self):
+        document = sample_document("Revenue grew 12% in fiscal 2024. " * 40)
+        first = [chunk["id"] for chunk in chunk_documents([document])]
+        second = [chunk["id"] for chunk in chunk_documents([document])]
+        self.assertEqual(first, second)
+        self.assertEqual(len(set(first)), len(first))
+
+    def test_reupload_does_not_re_embed(self):
+        document = sample_document("Operating margin was 31% compared to 28% last year. " * 30)
+        first = index_document(document)
+        encoded_after_first = self.model.encoded
+        second = index_document(document)
+
+        self.assertGreater(first["added"], 0)
+        self.assertEqual(second["added"], 0)
+        self.assertEqual(self.model.encoded, encoded_after_first)
+
+    def test_new_document_only_indexes_its_own_chunks(self):
+        index_document(sample_document(" ".join(f"Cash balance in quarter {i} was ${i}B." for i in range(60))))
+        encoded_before = self.model.encoded
+        other = " ".join(f"Net income in year {2000 + i} was ${i * 7}M." for i in range(60))
+        indexed = index_document(sample_document(other, "other.txt"))
+        self.assertEqual(self.model.encoded - encoded_before, indexed["chunks"])
+
+
+class PersistentVectorStoreTests(VectorStoreTestCase):
+
+    def test_index_survives_a_new_client(self):
+        indexed = index_document(sample_document("Free cash flow reached $12B in 2024. " * 30))
+        # simulates a restart or a second worker opening the same directory
+        reset_client()
+        self.assertEqual(get_collection().count(), indexed["total_chunks"])
+
+    def test_clear_index_removes_everything(self):
+        index_document(sample_document("Gross margin expanded by 150 basis points. " * 30))
+        clear_index()
+        self.assertEqual(get_collection().count(), 0)
+
+
+class DocumentRowsTests(VectorStoreTestCase):
+
+    def document(self):
+        return sample_document(" ".join(f"Inventory in week {i} was {i * 3} units." for i in range(120)))
+
+    def test_ingest_writes_flagged_document_and_chunk_rows(self):
+        indexed = index_document(self.document())
+        row = Document.objects.get(pk=indexed["document"])
+        self.assertTrue(row.chunks_generated)
+        self.assertEqual(row.chunks.count(), indexed["chunks"])
+        self.assertFalse(row.chunks.filter(embedding_generated=False).exists())
+
+    def test_interrupted_ingest_resumes_without_re_embedding(self):
+        real_vector_db = indexing.vector_db
+        calls = []
+
+        def crash_on_second_step(chunks, collection_name=None):
+            calls.append(len(chunks))
+            if len(calls) == 2:
+                # the process going down (SIGTERM), unlike an error this leaves the rows for the next attempt
+                raise SystemExit("worker died")
+            return real_vector_db(chunks, collection_name)
+
+        with mock.patch("research.indexing.INDEX_STEP_SIZE", 4), \
+                mock.patch("research.indexing.vector_db", side_effect=crash_on_second_step):
+            with self.assertRaises(SystemExit):
+                index_document(self.document())
+        self.assertEqual(Chunk.objects.filter(embedding_generated=True).count(), 4)
+
+        encoded_before = self.model.encoded
+        indexed = index_document(self.document())
+        self.assertEqual(self.model.encoded - encoded_before, indexed["chunks"] - 4)
+        self.assertFalse(Chunk.objects.filter(embedding_generated=False).exists())
+
+    def test_collection_is_rebuilt_from_rows(self):
+        indexed = index_document(self.document())
+        delete_collection()
+        self.assertEqual(get_collection().count(), 0)
+
+        rebuilt = rebuild_index()
+        self.assertEqual(rebuilt["chunks"], indexed["chunks"])
+        self.assertEqual(get_collection().count(), indexed["total_chunks"])
+
+
+class BatchedEmbeddingTests(SimpleTestCase):
+
+    def setUp(self):
+        reset_embedding_cache()
+        self.addCleanup(reset_embedding_cache)
+
+    def test_batches_keep_original_order_and_float32(self):
+        model = FakeEmbeddingModel()
+        texts = ["short", "a much longer piece of text than the others", "mid sized text", "x"]
+        with mock.patch("research.embeddings.get_embedding_model", return_value=model):
+            embeddings = embed_texts(texts, batch_size=2)
+
+        self.assertEqual(embeddings.dtype, np.float32)
+        self.assertEqual(embeddings.shape, (4, model.dimension))
+        for text, vector in zip(texts, embeddings):
+            np.testing.assert_array_equal(vector, model.encode(text))
+
+    def test_repeated_texts_are_served_from_cache(self):
+        model = FakeEmbeddingModel()
+        with mock.patch("research.embeddings.get_embedding_model", return_value=model):
+            embed_texts(["revenue grew", "margin fell"])
+            embed_texts(["revenue  grew ", "margin fell", "new text"])
+            embed_query("margin fell")
+        # whitespace differences hit the same key, only three distinct texts were ever encoded
+        self.assertEqual(model.encoded, 3)
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = EmbeddingCache(max_entries=2)
+        cache.put("a", np.ones(4))
+        cache.put("b", np.ones(4))
+        cache.get("a")
+        cache.put("c", np.ones(4))
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        stats = cache.stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_evicted_entries_spill_to_disk(self):
+        disk_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, disk_dir, ignore_errors=True)
+        cache = EmbeddingCache(max_entries=1, disk_dir=disk_dir)
+        cache.put("a", np.arange(4, dtype=np.float32))
+        cache.put("b", np.arange(4, 8, dtype=np.float32))
+
+        np.testing.assert_array_equal(cache.get("a"), np.arange(4, dtype=np.float32))
+        self.assertEqual(cache.stats()["disk_hits"], 1)
+
+        # a new cache over the same directory (restart, other worker) sees flushed entries too
+        cache.flush()
+        reopened = EmbeddingCache(max_entries=1, disk_dir=disk_dir)
+        np.testing.assert_array_equal(reopened.get("b"), np.arange(4, 8, dtype=np.float32))
+
+    def test_disk_rows_survive_a_lost_key_line(self):
+        disk_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, disk_dir, ignore_errors=True)
+        store = DiskEmbeddingStore(disk_dir)
+        store.put_many([("a", np.zeros(4, dtype=np.float32))])
+        # a writer that crashed after its vectors but before its keys, and half of another row
+        with open(store.vectors_path, "ab") as f:
+            f.write(np.ones(4, dtype=np.float32).tobytes() + b"\0" * 6)
+        store.put_many([("b", np.full(4, 2, dtype=np.float32))])
+
+        reopened = DiskEmbeddingStore(disk_dir)
+        np.testing.assert_array_equal(reopened.get("a"), np.zeros(4, dtype=np.float32))
+        np.testing.assert_array_equal(reopened.get("b"), np.full(4, 2, dtype=np.float32))
+
+    def test_disk_miss_only_rereads_changed_keys(self):
+        disk_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, disk_dir, ignore_errors=True)
+        store = DiskEmbeddingStore(disk_dir)
+        store.put_many([("a", np.zeros(4, dtype=np.float32))])
+        with mock.patch("builtins.open", side_effect=AssertionError("keys.txt reread")):
+            self.assertIsNone(store.get("missing"))
+        # another process appends, the next miss picks it up
+        DiskEmbeddingStore(disk_dir).put_many([("b", np.ones(4, dtype=np.float32))])
+        np.testing.assert_array_equal(store.get("b"), np.ones(4, dtype=np.float32))
+
+
+class AnswerCacheTests(SimpleTestCase):
+
+    def test_exact_and_near_duplicate_questions_hit(self):
+        cache = AnswerCache(similarity_threshold=0.9)
+        cache.store(("v1", 3), "What was revenue?", "$10B", np.array([1.0, 0.0, 0.0]))
+
+        self.assertEqual(cache.lookup(("v1", 3), "  what was REVENUE? ", np.array([0.0, 1.0, 0.0])), "$10B")
+        self.assertEqual(cache.lookup(("v1", 3), "How much revenue?", np.array([0.99, 0.05, 0.0])), "$10B")
+        self.assertIsNone(cache.lookup(("v1", 3), "What was net income?", np.array([0.0, 1.0, 0.0])))
+        self.assertEqual(cache.stats()["exact_hits"], 1)
+        self.assertEqual(cache.stats()["semantic_hits"], 1)
+
+    def test_other_corpus_version_misses(self):
+        cache = AnswerCache()
+        cache.store(("v1", 3), "What was revenue?", "$10B", np.array([1.0, 0.0]))
+        self.assertIsNone(cache.lookup(("v2", 3), "What was revenue?", np.array([1.0, 0.0])))
+
+
+class CachedPipelineTests(VectorStoreTestCase):
+
+    def test_repeat_question_skips_generation_until_corpus_changes(self):
+        index_document(sample_document(" ".join(f"Revenue in {2000 + i} was ${i}B." for i in range(40))))
+        with mock.patch("research.rag_pipeline.generate_response", return_value="It grew.") as generate:
+            run_rag_pipeline("How did revenue change?")
+            run_rag_pipeline("How did revenue change?")
+            self.assertEqual(generate.call_count, 1)
+
+            index_document(sample_document(" ".join(f"Debt in {2000 + i} was ${i}M." for i in range(40)), "debt.txt"))
+            run_rag_pipeline("How did revenue change?")
+            self.assertEqual(generate.call_count, 2)
+
+
+IMPORT_PROBE = """
+import json, os, sys, time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "market_research.settings")
+start = time.perf_counter()
+import django
+django.setup()
+import research.urls
+seconds = time.perf_counter() - start
+heavy = sorted(m for m in ("torch", "transformers", "sentence_transformers", "chromadb", "langchain", "pdfplumber")
+               if m in sys.modules)
+print(json.dumps({"seconds": seconds, "heavy": heavy}))
+"""
+
+
+class ImportTimeTests(SimpleTestCase):
+    """
+    manage.py commands and every worker boot import the urls, that must never load the ML stack again
+    """
+
+    # generous so slow CI machines pass, loading torch + flan-t5 takes far longer than this
+    IMPORT_BUDGET_SECONDS = 3.0
+
+    def test_import_research_urls_is_fast_and_light(self):
+        # fresh interpreter, the test process already has everything imported
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE],
+            cwd=str(settings.BASE_DIR),
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+
+        self.assertEqual(report["heavy"], [])
+        self.assertLess(report["seconds"], self.IMPORT_BUDGET_SECONDS)
+
+
+class StreamingAskTests(VectorStoreTestCase):
+
+    def test_sources_come_before_tokens(self):
+        index_document(sample_document(" ".join(f"Segment {i} revenue was ${i}B." for i in range(40))))
+        with mock.patch("research.rag_pipeline.stream_response", return_value=iter(["Segment ", "revenue ", "grew."])):
+            events = list(stream_rag_pipeline("How did segment revenue do?"))
+
+        self.assertEqual([event["event"] for event in events], ["sources", "token", "token", "token", "done"])
+        self.assertTrue(events[0]["sources"])
+        self.assertEqual(events[-1]["answer"], "Segment revenue grew.")
+
+    @override_settings(RAG_STUB_GENERATION_MS=0)
+    def test_streams_with_the_stub_backend(self):
+        index_document(sample_document("Net sales were $10B in fiscal 2023. Margins fell slightly."))
+        with mock.patch("research.rag_pipeline.get_generator", return_value=load_generator("flan-t5", "stub")):
+            events = list(stream_rag_pipeline("What were net sales?"))
+
+        self.assertEqual(events[0]["event"], "sources")
+        self.assertGreater(sum(event["event"] == "token" for event in events), 1)
+        self.assertEqual(events[-1]["event"], "done")
+        self.assertTrue(events[-1]["answer"].startswith("Net sales were $10B"))
+
+    def test_streaming_takes_an_executor_slot(self):
+        index_document(sample_document("Net sales were $10B in fiscal 2023. Margins fell slightly."))
+        saturated = mock.Mock()
+        saturated.submit.side_effect = ExecutorSaturated("full")
+        with mock.patch("research.rag_pipeline.get_generator", return_value=load_generator("flan-t5", "stub")), \
+                mock.patch("research.rag_pipeline.get_executor", return_value=saturated):
+            events = list(stream_rag_pipeline("What were net sales?"))
+
+        self.assertEqual(events[-1]["event"], "error")
+        self.assertIn("full", events[-1]["error"])
+
+    def test_endpoint_emits_server_sent_events(self):
+        fake_events = [
+            {"event": "sources", "sources": []},
+            {"event": "token", "text": "Hi"},
+            {"event": "done", "answer": "Hi", "cached": False},
+        ]
+
+        async def read_stream():
+            response = await AsyncClient().post("/rag/ask/stream/", {"query": "hello"}, content_type="application/json")
+            body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+            return response, body
+
+        with mock.patch("research.views.prepare_answer", return_value={"answer": None, "timings": {}}), \
+                mock.patch("research.views.stream_prepared_answer", return_value=iter(fake_events)):
+            response, body = async_to_sync(read_stream)()
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(body.count("\n\n"), 3)
+        self.assertLess(body.index("event: sources"), body.index("event: token"))
+        self.assertIn('data: {"text": "Hi"}', body)
+
+    def test_endpoint_answers_503_before_streaming_when_saturated(self):
+        async def ask():
+            return await AsyncClient().post("/rag/ask/stream/", {"query": "hi"}, content_type="application/json")
+
+        saturated = mock.Mock()
+        saturated.run = mock.AsyncMock(side_effect=ExecutorSaturated("full"))
+        with mock.patch("research.views.get_executor", return_value=saturated):
+            response = async_to_sync(ask)()
+
+        # the error is a plain response, the event stream is never opened
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.streaming)
+
+
+class BoundedExecutorTests(SimpleTestCase):
+
+    def test_rejects_when_workers_and_queue_are_full(self):
+        executor = BoundedExecutor(max_workers=1, max_queue=1)
+        release = threading.Event()
+        executor.submit(release.wait)
+        executor.submit(release.wait)
+        with self.assertRaises(ExecutorSaturated):
+            executor.submit(release.wait)
+        release.set()
+        self.assertEqual(executor.stats()["rejected"], 1)
+
+    def test_stage_timeout(self):
+        executor = BoundedExecutor(max_workers=1, max_queue=0, stage_timeouts={"generate": 0.05})
+        with self.assertRaises(StageTimeout) as raised:
+            async_to_sync(executor.run)("generate", time.sleep, 0.5)
+        self.assertEqual(raised.exception.stage, "generate")
+
+    @override_settings(RAG_TENANT_HEADER_ENABLED=True)
+    def test_async_ask_answers_503_when_saturated(self):
+        async def ask():
+            return await AsyncClient().post("/rag/async/ask/", {"query": "hi"}, content_type="application/json",
+                                            headers={"X-Tenant-ID": "acme"})
+
+        saturated = mock.Mock()
+        saturated.run = mock.AsyncMock(side_effect=ExecutorSaturated("full"))
+        with mock.patch("research.views.get_executor", return_value=saturated):
+            response = async_to_sync(ask)()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+
+
+class GenerationBatcherTests(SimpleTestCase):
+
+    def test_concurrent_prompts_share_one_batch(self):
+        batches = []
+
+        def generate_batch(prompts):
+            batches.append(list(prompts))
+            return [prompt.upper() for prompt in prompts]
+
+        batcher = GenerationBatcher(generate_batch, max_batch_size=8, window_ms=100, name="test_shared")
+        futures = [batcher.submit(f"prompt {i}") for i in range(4)]
+
+        self.assertEqual([future.result(timeout=5) for future in futures], [f"PROMPT {i}" for i in range(4)])
+        self.assertEqual(batches, [[f"prompt {i}" for i in range(4)]])
+        self.assertEqual(batcher.stats()["batch_size"]["count"], 1)
+
+    def test_batch_never_exceeds_max_size(self):
+        batches = []
+        batcher = GenerationBatcher(lambda prompts: batches.append(len(prompts)) or list(prompts),
+                                    max_batch_size=2, window_ms=50, name="test_max")
+        futures = [batcher.submit(str(i)) for i in range(5)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertTrue(all(size <= 2 for size in batches))
+        self.assertEqual(sum(batches), 5)
+
+    def test_errors_reach_every_waiting_caller(self):
+        def generate_batch(prompts):
+            raise RuntimeError("model crashed")
+
+        batcher = GenerationBatcher(generate_batch, window_ms=50, name="test_errors")
+        futures = [batcher.submit("a"), batcher.submit("b")]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=5)
+
+    def test_missing_outputs_fail_their_callers(self):
+        batcher = GenerationBatcher(lambda prompts: list(prompts)[:1], window_ms=50, name="test_short")
+        futures = [batcher.submit("a"), batcher.submit("b")]
+        self.assertEqual(futures[0].result(timeout=5), "a")
+        with self.assertRaises(RuntimeError):
+            futures[1].result(timeout=5)
+
+    def test_generate_gives_up_after_timeout(self):
+        release = threading.Event()
+        batcher = GenerationBatcher(lambda prompts: release.wait() and list(prompts), window_ms=0, name="test_stall")
+        self.addCleanup(release.set)
+        batcher.submit("stalls the worker")
+        start = time.perf_counter()
+        with self.assertRaises(FutureTimeout):
+            batcher.generate("waits", timeout=0.05)
+        self.assertLess(time.perf_counter() - start, 2)
+
+
+class IngestionJobTests(VectorStoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir, ignore_errors=True)
+        # the test drives the worker itself instead of background threads
+        settings_override = override_settings(INGEST_UPLOAD_DIR=upload_dir, INGEST_RUN_IN_PROCESS=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, name="filing.txt"):
+        content = " ".join(f"Backlog in quarter {i} was ${i}M." for i in range(80)).encode()
+        return self.client.post("/rag/upload/", {"file": SimpleUploadedFile(name, content)},
+                                headers={"X-Tenant-ID": "acme"})
+
+    def test_upload_returns_job_id_and_worker_indexes_it(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["job_id"]
+        collection = get_collection(IngestionJob.objects.get(pk=job_id).collection)
+        self.assertEqual(collection.count(), 0)
+
+        job = process_job(claim_next_job("test-worker"))
+
+        self.assertEqual(job.id, job_id)
+        self.assertEqual(job.status, IngestionJob.DONE)
+        self.assertEqual(set(job.progress), {"extracting", "chunking", "embedding"})
+        self.assertGreater(collection.count(), 0)
+        # only the uploader's own collection got the document
+        self.assertEqual(get_collection().count(), 0)
+        status_report = self.client.get(f"/rag/jobs/{job_id}/", headers={"X-Tenant-ID": "acme"}).json()
+        self.assertEqual(status_report["status"], "done")
+        self.assertEqual(status_report["result"]["added"], collection.count())
+
+    def test_a_job_is_claimed_only_once(self):
+        self.upload()
+        self.assertIsNotNone(claim_next_job("worker-a"))
+        self.assertIsNone(claim_next_job("worker-b"))
+
+    def test_jobs_of_a_dead_worker_are_requeued(self):
+        self.upload()
+        job = claim_next_job("crashed-worker")
+        IngestionJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(requeue_stale_jobs(stale_after=60), 1)
+        resumed = claim_next_job("new-worker")
+        self.assertEqual(resumed.pk, job.pk)
+        self.assertEqual(resumed.attempts, 2)
+
+    def test_failed_job_removes_its_upload(self):
+        self.upload()
+        job = claim_next_job("test-worker")
+        with mock.patch("research.jobs.index_file", side_effect=RuntimeError("bad file")):
+            job = process_job(job)
+        self.assertEqual(job.status, IngestionJob.FAILED)
+        self.assertFalse(os.path.exists(job.file_path))
+
+    def test_clear_cancels_queued_and_running_jobs(self):
+        self.upload()
+        running = claim_next_job("test-worker")
+        self.upload("second.txt")
+        queued = IngestionJob.objects.get(status=IngestionJob.QUEUED)
+
+        response = self.client.post("/rag/clear_docs/", headers={"X-Tenant-ID": "acme"})
+        self.assertEqual(response.status_code, 200)
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, IngestionJob.CANCELLED)
+        self.assertFalse(os.path.exists(queued.file_path))
+
+        # the worker notices before its first step and indexes nothing
+        job = process_job(running)
+        self.assertEqual(job.status, IngestionJob.CANCELLED)
+        self.assertFalse(os.path.exists(job.file_path))
+        self.assertEqual(get_collection(job.collection).count(), 0)
+
+    def test_cancel_after_the_last_check_removes_the_indexed_document(self):
+        self.upload()
+        job = claim_next_job("test-worker")
+        real_index_file = indexing.index_file
+
+        def index_then_cancel(*args, **kwargs):
+            indexed = real_index_file(*args, **kwargs)
+            # clear_docs runs between the last cancel check and the final update
+            IngestionJob.objects.filter(pk=job.pk).update(status=IngestionJob.CANCELLED)
+            return indexed
+
+        with mock.patch("research.jobs.index_file", side_effect=index_then_cancel):
+            job = process_job(job)
+
+        self.assertEqual(job.status, IngestionJob.CANCELLED)
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(job.document_id)
+        self.assertFalse(Document.objects.filter(collection=job.collection).exists())
+        self.assertEqual(get_collection(job.collection).count(), 0)
+
+    def test_job_is_failed_when_the_final_update_raises(self):
+        self.upload()
+        job = claim_next_job("test-worker")
+        real_finish = jobs._finish_job
+        calls = []
+
+        def finish_once_broken(job, outcome):
+            calls.append(outcome["status"])
+            if len(calls) == 1:
+                raise IntegrityError("FOREIGN KEY constraint failed")
+            return real_finish(job, outcome)
+
+        with mock.patch("research.jobs._finish_job", side_effect=finish_once_broken):
+            job = process_job(job)
+
+        # the job does not stay running, and the document it could not point at is removed
+        self.assertEqual(calls, [IngestionJob.DONE, IngestionJob.FAILED])
+        self.assertEqual(job.status, IngestionJob.FAILED)
+        self.assertIn("FOREIGN KEY", job.error)
+        self.assertFalse(Document.objects.filter(collection=job.collection).exists())
+
+
+def minimal_pdf(page_texts):
+    """
+    a tiny valid PDF with one line of text per page, built by hand so the tests need no pdf writer
+    """
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in page_texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    body = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(body))
+        body += f"{number} 0 obj\n{obj}\nendobj\n".encode()
+    xref = len(body)
+    body += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    body += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    body += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return body
+
+
+class PdfExtractionTests(SimpleTestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".pdf")
+        with os.fdopen(handle, "wb") as f:
+            f.write(minimal_pdf([f"Page {i} revenue" for i in range(12)]))
+        self.addCleanup(os.remove, self.path)
+
+    def test_sharded_extraction_keeps_page_order(self):
+        with override_settings(PDF_MIN_PAGES_PER_SHARD=2):
+            pages = extract_pdf_pages(self.path, processes=2)
+        self.assertEqual([page.strip() for page in pages], [f"Page {i} revenue" for i in range(12)])
+
+    def test_sharded_and_serial_extraction_agree(self):
+        # reference: every page of the file in order, in this process
+        import pdfplumber
+        with pdfplumber.open(self.path) as pdf:
+            serial = "".join(page_text(page) for page in pdf.pages)
+        with override_settings(PDF_MIN_PAGES_PER_SHARD=2):
+            self.assertEqual("".join(iter_file_text(self.path)), serial)
+
+    def test_table_search_runs_on_pages_with_only_curves(self):
+        page = mock.Mock(lines=[], rects=[], curves=[{"pts": []}], edges=[{"orientation": "h"}])
+        page.extract_text.return_value = "Revenue"
+        page.extract_tables.return_value = [[["Q1", "5"]]]
+        self.assertIn("Q1 | 5", page_text(page, skip_tables_without_lines=True))
+
+        # by default every page is searched, even one without any ruling
+        page.edges = []
+        self.assertIn("Q1 | 5", page_text(page))
+        self.assertNotIn("Q1 | 5", page_text(page, skip_tables_without_lines=True))
+
+
+class StreamingExtractionTests(SimpleTestCase):
+
+    def test_text_file_is_decoded_across_block_boundaries(self):
+        handle, path = tempfile.mkstemp(suffix=".txt")
+        self.addCleanup(os.remove, path)
+        text = "Umsatz stieg um 5 € " * 50
+        with os.fdopen(handle, "wb") as f:
+            f.write(text.encode("utf-8"))
+        # 7 byte blocks split the 3 byte euro sign again and again
+        pieces = list(iter_text_file(path, read_size=7))
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual("".join(pieces), text)
+
+    def test_streamed_chunks_cover_the_text_within_the_chunk_size(self):
+        text = " ".join(f"Segment {i} revenue grew {i % 7} percent." for i in range(400))
+        pieces = [text[i:i + 1000] for i in range(0, len(text), 1000)]
+        # a tiny window so the text is carried over between windows many times
+        with mock.patch("research.rag_pipeline.STREAM_WINDOW_CHUNKS", 2):
+            chunks = list(split_text_stream(pieces))
+        self.assertTrue(all(len(chunk) <= 300 for chunk in chunks))
+        self.assertEqual(chunks[0], text[:len(chunks[0])])
+        self.assertTrue(text.endswith(chunks[-1]))
+        self.assertEqual({word for chunk in chunks for word in chunk.split()}, set(text.split()))
+
+    def test_any_split_of_the_text_gives_the_one_shot_chunks(self):
+        # whitespace runs and non ASCII characters next to spaces, cut anywhere they fall
+        text = "".join(f" Note {i}:\n\n revenue \u20ac {i}M \t\u00e9 up\u00a0 {i % 5}%.  " for i in range(150))
+        doc = sample_document(text)
+        # the whole text fits one window here, so chunk_documents splits it in one go
+        one_shot = chunk_documents([doc])
+        rng = random.Random(7)
+        for _ in range(5):
+            cuts = sorted(rng.sample(range(1, len(text)), 60))
+            pieces = [text[start:stop] for start, stop in zip([0] + cuts, cuts + [len(text)])]
+            with mock.patch("research.rag_pipeline.STREAM_WINDOW_CHUNKS", 2):
+                streamed = list(stream_chunks(doc, pieces, one_shot[0]["document_id"]))
+            self.assertEqual(streamed, one_shot)
+
+
+class TenantTests(VectorStoreTestCase):
+
+    def ask(self, tenant, query="What was revenue?"):
+        with mock.patch("research.rag_pipeline.generate_response", return_value="answer"):
+            return self.client.post("/rag/ask/", {"query": query}, headers={"X-Tenant-ID": tenant}).json()["answer"]
+
+    @override_settings(RAG_TENANT_HEADER_ENABLED=True)
+    def test_tenants_only_see_their_own_documents(self):
+        acme = tenant_collection_name("header:acme")
+        index_document(sample_document(" ".join(f"Acme revenue in {2000 + i} was ${i}B." for i in range(40))),
+                       collection_name=acme)
+
+        self.assertEqual(self.ask("acme"), "answer")
+        self.assertEqual(self.ask("globex"), "No documents uploaded.")
+
+    @override_settings(RAG_TENANT_HEADER_ENABLED=True)
+    def test_clear_only_removes_the_callers_documents(self):
+        for tenant in ("acme", "globex"):
+            index_document(sample_document(" ".join(f"{tenant} backlog {i} was ${i}M." for i in range(40))),
+                           collection_name=tenant_collection_name(f"header:{tenant}"))
+
+        self.client.post("/rag/clear_docs/", headers={"X-Tenant-ID": "acme"})
+
+        self.assertEqual(get_collection(tenant_collection_name("header:acme")).count(), 0)
+        self.assertGreater(get_collection(tenant_collection_name("header:globex")).count(), 0)
+        self.assertEqual(Document.objects.filter(collection=tenant_collection_name("header:globex")).count(), 1)
+
+    def test_requests_without_a_header_get_a_session_tenant(self):
+        self.client.post("/rag/clear_docs/")
+        self.assertIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+
+    @override_settings(RAG_TENANT_HEADER_ENABLED=True)
+    def test_document_endpoint_only_shows_and_deletes_own_documents(self):
+        acme = tenant_collection_name("header:acme")
+        indexed = index_document(sample_document(" ".join(f"Acme revenue in {2000 + i} was ${i}B." for i in range(40))),
+                                 collection_name=acme)
+        url = f"/rag/documents/{indexed['document']}/"
+
+        self.assertEqual(self.client.get("/rag/documents/", headers={"X-Tenant-ID": "globex"}).json(), [])
+        self.assertEqual(self.client.get(url, headers={"X-Tenant-ID": "globex"}).status_code, 404)
+        self.assertEqual(self.client.delete(url, headers={"X-Tenant-ID": "globex"}).status_code, 404)
+        self.assertEqual(self.client.put(url, {"title": "x"}, content_type="application/json",
+                                         headers={"X-Tenant-ID": "acme"}).status_code, 405)
+        self.assertEqual(len(self.client.get("/rag/documents/", headers={"X-Tenant-ID": "acme"}).json()), 1)
+
+        self.assertEqual(self.client.delete(url, headers={"X-Tenant-ID": "acme"}).status_code, 204)
+        self.assertFalse(Document.objects.filter(collection=acme).exists())
+        # its vectors went with it
+        self.assertEqual(get_collection(acme).count(), 0)
+
+    @override_settings(RAG_TENANT_HEADER_ENABLED=True)
+    def test_logged_in_user_is_the_tenant_whatever_the_header(self):
+        from django.contrib.auth.models import User
+
+        user = User.objects.create_user("analyst", password="secret")
+        self.client.force_login(user)
+        index_document(sample_document(" ".join(f"Acme revenue in {2000 + i} was ${i}B." for i in range(40))),
+                       collection_name=tenant_collection_name("header:acme"))
+        # naming someone else's tenant in the header does not reach their documents
+        self.assertEqual(self.ask("acme"), "No documents uploaded.")
+
+    def test_header_is_ignored_by_default(self):
+        index_document(sample_document(" ".join(f"Acme revenue in {2000 + i} was ${i}B." for i in range(40))),
+                       collection_name=tenant_collection_name("header:acme"))
+        self.assertEqual(self.ask("acme"), "No documents uploaded.")
+
+    def test_header_only_caller_cannot_reach_a_session_tenant(self):
+        self.client.post("/rag/clear_docs/")
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        index_document(sample_document(" ".join(f"Acme revenue in {2000 + i} was ${i}B." for i in range(40))),
+                       collection_name=tenant_collection_name(f"session:{session_key}"))
+        self.assertEqual(self.ask("anything"), "answer")
+
+        # another client without the cookie, naming the session (or anything else) in the header
+        self.client = self.client_class()
+        self.assertEqual(self.ask(session_key), "No documents uploaded.")
+        self.assertEqual(self.ask(f"session:{session_key}"), "No documents uploaded.")
+
+    @override_settings(RAG_TENANT_MAX_CHUNKS=10)
+    def test_tenant_quota_stops_ingest(self):
+        with self.assertRaises(TenantQuotaExceeded):
+            index_document(sample_document(" ".join(f"Capex in month {i} was ${i}M." for i in range(100))),
+                           collection_name=tenant_collection_name("header:acme"))
+
+    @override_settings(RAG_TENANT_MAX_CHUNKS=10)
+    def test_ingest_stopped_half_way_leaves_nothing_behind(self):
+        acme = tenant_collection_name("header:acme")
+        version = corpus_version(acme)
+        # small steps, so a few are stored before the quota is hit
+        with mock.patch.object(indexing, "INDEX_STEP_SIZE", 4), self.assertRaises(TenantQuotaExceeded):
+            index_document(sample_document(" ".join(f"Capex in month {i} was ${i}M." for i in range(100))),
+                           collection_name=acme)
+
+        self.assertEqual(get_collection(acme).count(), 0)
+        self.assertFalse(Document.objects.filter(collection=acme).exists())
+        self.assertFalse(Chunk.objects.filter(document__collection=acme).exists())
+        self.assertNotEqual(corpus_version(acme), version)
+
+
+class MetadataFilterTests(VectorStoreTestCase):
+
+    def index(self, company, date_filed, doc_type="10-K"):
+        document = sample_document(" ".join(f"{company} revenue in quarter {i} was ${i}B." for i in range(40)),
+                                   f"{company}.txt")
+        document.update(company=company, doc_type=doc_type, date_filed=date_filed)
+        index_document(document)
+
+    def search(self, filters, top_k=5):
+        return search_vector(get_collection(), embed_query("revenue"), top_k=top_k, where=build_where(filters))
+
+    def test_filters_become_a_where_clause(self):
+        self.assertIsNone(build_where({}))
+        self.assertEqual(build_where({"company": "Apple"}), {"company": "Apple"})
+        where = build_where({"company": ["Apple", "Microsoft"], "date_from": "2024-01-01"})
+        self.assertEqual(where["$and"][0], {"company": {"$in": ["Apple", "Microsoft"]}})
+        self.assertEqual(where["$and"][1], {"date_filed_ts": {"$gte": 1704067200}})
+        with self.assertRaises(InvalidFilter):
+            build_where({"ticker": "AAPL"})
+        with self.assertRaises(InvalidFilter):
+            build_where({"date_to": "last year"})
+
+    def test_filtered_search_still_returns_top_k_matches(self):
+        self.index("Apple", "2023-10-27")
+        self.index("Microsoft", "2024-07-30")
+
+        results = self.search({"company": "Microsoft"})
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result["metadata"]["company"] == "Microsoft" for result in results))
+
+        results = self.search({"date_from": "2023-01-01", "date_to": "2023-12-31"})
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result["metadata"]["company"] == "Apple" for result in results))
+
+    def test_ask_rejects_unknown_filters(self):
+        response = self.client.post("/rag/ask/", {"query": "q", "filters": {"ticker": "AAPL"}},
+                                    content_type="application/json", headers={"X-Tenant-ID": "acme"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_short_and_boilerplate_chunks_are_not_indexed(self):
+        self.assertFalse(is_indexable("Page 12 of 140"))
+        self.assertFalse(is_indexable("Table of Contents"))
+        self.assertFalse(is_indexable("42"))
+        self.assertTrue(is_indexable("Net sales increased 2% to $383.3 billion in 2023."))
+
+
+class LexicalIndexTests(SimpleTestCase):
+
+    def test_exact_tokens_rank_first_and_filters_apply(self):
+        index = LexicalIndex()
+        index.add([
+            ("a", "Apple reported FY2023 net sales of $383.3 billion.", {"company": "Apple"}),
+            ("b", "Microsoft revenue grew in fiscal year 2024.", {"company": "Microsoft"}),
+            ("c", "Net sales by segment for FY2022.", {"company": "Apple"}),
+        ])
+        self.assertEqual([chunk_id for chunk_id, _ in index.search("FY2023 net sales")][:2], ["a", "c"])
+        self.assertEqual([chunk_id for chunk_id, _ in index.search("net sales", where={"company": "Microsoft"})], [])
+        self.assertEqual(index.search("dividends"), [])
+
+    def test_chunks_are_added_incrementally(self):
+        index = LexicalIndex()
+        index.add([("a", "Goodwill impairment of $2B.", {})])
+        index.add([("b", "Goodwill was unchanged.", {}), ("a", "Goodwill impairment of $2B.", {})])
+        self.assertEqual(len(index), 2)
+        self.assertEqual({chunk_id for chunk_id, _ in index.search("goodwill")}, {"a", "b"})
+
+    def test_reciprocal_rank_fusion_prefers_ids_both_lists_agree_on(self):
+        fused = reciprocal_rank_fusion([["x", "y", "z"], ["y", "w"]])
+        self.assertEqual(fused[0], "y")
+        self.assertEqual(set(fused), {"x", "y", "z", "w"})
+
+
+class HybridRetrievalTests(VectorStoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        text = " ".join(f"Segment {i} operating income was ${i}M in the quarter." for i in range(60))
+        index_document(sample_document(text + " The ticker ZQXW closed the year at $12.", "filing.txt"))
+
+    def retrieve(self, mode):
+        collection = get_collection()
+        return retrieve(collection, "ZQXW ticker", embed_query("zqxw ticker"), top_k=3, mode=mode)
+
+    def test_lexical_and_hybrid_find_the_exact_token(self):
+        self.assertIn("ZQXW", self.retrieve("lexical")[0]["content"])
+        self.assertTrue(any("ZQXW" in result["content"] for result in self.retrieve("hybrid")))
+
+    def test_index_catches_up_with_rows_from_other_workers_and_clears(self):
+        get_lexical_index(get_collection().name)
+        # another worker's upload: rows and version change, nothing added to this process's index
+        with mock.patch("research.indexing.add_to_lexical_index"):
+            index_document(sample_document(" ".join(f"Warrant {i} expires in 2031." for i in range(30)), "w.txt"))
+        self.assertTrue(get_lexical_index(get_collection().name).search("warrant"))
+
+        clear_index()
+        self.assertEqual(len(get_lexical_index(get_collection().name)), 0)
+
+
+class FakeCrossEncoder:
+    """
+    stands in for the CrossEncoder, a chunk scores one point per question word it contains
+    """
+
+    def __init__(self):
+        self.scored = 0
+
+    def predict(self, pairs, **kwargs):
+        self.scored += len(pairs)
+        return np.array([sum(word in text.lower() for word in query.lower().split()) for query, text in pairs],
+                        dtype=np.float32)
+
+
+class RerankTests(SimpleTestCase):
+
+    def setUp(self):
+        self.model = FakeCrossEncoder()
+        patcher = mock.patch("research.rerank.get_reranker", return_value=self.model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.candidates = [
+            {"id": "a", "content": "Dividends were unchanged.", "metadata": {}},
+            {"id": "b", "content": "Goodwill impairment hit operating margin.", "metadata": {}},
+            {"id": "c", "content": "Operating margin widened.", "metadata": {}},
+        ]
+
+    def test_best_candidates_first_and_scores_cached(self):
+        reranker = CrossEncoderReranker(batch_size=2, budget_ms=None)
+        ranked = reranker.rerank("goodwill operating margin", self.candidates, top_k=2)
+        self.assertEqual([result["id"] for result in ranked], ["b", "c"])
+        self.assertEqual(self.model.scored, 3)
+
+        reranker.rerank("Goodwill  operating margin", self.candidates, top_k=2)
+        self.assertEqual(self.model.scored, 3)
+        self.assertEqual(reranker.stats()["score_cache"]["hits"], 3)
+
+    def test_over_budget_keeps_retrieval_order(self):
+        reranker = CrossEncoderReranker(budget_ms=50)
+        # earlier questions showed a pair takes 100ms
+        reranker.seconds_per_pair = 0.1
+        timings = {}
+        ranked = reranker.rerank("goodwill operating margin", self.candidates, top_k=2, timings=timings)
+        self.assertEqual([result["id"] for result in ranked], ["a", "b"])
+        self.assertEqual(self.model.scored, 0)
+        self.assertTrue(timings["rerank_skipped"])
+        self.assertEqual(reranker.stats()["skipped"], 1)
+
+
+@override_settings(RAG_RERANK_ENABLED=True, RAG_RERANK_CANDIDATES=10, RAG_RERANK_BUDGET_MS=None)
+class RerankedPipelineTests(VectorStoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_rerank_stage()
+        self.addCleanup(reset_rerank_stage)
+        self.cross_encoder = FakeCrossEncoder()
+        patcher = mock.patch("research.rerank.get_reranker", return_value=self.cross_encoder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_candidate_pool_is_reranked_down_to_top_k(self):
+        index_document(sample_document(" ".join(f"Segment {i} revenue was ${i}B in the year." for i in range(60))))
+        timings = {}
+        with mock.patch("research.rag_pipeline.generate_response", return_value="It grew.") as generate:
+            run_rag_pipeline("segment revenue", top_k=2, mode="dense", timings=timings)
+        self.assertEqual(self.cross_encoder.scored, 10)
+        # the two best chunks, or one block when they are neighbours
+        self.assertIn("Source 1:", generate.call_args[0][0])
+        self.assertNotIn("Source 3:", generate.call_args[0][0])
+        self.assertTrue({"embed", "retrieve", "rerank", "generate"} <= set(timings))
+
+
+def search_result(chunk_id, content, document_id="doc", chunk_index=0):
+    return {"id": chunk_id, "content": content, "metadata": {
+        "company": "Apple", "doc_type": "10-K", "document_id": document_id, "chunk_index": chunk_index}}
+
+
+class ContextPackingTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("research.context_packing.get_tokenizer", return_value=WordTokenizer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_neighbouring_chunks_are_merged_with_the_overlap_once(self):
+        self.assertEqual(join_overlapping("net sales rose 8 percent", "rose 8 percent in Europe"),
+                         "net sales rose 8 percent in Europe")
+        blocks = merge_neighbours([
+            search_result("b", "segment two grew", chunk_index=5),
+            search_result("x", "other filing", document_id="other", chunk_index=4),
+            search_result("a", "segment one and segment two", chunk_index=4),
+        ])
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(blocks[0]["content"], "segment one and segment two grew")
+        self.assertEqual([result["id"] for result in blocks[0]["results"]], ["b", "a"])
+
+    @override_settings(RAG_PROMPT_MAX_TOKENS=150)
+    def test_best_chunks_fill_the_budget_and_the_rest_is_counted(self):
+        results = [search_result(str(i), " ".join(f"word{i}" for _ in range(30)), chunk_index=i * 2)
+                   for i in range(5)]
+        packed = pack_prompt("what happened?", results)
+
+        self.assertLessEqual(packed["prompt_tokens"], 150)
+        self.assertEqual(len(packed["prompt"].split()), packed["prompt_tokens"] - 1)
+        self.assertEqual(packed["sources"][0]["id"], "0")
+        self.assertNotIn("word4", packed["prompt"])
+        self.assertGreater(packed["dropped_tokens"], 0)
+        self.assertGreater(packed["dropped_chunks"], 0)
+
+    def test_tokenizer_load_failure_is_not_retried_per_count(self):
+        reset_tokenizer_fallback()
+        self.addCleanup(reset_tokenizer_fallback)
+        with mock.patch("research.context_packing.get_tokenizer", side_effect=OSError("offline")) as load:
+            self.assertEqual(count_tokens("net sales grew"), 3)
+            self.assertEqual(count_tokens("margins fell"), 2)
+        self.assertEqual(load.call_count, 1)
+
+
+class InferenceBackendTests(SimpleTestCase):
+
+    @override_settings(RAG_INFERENCE_BACKEND="int8", RAG_GENERATION_BACKEND="onnx")
+    def test_per_model_backend_overrides_the_default(self):
+        self.assertEqual(embedding_backend(), "int8")
+        self.assertEqual(generation_backend(), "onnx")
+        with override_settings(RAG_EMBEDDING_BACKEND="tensorrt"):
+            with self.assertRaises(ValueError):
+                embedding_backend()
+
+    @override_settings(RAG_STUB_GENERATION_MS=0)
+    def test_stub_backend_is_deterministic_and_loads_no_model(self):
+        model = load_embedding_model("all-MiniLM-L6-v2", "stub")
+        vectors = model.encode(["net sales grew", "net sales grew", "goodwill impairment"])
+        np.testing.assert_array_equal(vectors[0], vectors[1])
+        self.assertAlmostEqual(float(np.linalg.norm(vectors[2])), 1.0, places=5)
+
+        generator = load_generator("google/flan-t5-base", "stub")
+        prompt = "CONTEXT:\nSource 1:\nContent:\nNet sales were $10B. Margins fell.\n\nQUESTION:\nNet sales?"
+        self.assertEqual(generator([prompt])[0]["generated_text"], "Net sales were $10B.")
+
+    def test_vectors_are_cached_per_backend(self):
+        model = FakeEmbeddingModel()
+        patcher = mock.patch("research.embeddings.get_embedding_model", return_value=model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        reset_embedding_cache()
+        self.addCleanup(reset_embedding_cache)
+
+        embed_texts(["Revenue grew 8 percent."])
+        embed_texts(["Revenue grew 8 percent."])
+        self.assertEqual(model.encoded, 1)
+        with override_settings(RAG_EMBEDDING_BACKEND="int8"):
+            embed_texts(["Revenue grew 8 percent."])
+        self.assertEqual(model.encoded, 2)
+
+
+class TracingTests(VectorStoreTestCase):
+
+    def test_stages_on_executor_threads_join_the_request_trace(self):
+        executor = BoundedExecutor(max_workers=1)
+
+        def work():
+            with stage("test_worker_stage") as record:
+                record["chunks"] = 3
+
+        with start_trace("test") as trace:
+            with stage("test_caller_stage"):
+                time.sleep(0.01)
+            executor.submit(work).result()
+
+        breakdown = trace.breakdown()
+        self.assertGreaterEqual(breakdown["stages"]["test_caller_stage"]["wall_ms"], 10)
+        self.assertEqual(breakdown["stages"]["test_worker_stage"]["chunks"], 3)
+        self.assertGreaterEqual(breakdown["total_ms"], breakdown["stages"]["test_caller_stage"]["wall_ms"])
+
+    def test_ask_returns_timings_and_metrics_are_exported(self):
+        tenant = {"X-Tenant-ID": "acme"}
+        with override_settings(RAG_TENANT_MODE="shared"):
+            index_document(sample_document(" ".join(f"Segment {i} revenue was ${i}B." for i in range(40))))
+            with mock.patch("research.rag_pipeline.generate_response", return_value="It grew a lot."):
+                body = self.client.post("/rag/ask/", {"query": "segment revenue", "timings": True},
+                                        content_type="application/json", headers=tenant).json()
+
+        stages = body["timings"]["stages"]
+        self.assertTrue({"embed", "retrieve", "augment", "generate"} <= set(stages))
+        self.assertEqual(stages["generate"]["tokens"], 4)
+        self.assertGreater(stages["augment"]["tokens"], 0)
+
+        metrics = self.client.get("/rag/metrics/")
+        self.assertTrue(metrics["Content-Type"].startswith("text/plain"))
+        text = metrics.content.decode()
+        self.assertIn("# TYPE rag_stage_wall_seconds histogram", text)
+        self.assertIn('rag_stage_wall_seconds_bucket{stage="retrieve",le="+Inf"}', text)
+        self.assertIn('rag_stage_chunks_count{stage="embed_chunks"}', text)
+
+
+
+class ExactVectorStoreTests(VectorStoreTestCase):
+
+    def random_chunks(self, count, seed=0, dimension=16):
+        rng = np.random.default_rng(seed)
+        vectors = rng.standard_normal((count, dimension)).astype(np.float32)
+        companies = ["Apple", "Microsoft", "Nvidia"]
+        metadatas = [{"company": companies[i % 3], "doc_type": "10-K" if i % 2 else "10-Q",
+                      "date_filed_ts": 1_600_000_000 + i * 86400} for i in range(count)]
+        return [f"chunk-{i}" for i in range(count)], [f"text {i}" for i in range(count)], vectors, metadatas
+
+    def test_exact_search_and_filters_match_chroma(self):
+        ids, documents, vectors, metadatas = self.random_chunks(300)
+        chroma = chroma_store("exact_vs_chroma")
+        chroma.add(ids=ids, documents=documents, embeddings=vectors, metadatas=metadatas)
+        for dtype in ("float32", "float16"):
+            exact = ExactVectorStore("exact_vs_chroma", dtype=dtype, mmap_dir=tempfile.gettempdir())
+            exact.append(ids, documents, vectors, metadatas)
+            query = np.random.default_rng(1).standard_normal(16).astype(np.float32)
+            for where in (None, {"company": "Apple"}, {"company": {"$in": ["Apple", "Nvidia"]}},
+                          build_where({"company": "Microsoft", "date_from": "2020-10-01"}),
+                          {"$or": [{"doc_type": "10-K"}, {"company": {"$ne": "Apple"}}]}):
+                expected = [result["id"] for result in chroma.search(query, top_k=5, where=where)]
+                found = exact.search(query, top_k=5, where=where)
+                self.assertEqual([result["id"] for result in found], expected, f"{dtype} {where}")
+                self.assertTrue(all(result["metadata"] == metadatas[ids.index(result["id"])] for result in found))
+            self.assertEqual(exact.search(query, top_k=5, where={"company": "Tesla"}), [])
+
+    def test_auto_backend_follows_corpus_size_and_other_workers(self):
+        with override_settings(RAG_EXACT_MAX_CHUNKS=10):
+            index_document(sample_document(" ".join(f"Segment {i} revenue was ${i}B." for i in range(20))))
+            store = get_collection()
+            self.assertIsInstance(store, ExactVectorStore)
+            self.assertEqual(store.count(), chroma_store().count())
+            self.assertEqual(search_vector(store, embed_query("segment revenue"), top_k=2)[0]["id"],
+                             search_vector(chroma_store(), embed_query("segment revenue"), top_k=2)[0]["id"])
+
+            # another worker stores chunks, this worker's index catches up on the next corpus version
+            ids, documents, vectors, metadatas = self.random_chunks(4, dimension=self.model.dimension)
+            chroma_store().add(ids=ids, documents=documents, embeddings=vectors, metadatas=metadatas)
+            indexing.corpus_changed(store.name)
+            self.assertEqual(get_collection().count(), store.count())
+            self.assertIn("chunk-3", get_collection().existing_ids(["chunk-3"]))
+
+            # past RAG_EXACT_MAX_CHUNKS chroma answers the searches
+            ids, documents, vectors, metadatas = self.random_chunks(20, seed=2, dimension=self.model.dimension)
+            chroma_store().add(ids=[f"more-{i}" for i in ids], documents=documents, embeddings=vectors,
+                               metadatas=metadatas)
+            indexing.corpus_changed(store.name)
+            self.assertIsInstance(get_collection(), ChromaVectorStore)
+
+        clear_index()
+        self.assertIsInstance(get_collection(), ExactVectorStore)
+        self.assertEqual(get_collection().count(), 0)
+
+
+class HnswTuningTests(VectorStoreTestCase):
+
+    def test_hnsw_settings_apply_per_collection(self):
+        with override_settings(RAG_HNSW={"M": 12}, RAG_HNSW_COLLECTIONS={"tuned_collection": {"search_ef": 40}}):
+            self.assertEqual(hnsw_settings("tuned_collection"), {"M": 12, "construction_ef": 100, "search_ef": 40})
+            configuration = chroma_store("tuned_collection").collection.configuration["hnsw"]
+            self.assertEqual((configuration["max_neighbors"], configuration["ef_search"]), (12, 40))
+            self.assertEqual(chroma_store("other_collection").collection.configuration["hnsw"]["ef_search"], 100)
+        # search_ef of an existing collection follows the settings, M stays what it was built with
+        with override_settings(RAG_HNSW_COLLECTIONS={"tuned_collection": {"search_ef": 80, "M": 32}}):
+            configuration = chroma_store("tuned_collection").collection.configuration["hnsw"]
+            self.assertEqual((configuration["max_neighbors"], configuration["ef_search"]), (12, 80))
+        with override_settings(RAG_HNSW={"ef": 10}):
+            with self.assertRaises(ValueError):
+                hnsw_settings()
+
+    def test_sweep_measures_recall_against_exact_search_and_recommends(self):
+        from django.core.management import call_command
+
+        index_document(sample_document(" ".join(f"Segment {i} revenue was ${i}B in fiscal {2000 + i}." for i in range(60))))
+        output = os.path.join(tempfile.mkdtemp(), "hnsw.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(output), ignore_errors=True)
+        stdout = io.StringIO()
+        call_command("tune_hnsw", "--m", "4,16", "--construction-ef", "64", "--search-ef", "8,100", "--queries", "5",
+                     "--top-k", "3", "--output", output, stdout=stdout)
+
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(len(report["rows"]), 4)
+        for row in report["rows"]:
+            self.assertTrue(0 <= row["recall"] <= 1)
+            # measured from the index files, at least the stored vectors themselves (float32)
+            self.assertGreaterEqual(row["index_bytes"], report["vectors"] * report["dimension"] * 4)
+            self.assertGreater(row["est_index_bytes"], 0)
+        self.assertGreaterEqual(report["recommended"]["recall"], 0.95)
+        self.assertIn("RAG_HNSW_COLLECTIONS", stdout.getvalue())
+
+
+class RetrievalEvaluationTests(SimpleTestCase):
+
+    @override_settings(RAG_INFERENCE_BACKEND="stub")
+    def test_command_reports_recall_mrr_and_latency_per_configuration(self):
+        from django.core.management import call_command
+
+        reset_embedding_cache()
+        self.addCleanup(reset_embedding_cache)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir, ignore_errors=True)
+        output = os.path.join(output_dir, "eval.json")
+        stdout = io.StringIO()
+        call_command("evaluate_retrieval", "--chunk-sizes", "200,300", "--modes", "dense,lexical",
+                     "--top-k", "1,5", "--hnsw-m", "default,8", "--output", output, stdout=stdout)
+
+        self.assertIn("recall@k", stdout.getvalue())
+        with open(output) as f:
+            rows = json.load(f)["rows"]
+        # 2 chunk sizes x 2 hnsw settings x 2 modes x 2 ks
+        self.assertEqual(len(rows), 16)
+        for row in rows:
+            self.assertGreater(row["chunks"], 0)
+            self.assertGreaterEqual(row["p95_ms"], row["p50_ms"])
+        lexical_at_5 = [row for row in rows if row["mode"] == "lexical" and row["top_k"] == 5]
+        # exact numbers and names are easy for bm25 on this corpus
+        self.assertTrue(all(row["recall"] >= 0.8 for row in lexical_at_5))
+        at_1 = {(row["chunk_size"], row["mode"], row["hnsw"]["M"]): row["recall"] for row in rows if row["top_k"] == 1}
+        for row in rows:
+            if row["top_k"] == 5:
+                self.assertGreaterEqual(row["recall"], at_1[(row["chunk_size"], row["mode"], row["hnsw"]["M"])])
+
+    @override_settings(RAG_INFERENCE_BACKEND="stub")
+    def test_every_configuration_pays_for_its_own_encoding(self):
+        from research import embeddings
+        from research.management.commands.evaluate_retrieval import DEFAULT_DATASET, evaluate, load_dataset
+
+        reset_embedding_cache()
+        self.addCleanup(reset_embedding_cache)
+        dataset = load_dataset(DEFAULT_DATASET)
+        config = {"embedding_model": "all-MiniLM-L6-v2", "chunk_size": 300, "chunk_overlap": 50,
+                  "hnsw": {"M": None, "construction_ef": None, "search_ef": None}}
+        encoded = []
+        real_encode = embeddings._encode_batches
+
+        def counting_encode(texts, batch_size):
+            encoded.append(len(texts))
+            return real_encode(texts, batch_size)
+
+        with mock.patch("research.embeddings._encode_batches", side_effect=counting_encode):
+            rows = evaluate(dataset, [config, dict(config)], [3], ["dense"])
+
+        # the same configuration twice: chunks and questions are encoded again the second time
+        per_run = rows[0]["chunks"] + len(dataset["questions"])
+        self.assertEqual(sum(encoded), 2 * per_run)
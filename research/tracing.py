@@ -0,0 +1,138 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from research.metrics import LATENCY_BUCKETS, SIZE_BUCKETS, TOKEN_BUCKETS, histogram
+
+# PIPELINE TRACING
+# every stage of the pipeline (embed, retrieve, rerank, augment, generate on the question side,
+# extract/chunk, embed_chunks and store on the upload side) runs inside `with stage("name") as record:`.
+# a stage measures its wall time and the cpu time of its thread, the code inside can add counts
+# (record["tokens"] = ..., record["chunks"] = ...). every stage feeds the process wide histograms
+#   rag_stage_wall_seconds{stage}, rag_stage_cpu_seconds{stage}, rag_stage_tokens{stage}, rag_stage_chunks{stage}
+# that /rag/metrics/ exposes for prometheus. a request can also collect its own breakdown:
+# inside `with start_trace() as trace:` every stage is added to trace, also on executor threads
+# (the executor copies the context into its workers).
+# cpu time is the thread's own, a stage that waits for another thread (a micro-batched generation)
+# shows the wait as wall time with little cpu.
+
+COUNT_BUCKETS = {"tokens": TOKEN_BUCKETS, "chunks": SIZE_BUCKETS + (128, 256, 512, 1024)}
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("rag_trace", default=None)
+
+
+class Trace:
+    """
+    per-request breakdown: stage -> {"wall_ms", "cpu_ms", "tokens", "chunks", "calls"}
+    """
+
+    def __init__(self, name: str = "request"):
+        self.name = name
+        self.stages: Dict[str, Dict] = {}
+        self.started = time.perf_counter()
+        self.wall_ms = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, record: Dict):
+        # a stage that runs several times in one request (one embed_chunks per indexing step) is summed up
+        with self._lock:
+            entry = self.stages.setdefault(name, {"wall_ms": 0.0, "cpu_ms": 0.0, "calls": 0})
+            entry["calls"] += 1
+            for key, value in record.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    entry[key] = round(entry.get(key, 0) + value, 2)
+                else:
+                    entry[key] = value
+
+    def breakdown(self) -> Dict:
+        with self._lock:
+            stages = {name: dict(entry) for name, entry in self.stages.items()}
+        total = self.wall_ms if self.wall_ms is not None else (time.perf_counter() - self.started) * 1000
+        return {"total_ms": round(total, 2), "stages": stages}
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(name: str = "request"):
+    """
+    collect every stage that runs inside the with block (on this thread or the executor's) into one Trace
+    """
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.wall_ms = round((time.perf_counter() - trace.started) * 1000, 2)
+        histogram("rag_request_wall_seconds", LATENCY_BUCKETS, "Wall time of a traced request",
+                  {"request": name}).observe(trace.wall_ms / 1000)
+
+
+def observe_stage(name: str, record: Dict):
+    """
+    feed one finished stage into the histograms and the current trace
+    """
+    histogram("rag_stage_wall_seconds", LATENCY_BUCKETS, "Wall time of a pipeline stage",
+              {"stage": name}).observe(record["wall_ms"] / 1000)
+    # a stage whose work hopped between threads (the streamed generation) has no cpu time
+    if record.get("cpu_ms") is not None:
+        histogram("rag_stage_cpu_seconds", LATENCY_BUCKETS, "CPU time of the thread running a pipeline stage",
+                  {"stage": name}).observe(record["cpu_ms"] / 1000)
+    for key, buckets in COUNT_BUCKETS.items():
+        if record.get(key) is not None:
+            histogram(f"rag_stage_{key}", buckets, f"{key.capitalize()} handled by a pipeline stage",
+                      {"stage": name}).observe(record[key])
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, record)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    time the with block as pipeline stage name, yields the record the block may add "tokens" / "chunks" to.
+    a stage that raises is still recorded, with "error" set
+    """
+    record: Dict = {}
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    except BaseException:
+        record["error"] = True
+        raise
+    finally:
+        record["wall_ms"] = round((time.perf_counter() - wall_start) * 1000, 2)
+        record["cpu_ms"] = round((time.thread_time() - cpu_start) * 1000, 2)
+        observe_stage(name, record)
+
+
+def traced_iter(name: str, items):
+    """
+    yield from items, timing only the time spent producing them (not the consumer's work between items)
+    as one stage with the number of items as "chunks". used for the streamed extract and chunk stage
+    """
+    record = {"wall_ms": 0.0, "cpu_ms": 0.0, "chunks": 0}
+    iterator = iter(items)
+    try:
+        while True:
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                record["wall_ms"] += (time.perf_counter() - wall_start) * 1000
+                record["cpu_ms"] += (time.thread_time() - cpu_start) * 1000
+            record["chunks"] += 1
+            yield item
+    finally:
+        record["wall_ms"] = round(record["wall_ms"], 2)
+        record["cpu_ms"] = round(record["cpu_ms"], 2)
+        observe_stage(name, record)
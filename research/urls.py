@@ -1,7 +1,10 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import DocumentViewSet, query_rag
-from .views import ask_rag, upload_document, clear_docs
+from .views import ask_rag, ask_stream, upload_document, clear_docs
+from .views import ask_rag_async, upload_document_async
+from .views import ingestion_job
+from .views import model_health, warm_up_models, metrics
 
 router = DefaultRouter()
 router.register(r'documents', DocumentViewSet, basename='document')
@@ -10,6 +13,13 @@ urlpatterns = [
     path('', include(router.urls)),
     path('query/', query_rag, name='query-rag'),
     path("ask/", ask_rag),
+    path("ask/stream/", ask_stream, name="ask-stream"),
     path('upload/', upload_document, name='upload-document'),
+    path('jobs/<int:job_id>/', ingestion_job, name='ingestion-job'),
     path('clear_docs/', clear_docs, name='clear-documents'),
+    path('async/ask/', ask_rag_async, name='ask-rag-async'),
+    path('async/upload/', upload_document_async, name='upload-document-async'),
+    path('models/health/', model_health, name='model-health'),
+    path('models/warmup/', warm_up_models, name='model-warmup'),
+    path('metrics/', metrics, name='metrics'),
 ]
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import threading
+import uuid
+from typing import Dict, Iterable, List, Set
+
+from django.conf import settings
+
+# PERSISTENT VECTOR STORE
+# one chromadb client per process, opened on first use and shared by the pipeline and the views.
+# the client writes to CHROMA_PERSIST_DIR so the index survives restarts, and every worker on the
+# same host opens the same directory instead of rebuilding its own in-memory copy.
+# set CHROMA_PERSIST_DIR = None to get the old in-memory behaviour (used by the tests).
+# every tenant (session or X-Tenant-ID, see research/tenancy.py) has its own collection. with
+# CHROMA_MEMORY_LIMIT_BYTES set, chroma keeps loaded collection indexes in an LRU cache under that
+# budget and unloads the least recently used (idle) ones first, they are reloaded from disk on use.
+# the pipeline talks to a collection through the VectorStore interface below. chroma is always
+# where chunks are stored, small collections are searched by an exact in-process numpy index that
+# mirrors them (research/exact_index.py), see RAG_VECTOR_BACKEND.
+
+DEFAULT_COLLECTION_NAME = "financial_documents"
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    return the process wide chromadb client, opening it the first time
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # imported on first use, chromadb is slow to import
+                import chromadb
+                from chromadb.config import Settings
+                persist_dir = getattr(settings, "CHROMA_PERSIST_DIR", None)
+                memory_limit = getattr(settings, "CHROMA_MEMORY_LIMIT_BYTES", None)
+                options = {}
+                if memory_limit:
+                    options = {"chroma_segment_cache_policy": "LRU", "chroma_memory_limit_bytes": int(memory_limit)}
+                client_settings = Settings(**options)
+                if persist_dir:
+                    _client = chromadb.PersistentClient(path=str(persist_dir), settings=client_settings)
+                else:
+                    _client = chromadb.Client(client_settings)
+    return _client
+
+
+def reset_client():
+    """
+    forget the current client so the next call opens CHROMA_PERSIST_DIR again (tests, settings changes)
+    """
+    global _client
+    with _client_lock:
+        _client = None
+    # the exact indexes mirror collections of the old client
+    from research.exact_index import drop_exact_index
+    drop_exact_index()
+
+
+def collection_name() -> str:
+    return getattr(settings, "CHROMA_COLLECTION_NAME", DEFAULT_COLLECTION_NAME)
+
+
+def tenant_collection_name(tenant: str = None) -> str:
+    """
+    collection of one tenant. the tenant id is hashed so any session key or header value
+    gives a valid chroma name (3-63 characters of [a-zA-Z0-9._-]). no tenant = the shared collection
+    """
+    if not tenant:
+        return collection_name()
+    return f"{collection_name()}_{hashlib.sha256(tenant.encode('utf-8')).hexdigest()[:16]}"
+
+
+VECTOR_BACKENDS = ("auto", "chroma", "exact")
+# auto: collections up to this many chunks are searched by the exact index, bigger ones by chroma's hnsw
+DEFAULT_EXACT_MAX_CHUNKS = 20000
+
+
+def vector_backend() -> str:
+    backend = getattr(settings, "RAG_VECTOR_BACKEND", "auto")
+    if backend not in VECTOR_BACKENDS:
+        raise ValueError(f"Unknown vector backend '{backend}', expected one of {', '.join(VECTOR_BACKENDS)}")
+    return backend
+
+
+def exact_max_chunks() -> int:
+    return getattr(settings, "RAG_EXACT_MAX_CHUNKS", DEFAULT_EXACT_MAX_CHUNKS)
+
+
+class VectorStore:
+    """
+    what the pipeline needs from a collection: store chunks with their embeddings and
+    return the top_k chunks closest to a query embedding as [{"id", "content", "metadata"}, ...] best first.
+    where is a chroma style metadata filter (research/filters.py build_where)
+    """
+
+    backend = None
+    name = None
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        raise NotImplementedError
+
+    def add(self, ids: List[str], documents: List[str], embeddings, metadatas: List[Dict]):
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    def search(self, query_embedding, top_k: int = 3, where: Dict = None) -> List[Dict]:
+        raise NotImplementedError
+
+
+class ChromaVectorStore(VectorStore):
+    """
+    a chromadb collection: persistent, approximate (hnsw) search, filters applied inside the search
+    """
+
+    backend = "chroma"
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.name = collection.name
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        return set(self.collection.get(ids=list(ids), include=[])["ids"])
+
+    def add(self, ids: List[str], documents: List[str], embeddings, metadatas: List[Dict]):
+        # collection.add stores ids, documents, embeddings, and metadata in one table
+        self.collection.add(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+
+    def delete(self, ids: List[str]):
+        self.collection.delete(ids=list(ids))
+
+    def search(self, query_embedding, top_k: int = 3, where: Dict = None) -> List[Dict]:
+        results = self.collection.query(
+            # this is the meaning of the users question
+            query_embeddings=[query_embedding],
+            # give me the top_k results
+            n_results=top_k,
+            where=where
+        )
+        return [
+            {"id": chunk_id, "content": doc, "metadata": meta}
+            for chunk_id, doc, meta in zip(results['ids'][0], results['documents'][0], results['metadatas'][0])
+        ]
+
+    def iter_rows(self, ids: Iterable[str] = None, batch_size: int = 1000):
+        """
+        yield (ids, documents, embeddings, metadatas) slices of the stored chunks, all of them without ids
+        """
+        ids = list(self.collection.get(include=[])["ids"]) if ids is None else list(ids)
+        for start in range(0, len(ids), batch_size):
+            rows = self.collection.get(ids=ids[start:start + batch_size],
+                                       include=["documents", "embeddings", "metadatas"])
+            yield rows["ids"], rows["documents"], rows["embeddings"], rows["metadatas"]
+
+
+# HNSW PARAMETERS
+# chroma's approximate search is an hnsw graph with three knobs:
+#   M                neighbours per node, more = better recall and more memory, slower build
+#   construction_ef  candidates looked at while inserting, more = better graph, slower build
+#   search_ef        candidates looked at per query, more = better recall, slower search
+# RAG_HNSW sets them for every collection, RAG_HNSW_COLLECTIONS per collection name on top of it.
+# M and construction_ef are fixed when chroma creates a collection (new tenants, rebuild_index).
+# search_ef is also written to existing collections, chroma uses it once it loads the index again
+# (next process start). `manage.py tune_hnsw` measures the trade off and recommends values.
+HNSW_PARAMETERS = ("M", "construction_ef", "search_ef")
+# chroma's own defaults
+DEFAULT_HNSW = {"M": 16, "construction_ef": 100, "search_ef": 100}
+
+
+def hnsw_settings(name: str = None) -> Dict:
+    """
+    the hnsw parameters of a collection: the defaults, RAG_HNSW, then RAG_HNSW_COLLECTIONS[name]
+    """
+    name = name or collection_name()
+    params = dict(DEFAULT_HNSW)
+    params.update(getattr(settings, "RAG_HNSW", None) or {})
+    params.update((getattr(settings, "RAG_HNSW_COLLECTIONS", None) or {}).get(name, {}))
+    unknown = set(params) - set(HNSW_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown hnsw parameter(s) {', '.join(sorted(unknown))} for collection '{name}', "
+                         f"expected {', '.join(HNSW_PARAMETERS)}")
+    return params
+
+
+def hnsw_metadata(params: Dict) -> Dict:
+    """
+    chroma collection metadata for cosine search with these hnsw parameters (None = chroma's default)
+    """
+    metadata = {"hnsw:space": "cosine"}
+    metadata.update({f"hnsw:{key}": int(value) for key, value in params.items() if value is not None})
+    return metadata
+
+
+def chroma_store(name: str = None) -> ChromaVectorStore:
+    """
+    the chroma collection that holds every chunk and embedding, created the first time
+    """
+    name = name or collection_name()
+    params = hnsw_settings(name)
+    # collection in chromadb is a table database that holds all your doc chunks and embeddings
+    # tells chroma to use cosine similarity for vector comparisons, with our hnsw parameters
+    collection = get_client().get_or_create_collection(name=name, metadata=hnsw_metadata(params))
+    # an existing collection keeps the M and construction_ef it was created with, search_ef follows the settings
+    configured = (collection.configuration or {}).get("hnsw") or {}
+    if params.get("search_ef") and configured.get("ef_search") not in (None, params["search_ef"]):
+        collection.modify(configuration={"hnsw": {"ef_search": int(params["search_ef"])}})
+    return ChromaVectorStore(collection)
+
+
+def get_collection(name: str = None) -> VectorStore:
+    """
+    return the collection that holds every chunk and embedding, creating it the first time
+    This is basically the brain of our RAG, this is the only data the RAG will ever generate responses off of.
+    with RAG_VECTOR_BACKEND "auto" a collection of at most RAG_EXACT_MAX_CHUNKS chunks comes back as its
+    exact in-process index (writes still go to chroma), "exact" always and "chroma" never does that
+    """
+    name = name or collection_name()
+    backend = vector_backend()
+    if backend != "chroma":
+        from research.exact_index import get_exact_store
+        store = get_exact_store(name, max_chunks=exact_max_chunks() if backend == "auto" else None)
+        if store is not None:
+            return store
+    return chroma_store(name)
+
+
+def delete_collection(name: str = None):
+    """
+    drop every chunk and embedding stored in the collection, on disk too
+    """
+    from research.exact_index import drop_exact_index
+    drop_exact_index(name or collection_name())
+    try:
+        get_client().delete_collection(name or collection_name())
+    except Exception:
+        # nothing to delete
+        pass
+
+
+# CORPUS VERSION
+# a random token that changes every time documents are added or cleared.
+# caches built on top of the index (answer cache) key their entries by it, so nothing computed
+# against an older corpus is ever served. with a persistent store the token lives next to the
+# index on disk, so an upload handled by one worker invalidates the caches of all the others.
+
+_versions = {}
+
+
+def _version_path(name: str):
+    persist_dir = getattr(settings, "CHROMA_PERSIST_DIR", None)
+    if not persist_dir:
+        return None
+    return os.path.join(str(persist_dir), "corpus_versions", name)
+
+
+def corpus_version(name: str = None) -> str:
+    """
+    current version token of a collection's contents
+    """
+    name = name or collection_name()
+    path = _version_path(name)
+    if path is not None:
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return "initial"
+    return _versions.get(name, "initial")
+
+
+def bump_corpus_version(name: str = None) -> str:
+    """
+    mark a collection's contents as changed, returns the new token
+    """
+    name = name or collection_name()
+    version = uuid.uuid4().hex
+    path = _version_path(name)
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so readers never see a half written token
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(version)
+        os.replace(tmp_path, path)
+    _versions[name] = version
+    return version
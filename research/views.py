@@ -1,131 +1,367 @@
 from django.shortcuts import render
-from rest_framework import viewsets, status
+from rest_framework import mixins, viewsets, status
 from rest_framework.response import Response
-from rest_framework.decorators import api_view,parser_classes
-from .models import Document
-from .serializers import DocumentSerializer
-from .rag_pipeline import run_rag_pipeline
+from rest_framework.decorators import api_view,parser_classes,permission_classes
+from rest_framework.permissions import IsAdminUser
+from .models import Document, IngestionJob
+from .serializers import DocumentSerializer, IngestionJobSerializer
+from .rag_pipeline import run_rag_pipeline, stream_prepared_answer
+from .rag_pipeline import prepare_answer, generate_response, finish_answer, RETRIEVAL_MODES
+from .executor import get_executor, ExecutorSaturated, StageTimeout
+from .batching import current_batcher
+from .indexing import clear_index, delete_document
+from .tenancy import collection_for_request, check_quota, TenantQuotaExceeded
+from .filters import build_where, upload_metadata, InvalidFilter
+from .jobs import enqueue_upload, ensure_local_workers, cancel_jobs, spool_upload, index_spooled_file
+from .model_registry import registry
+from .embedding_cache import get_embedding_cache
+from .answer_cache import get_answer_cache
+from .rerank import current_rerank_stage
+from .inference_backends import embedding_backend, generation_backend
+from .vector_store import vector_backend
+from .metrics import render_prometheus
+from .tracing import stage, start_trace
+from .context_packing import count_tokens
 from rest_framework.parsers import MultiPartParser, FormParser
-from PyPDF2  import PdfReader
 from datetime import date
-import PyPDF2
 from django.utils import timezone
-import re
-import chromadb
-import pdfplumber
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from asgiref.sync import sync_to_async
+import json
+import os
 
 
 # Create your views here.
 
-# In-memory storage for uploaded documents for session only
-TEMP_DOCS = []
+# Document list / detail / delete using viewset, scoped to the caller's tenant.
+# documents are created by uploading and their text lives in the index, so they cannot be
+# created or edited here, and a delete also removes the document's chunks from the index
+class DocumentViewSet(mixins.DestroyModelMixin, viewsets.ReadOnlyModelViewSet):
+    serializer_class = DocumentSerializer
 
+    def get_queryset(self):
+        # other tenants' documents do not exist as far as this caller is concerned
+        return Document.objects.filter(collection=collection_for_request(self.request)).order_by("pk")
 
-# Document CRUD using viewset
-class DocumentViewSet(viewsets.ModelViewSet):
-    queryset = Document.objects.all()
-    serializer_class = DocumentSerializer
+    def perform_destroy(self, instance):
+        delete_document(instance)
+
+def search_options(data):
+    """
+    metadata filter (as a chroma where clause) and retrieval mode of an ask request,
+    raises InvalidFilter for anything the pipeline cannot use
+    """
+    mode = data.get("mode")
+    if mode is not None and mode not in RETRIEVAL_MODES:
+        raise InvalidFilter(f"'mode' must be one of {', '.join(RETRIEVAL_MODES)}")
+    return build_where(data.get("filters")), mode
 
 # RAG query endpoint POST
 @api_view(['POST'])
 def query_rag(request):
     """
-    expects JSON: {"query": "your question"}
+    expects JSON: {"query": "your question", "filters": {...}, "mode": "hybrid"}, filters and mode are optional
     returns LLM answer
     """
     query = request.data.get("query")
     if not query:
         return Response({"error": "Query is required"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        where, mode = search_options(request.data)
+    except InvalidFilter as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-    response = run_rag_pipeline(query)
+    response = run_rag_pipeline(query, collection_name=collection_for_request(request), where=where, mode=mode)
     return Response({"response": response})
 
 
+def wants_timings(request, data) -> bool:
+    # {"timings": true} in the body or ?timings=1 adds the per-stage breakdown to the answer
+    return data.get("timings") in (True, "1", "true") or request.GET.get("timings") in ("1", "true")
+
 @api_view(['POST'])
 def ask_rag(request):
     query = request.data.get("query")
     if not query:
         return Response({"error": "Query is required"}, status=status.HTTP_400_BAD_REQUEST)
-    
-    # Pass TEMP_DOCS as first argument
-    answer = run_rag_pipeline(TEMP_DOCS, query)
+    # optional filters {"company": ..., "doc_type": ..., "date_from": ..., "date_to": ...}
+    # and mode dense | lexical | hybrid
+    try:
+        where, mode = search_options(request.data)
+    except InvalidFilter as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # documents were already indexed at upload time, this only embeds the question and searches
+    # the caller's own collection. every stage is traced (research/tracing.py)
+    with start_trace("ask") as trace:
+        answer = run_rag_pipeline(query, collection_name=collection_for_request(request), where=where, mode=mode)
 
+    if wants_timings(request, request.data):
+        return Response({"answer": answer, "timings": trace.breakdown()})
     return Response({"answer": answer})
 
-# allows the upload of documents via API
-def extract_text(file):
-    """
-    Extract text and tables from PDF using pdfplumber
-    """
-    if file.name.endswith(".txt"):
-        return file.read().decode("utf-8")
-    elif file.name.endswith(".pdf"):
-        text = ""
-        with pdfplumber.open(file) as pdf:
-            for page in pdf.pages:
-                # extract text
-                page_text = page.extract_text() or ""
-                text += page_text + "\n"
-
-                # extract tables if any
-                tables = page.extract_tables()
-                for table in tables:
-                    # convert table rows into string
-                    for row in table:
-                        text += " | ".join([str(cell) for cell in row if cell]) + "\n"
-        return text
-    else:
-        return ""
-    
+# streaming RAG query endpoint POST, server-sent events
+# serve through market_research/asgi.py (e.g. uvicorn market_research.asgi:application) so events
+# reach the client as they are produced, under WSGI the whole stream is buffered before sending
+@csrf_exempt
+async def ask_stream(request):
+    """
+    expects JSON: {"query": "your question", "filters": {...}, "mode": "hybrid"}
+    streams "sources" first, then a "token" event per piece of generated text, then "done"
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    try:
+        body = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    query = body.get("query")
+    if not query:
+        return JsonResponse({"error": "Query is required"}, status=400)
+    try:
+        where, mode = search_options(body)
+    except InvalidFilter as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    # the session lives in the database, look it up off the event loop
+    collection_name = await sync_to_async(collection_for_request)(request)
+    # embedding the question and retrieval run on the bounded executor like ask_rag_async,
+    # a busy server answers 503 (or 504) before the stream is opened
+    try:
+        prepared = await get_executor().run("retrieve", prepare_answer, query, collection_name=collection_name,
+                                            where=where, mode=mode)
+    except (ExecutorSaturated, StageTimeout) as e:
+        return executor_error_response(e)
+    response = StreamingHttpResponse(sse_events(query, prepared), content_type="text/event-stream")
+    # stop browsers and proxies (nginx) from caching or buffering the stream
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+def format_sse(event: dict) -> str:
+    """
+    one server-sent event, the "event" key becomes the event name and the rest the JSON data
+    """
+    payload = {key: value for key, value in event.items() if key != "event"}
+    return f"event: {event['event']}\ndata: {json.dumps(payload)}\n\n"
+
+async def sse_events(query: str, prepared: dict):
+    # generation is blocking (it waits for pieces from the executor, research/rag_pipeline.py stream_response),
+    # so every step runs in a worker thread and the event loop stays free to flush events and serve other requests
+    events = stream_prepared_answer(query, prepared)
+    next_event = sync_to_async(next, thread_sensitive=False)
+    while True:
+        event = await next_event(events, None)
+        if event is None:
+            break
+        yield format_sse(event)
+
 @api_view(["POST"])
 def upload_document(request):
     """
-    Accepts file upload, extracts text and tables now using pdfplumber, stores in TEMP_DOCS only
+    Accepts file upload, saves it to disk and queues it for ingestion (research/jobs.py).
+    returns the job id right away, extraction, chunking and embedding happen in a background worker.
+    poll jobs/<id>/ for progress
     """
-    global TEMP_DOCS
-
     file = request.FILES.get("file")
     if not file:
         return Response({"error": "No file uploaded"}, status=400)
+    # optional company / doc_type / date_filed form fields, they can be filtered on when asking
+    try:
+        metadata = upload_metadata(request.data)
+    except InvalidFilter as e:
+        return Response({"error": str(e)}, status=400)
 
-    # use extract_text function which handles both txt and pdf with tables
-    content = extract_text(file)
-
-    # clean extra whitespace
-    content = re.sub(r'\s+', ' ', content).strip()
+    collection_name = collection_for_request(request)
+    # a tenant that is already full is turned away before the file is even saved
+    try:
+        check_quota(collection_name, 1)
+    except TenantQuotaExceeded as e:
+        return Response({"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
 
-    # store in TEMP_DOCS (memory)
-    TEMP_DOCS.append({
-        "title": file.name,
-        "company": "Unknown",
-        "doc_type": "uploaded",
-        "content": content,
-        "date_filed": None
-    })
+    job = enqueue_upload(file, collection_name, metadata)
 
     return Response({
+        "status": job.status,
+        "job_id": job.id,
+        "status_url": reverse("ingestion-job", args=[job.id])
+    }, status=status.HTTP_202_ACCEPTED)
+
+# ingestion job status GET
+@api_view(["GET"])
+def ingestion_job(request, job_id):
+    """
+    status and per-stage progress of an upload
+    """
+    # other tenants' jobs are not visible
+    job = IngestionJob.objects.filter(pk=job_id, collection=collection_for_request(request)).first()
+    if job is None:
+        return Response({"error": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    # after a restart queued jobs wait for a worker, make sure this process has some running
+    if job.status == IngestionJob.QUEUED and getattr(settings, "INGEST_RUN_IN_PROCESS", True):
+        ensure_local_workers()
+
+    return Response(IngestionJobSerializer(job).data)
+
+# ASYNC ENDPOINTS
+# same as ask_rag / upload_document, but meant to be served through market_research/asgi.py.
+# the view itself only awaits, every CPU heavy stage runs on the bounded executor (research/executor.py)
+# so a few slow questions cannot hold every worker. when the executor is full the request is turned
+# away at once with 503, and a stage that runs past its timeout answers 504.
+
+def executor_error_response(error):
+    if isinstance(error, ExecutorSaturated):
+        response = JsonResponse({"error": "Server is busy, try again shortly", "detail": str(error)}, status=503)
+        response["Retry-After"] = "1"
+        return response
+    return JsonResponse({"error": str(error), "stage": error.stage}, status=504)
+
+@csrf_exempt
+async def ask_rag_async(request):
+    """
+    expects JSON: {"query": "your question", "filters": {...}, "mode": "hybrid", "timings": false}
+    returns {"answer": "..."}, plus the per-stage "timings" breakdown when asked for
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    try:
+        body = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    query = body.get("query")
+    if not query:
+        return JsonResponse({"error": "Query is required"}, status=400)
+    try:
+        where, mode = search_options(body)
+    except InvalidFilter as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    collection_name = await sync_to_async(collection_for_request)(request)
+    executor = get_executor()
+    with start_trace("ask_async") as trace:
+        try:
+            # embed the question, check the answer cache, search and build the prompt
+            prepared = await executor.run("retrieve", prepare_answer, query, collection_name=collection_name,
+                                          where=where, mode=mode)
+            if prepared["answer"] is None:
+                # flan-t5 generation, the slowest stage
+                response = await executor.run("generate", traced_generate, prepared["prompt"])
+                prepared["answer"] = finish_answer(query, prepared, response)
+        except (ExecutorSaturated, StageTimeout) as e:
+            return executor_error_response(e)
+
+    if wants_timings(request, body):
+        return JsonResponse({"answer": prepared["answer"], "timings": trace.breakdown()})
+    return JsonResponse({"answer": prepared["answer"]})
+
+def traced_generate(prompt: str) -> str:
+    # generate_response as a traced stage, it runs on an executor thread
+    with stage("generate") as record:
+        response = generate_response(prompt)
+        record["tokens"] = count_tokens(response)
+    return response
+
+@csrf_exempt
+async def upload_document_async(request):
+    """
+    Accepts file upload, spools it to disk and indexes it on the executor into Document/Chunk rows
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+
+    # multipart parsing reads the spooled body from disk, keep it off the event loop
+    file = await sync_to_async(lambda: request.FILES.get("file"))()
+    if not file:
+        return JsonResponse({"error": "No file uploaded"}, status=400)
+    try:
+        metadata = upload_metadata(request.POST)
+    except InvalidFilter as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    collection_name = await sync_to_async(collection_for_request)(request)
+    executor = get_executor()
+    # copied to disk in pieces, then extracted and indexed as a stream
+    path = await sync_to_async(spool_upload, thread_sensitive=False)(file)
+    try:
+        indexed = await executor.run("index", index_spooled_file, path, file.name,
+                                     collection_name=collection_name, metadata=metadata)
+    except ExecutorSaturated as e:
+        # never started, so nothing else will remove the spooled file
+        os.remove(path)
+        return executor_error_response(e)
+    except StageTimeout as e:
+        return executor_error_response(e)
+    except TenantQuotaExceeded as e:
+        return JsonResponse({"error": str(e)}, status=413)
+
+    loaded_docs = await Document.objects.filter(collection=collection_name).acount()
+
+    return JsonResponse({
         "status": "success",
-        "loaded_docs": len(TEMP_DOCS)
+        "loaded_docs": loaded_docs,
+        "chunks": indexed["chunks"],
+        "new_chunks": indexed["added"]
     })
 
-#clear TEMP_DOCS for a fresh session
+#clear the stored documents for a fresh session
 @api_view(["POST"])
 def clear_docs(request):
     """
-    Clears all uploaded documents in memory and in chromadb
+    Clears the caller's uploaded documents in the database and in chromadb, other sessions keep theirs
     """
-    global TEMP_DOCS
-
-    # clear in-memory docs
-    TEMP_DOCS = []
-    # clear chroma collection
-    client = chromadb.Client()
-    try:
-        client.delete_collection("financial_documents")
-    except:
-        pass
+    collection_name = collection_for_request(request)
+    # uploads still queued or being indexed would bring documents back after the clear
+    cancel_jobs(collection_name)
+    # delete the Document/Chunk rows and the chroma collection
+    clear_index(collection_name)
 
     return Response({
         "status": "cleared",
-        "docs_remaining": len(TEMP_DOCS)
-    })
\ No newline at end of file
+        "docs_remaining": Document.objects.filter(collection=collection_name).count()
+    })
+
+# model registry health check GET
+@api_view(["GET"])
+def model_health(request):
+    """
+    reports which models are loaded, their load time and memory.
+    ?probe=1 also runs a tiny inference on every loaded model
+    """
+    probe = request.query_params.get("probe") in ("1", "true")
+    report = registry.health(probe=probe)
+    report["backends"] = {"embedding": embedding_backend(), "generator": generation_backend(),
+                          "vector": vector_backend()}
+    report["embedding_cache"] = get_embedding_cache().stats()
+    answer_cache = get_answer_cache()
+    report["answer_cache"] = answer_cache.stats() if answer_cache is not None else None
+    report["executor"] = get_executor().stats()
+    batcher = current_batcher()
+    report["generation_batcher"] = batcher.stats() if batcher is not None else None
+    reranker = current_rerank_stage()
+    report["reranker"] = reranker.stats() if reranker is not None else None
+    code = status.HTTP_200_OK if report["status"] == "ok" else status.HTTP_503_SERVICE_UNAVAILABLE
+    return Response(report, status=code)
+
+# prometheus scrape endpoint GET
+def metrics(request):
+    """
+    every pipeline histogram (stage wall and cpu time, tokens, chunks, batch sizes, queue waits)
+    in the prometheus text format
+    """
+    return HttpResponse(render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# load every model now instead of on the first question
+# loading takes seconds and gigabytes, so only staff may trigger it over http.
+# deployments warm up at startup with `python manage.py warmup` instead
+@api_view(["POST"])
+@permission_classes([IsAdminUser])
+def warm_up_models(request):
+    """
+    loads all registered models ahead of traffic and returns their stats, staff users only
+    """
+    return Response({"status": "warmed", "models": registry.warm_up()})